@@ -0,0 +1,1063 @@
+"""
+Benchmarks for the Customer Care Multi-Agent System
+
+Usage:
+    python benchmarks.py fast-path [--threshold 0.7] [--synthetic 500] [--json out.json]
+    python benchmarks.py knowledge-base [--sizes 10,100,1000,10000,100000] [--json out.json]
+    python benchmarks.py early-exit [--tickets 140] [--llm-latency 0.05] [--json out.json]
+    python benchmarks.py checkpoints [--records 20000] [--threads 4] [--json out.json]
+    python benchmarks.py outbox [--actions 5000] [--threads 8] [--sink-latency 0.02] [--json out.json]
+    python benchmarks.py load [--corpus scenarios] [--tickets 200] [--concurrency 1,8,32]
+                              [--latency lognormal:0.05,0.4] [--error-rate 0.02] [--json out.json]
+    python benchmarks.py mock-server [--port 8089] [--latency fixed:0.1]
+
+No API key needed: these benchmarks exercise the local parts of the system,
+or run the full pipeline against a simulated LLM client or a mock OpenAI
+server (load, mock-server).
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Tuple
+
+from openai import OpenAI
+
+from customer_care_SIMPLE import (DEFAULT_ARTICLES, AGENT_GRAPH, ActionOutbox, ApprovalQueue, CheckpointLog,
+                                  CustomerCareState, CustomerCareSystem, EarlyExitPolicy, FastPathClassifier,
+                                  FileSink, KnowledgeBase, RateLimiter, ResilientClient, SpeculationPolicy,
+                                  get_customer_store, get_scenario, index_terms, percentile)
+
+# ============================================================================
+# TEST DATA
+# ============================================================================
+
+# Expected intent of each built-in menu scenario
+SCENARIO_INTENTS = {
+    "1": "REFUND",
+    "2": "REFUND",
+    "3": "SHIPPING",
+    "4": "ACCOUNT",
+    "5": "TRACKING",
+    "6": "RETURN"
+}
+
+SYNTHETIC_TEMPLATES = {
+    "REFUND": [
+        "My {item} arrived broken, I want a refund for {order}",
+        "Please refund {order}, the {item} stopped working after {days} days",
+        "I want my money back for the defective {item}",
+        "The {item} is faulty. Can I get a full refund?"
+    ],
+    "RETURN": [
+        "I'd like to return the {item} from {order}, it doesn't fit",
+        "Can I exchange my {item} for a different size?",
+        "I received the wrong {item} and want to send it back",
+        "How do I get a return label for {order}?"
+    ],
+    "SHIPPING": [
+        "My {item} is stuck in transit, it's {days} days late",
+        "How much is express shipping for a {item}?",
+        "The delivery of {order} is delayed again",
+        "Can you change the shipping address for {order}?"
+    ],
+    "TRACKING": [
+        "Where is my package? {order} should be here by now",
+        "Can you track {order} for me?",
+        "What is the status of my {item} order {order}?",
+        "Tracking for {order} hasn't updated in {days} days"
+    ],
+    "ACCOUNT": [
+        "I can't log into my account, the password reset email never came",
+        "Please help me reset my password",
+        "My account is locked after {days} failed sign in attempts",
+        "How do I change the email address on my account?"
+    ],
+    "BILLING": [
+        "I was charged twice for {order}",
+        "There's an unknown charge on my card for the {item}",
+        "Can I get an invoice for {order}?",
+        "My payment for the {item} was declined"
+    ],
+    "OTHER": [
+        "Do you have the {item} in stock?",
+        "What are your opening hours?",
+        "Can you recommend a good {item}?",
+        "Thanks for the great service on my last {item}"
+    ]
+}
+
+ITEMS = ["laptop", "blender", "jacket", "phone case", "headphones", "camera", "shirt", "monitor"]
+CUSTOMER_IDS = ["12345", "67890", "11111", "22222"]
+
+def synthetic_tickets(count: int, seed: int = 7) -> List[Dict]:
+    """Labeled tickets generated from templates"""
+    rng = random.Random(seed)
+    intents = sorted(SYNTHETIC_TEMPLATES)
+    tickets = []
+    for _ in range(count):
+        intent = rng.choice(intents)
+        query = rng.choice(SYNTHETIC_TEMPLATES[intent]).format(
+            item=rng.choice(ITEMS),
+            order=f"ORD-{rng.randint(100, 999)}",
+            days=rng.randint(2, 14)
+        )
+        tickets.append({"query": query, "customer_id": rng.choice(CUSTOMER_IDS), "intent": intent})
+    return tickets
+
+def scenario_tickets() -> List[Dict]:
+    """The six built-in menu scenarios with their expected intents"""
+    return [dict(get_scenario(choice), intent=intent) for choice, intent in SCENARIO_INTENTS.items()]
+
+# ============================================================================
+# FAST-PATH CLASSIFIER
+# ============================================================================
+
+def training_rows(csv_path: str) -> List[Dict]:
+    """Rows of the fast-path training CSV"""
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+def without_near_duplicates(rows: List[Dict], texts: List[str], max_overlap: float = 0.6) -> List[Dict]:
+    """Training rows less than max_overlap of whose terms appear together in any of texts
+
+    The training data paraphrases some evaluation tickets; scoring on
+    those would measure recall of the training set, not accuracy.
+    """
+    evaluated = {frozenset(index_terms(text)) for text in texts}
+    kept = []
+    for row in rows:
+        terms = set(index_terms(row["text"]))
+        if not terms or max(len(terms & other) for other in evaluated) / len(terms) < max_overlap:
+            kept.append(row)
+    return kept
+
+def shown_threshold(threshold: float) -> Optional[float]:
+    """A threshold for reports; None when the classifier never answers"""
+    return None if threshold == FastPathClassifier.NEVER else round(threshold, 3)
+
+def cross_validate_fast_path(rows: List[Dict], threshold: Optional[float] = None, target_accuracy: float = 0.95,
+                             folds: int = 5, seed: int = 7) -> Dict:
+    """Held-out accuracy of every field: each row is predicted by a model trained without it
+
+    Without a threshold, each fold's model calibrates its own on its
+    training rows only, so the short-circuit accuracy is held-out too.
+    """
+    rows = list(rows)
+    random.Random(seed).shuffle(rows)
+    fields = [field for field in FastPathClassifier.FIELDS if field in rows[0]]
+    intent_correct = all_correct = short_circuited = short_circuited_correct = 0
+    thresholds = []
+    for fold in range(folds):
+        held_out = rows[fold::folds]
+        classifier = FastPathClassifier.from_rows(
+            [row for i, row in enumerate(rows) if i % folds != fold], threshold, target_accuracy)
+        thresholds.append(shown_threshold(classifier.threshold))
+        for row in held_out:
+            prediction = classifier.predict(row["text"])
+            correct = all(prediction[field] == row[field].strip().upper() for field in fields)
+            intent_correct += prediction["intent"] == row["intent"].strip().upper()
+            all_correct += correct
+            if prediction["confidence"] >= classifier.threshold:
+                short_circuited += 1
+                short_circuited_correct += correct
+    return {
+        "folds": folds,
+        "rows": len(rows),
+        "thresholds": thresholds,
+        "intent_accuracy": round(intent_correct / len(rows), 3),
+        "all_fields_accuracy": round(all_correct / len(rows), 3),
+        "short_circuit_accuracy": round(short_circuited_correct / short_circuited, 3) if short_circuited else None,
+        "llm_calls_saved_pct": round(100 * short_circuited / len(rows), 1)
+    }
+
+def benchmark_fast_path(csv_path: str = "data/intent_training.csv", threshold: Optional[float] = None,
+                        synthetic: int = 500, llm_latency_s: float = 1.5, target_accuracy: float = 0.95) -> Dict:
+    """Accuracy, latency and Greeter calls saved by the local classifier
+
+    Accuracy is held-out: cross-validated over the training CSV (all
+    fields), and on the menu scenarios and synthetic tickets (intent)
+    with a model trained without their near-duplicates. Without a
+    threshold, every model calibrates one for target_accuracy. Greeter-stage
+    latency is modeled: local time for short-circuited queries, local
+    time plus llm_latency_s for the ones that fall back to the LLM.
+    """
+    rows = training_rows(csv_path)
+    report = {"threshold": "calibrated" if threshold is None else threshold,
+              "target_accuracy": target_accuracy, "llm_latency_s": llm_latency_s,
+              "cross_validation": cross_validate_fast_path(rows, threshold, target_accuracy)}
+
+    for corpus, tickets in (("scenarios", scenario_tickets()),
+                            ("synthetic", synthetic_tickets(synthetic))):
+        train = without_near_duplicates(rows, [ticket["query"] for ticket in tickets])
+        classifier = FastPathClassifier.from_rows(train, threshold, target_accuracy)
+        correct = 0
+        short_circuited = 0
+        short_circuited_correct = 0
+        local_ms = []
+        stage_ms = []
+        for ticket in tickets:
+            started = time.perf_counter()
+            prediction = classifier.predict(ticket["query"])
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            local_ms.append(elapsed_ms)
+
+            is_correct = prediction["intent"] == ticket["intent"]
+            correct += is_correct
+            if prediction["confidence"] >= classifier.threshold:
+                short_circuited += 1
+                short_circuited_correct += is_correct
+                stage_ms.append(elapsed_ms)
+            else:
+                stage_ms.append(elapsed_ms + llm_latency_s * 1000)
+
+        report[corpus] = {
+            "tickets": len(tickets),
+            "training_rows": len(train),
+            "threshold": shown_threshold(classifier.threshold),
+            "near_duplicates_removed": len(rows) - len(train),
+            "accuracy": round(correct / len(tickets), 3),
+            "short_circuit_accuracy": round(short_circuited_correct / short_circuited, 3) if short_circuited else None,
+            "llm_calls_saved": short_circuited,
+            "llm_calls_saved_pct": round(100 * short_circuited / len(tickets), 1),
+            "local_p50_ms": round(percentile(local_ms, 50), 3),
+            "local_p99_ms": round(percentile(local_ms, 99), 3),
+            "greeter_stage_p50_ms": round(percentile(stage_ms, 50), 1),
+            "greeter_stage_p99_ms": round(percentile(stage_ms, 99), 1),
+            "llm_only_p50_ms": round(llm_latency_s * 1000, 1)
+        }
+    return report
+
+def print_fast_path(report: Dict):
+    """Print the fast-path benchmark as a table"""
+    print("\n" + "="*80)
+    print(f"⚡ FAST-PATH CLASSIFIER (threshold {report['threshold']}, target accuracy "
+          f"{report['target_accuracy']}, LLM Greeter modeled at {report['llm_latency_s']}s)")
+    print("="*80)
+    cv = report["cross_validation"]
+    print(f"\n{cv['folds']}-fold cross-validation: {cv['rows']} training rows, "
+          f"thresholds {cv['thresholds']} (None: always asks the LLM)")
+    print(f"   Accuracy (intent / all fields): {cv['intent_accuracy']} / {cv['all_fields_accuracy']}")
+    print(f"   Short-circuited: {cv['llm_calls_saved_pct']}%, all fields right on {cv['short_circuit_accuracy']}")
+    for corpus in ("scenarios", "synthetic"):
+        r = report[corpus]
+        print(f"\n{corpus}: {r['tickets']} tickets (trained on {r['training_rows']} rows, "
+              f"{r['near_duplicates_removed']} near-duplicates left out, threshold {r['threshold']})")
+        print(f"   Accuracy (all / short-circuited): {r['accuracy']} / {r['short_circuit_accuracy']}")
+        print(f"   Greeter calls saved: {r['llm_calls_saved']} ({r['llm_calls_saved_pct']}%)")
+        print(f"   Local latency p50/p99: {r['local_p50_ms']} / {r['local_p99_ms']} ms")
+        print(f"   Greeter stage p50/p99: {r['greeter_stage_p50_ms']} / {r['greeter_stage_p99_ms']} ms "
+              f"(LLM only: {r['llm_only_p50_ms']} ms)")
+    print("="*80)
+
+# ============================================================================
+# KNOWLEDGE BASE
+# ============================================================================
+
+def synthetic_articles(count: int, seed: int = 7, words_per_article: int = 60) -> Dict[str, str]:
+    """Random policy-like articles with a Zipf-shaped vocabulary
+
+    The words customers actually use come first (most frequent), so
+    queries hit long posting lists as they would in a real corpus.
+    """
+    rng = random.Random(seed)
+    sample_text = " ".join(list(DEFAULT_ARTICLES.values()) + ITEMS +
+                           [t for templates in SYNTHETIC_TEMPLATES.values() for t in templates])
+    common_words = sorted(set(index_terms(sample_text)))
+    rng.shuffle(common_words)
+    vocabulary = common_words + [f"term{i}" for i in range(20000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    cumulative = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return {
+        f"doc-{i}": " ".join(rng.choices(vocabulary, cum_weights=cumulative, k=words_per_article))
+        for i in range(count)
+    }
+
+def benchmark_knowledge_base(sizes: List[int] = (10, 100, 1000, 10000, 100000),
+                             queries: int = 200, seed: int = 7) -> Dict:
+    """Build time, search latency and incremental update cost by corpus size"""
+    rng = random.Random(seed)
+    query_texts = [ticket["query"] for ticket in synthetic_tickets(queries, seed)]
+    report = {"queries": queries, "sizes": []}
+
+    for size in sizes:
+        articles = synthetic_articles(size, seed)
+        articles.update(DEFAULT_ARTICLES)
+
+        started = time.perf_counter()
+        kb = KnowledgeBase.from_articles(articles)
+        build_s = time.perf_counter() - started
+
+        search_ms = []
+        for query in query_texts:
+            started = time.perf_counter()
+            kb.search(query, 3)
+            search_ms.append((time.perf_counter() - started) * 1000)
+
+        update_ms = []
+        doc_ids = list(articles)
+        for _ in range(50):
+            doc_id = rng.choice(doc_ids)
+            started = time.perf_counter()
+            kb.update(doc_id, articles[doc_id] + " updated")
+            kb.remove(doc_id)
+            kb.add(doc_id, articles[doc_id])
+            update_ms.append((time.perf_counter() - started) * 1000 / 3)
+
+        report["sizes"].append({
+            "articles": len(kb),
+            "terms": len(kb.postings),
+            "build_s": round(build_s, 3),
+            "search_p50_ms": round(percentile(search_ms, 50), 3),
+            "search_p99_ms": round(percentile(search_ms, 99), 3),
+            "update_p50_ms": round(percentile(update_ms, 50), 3)
+        })
+    return report
+
+def print_knowledge_base(report: Dict):
+    """Print the knowledge-base benchmark as a table"""
+    print("\n" + "="*80)
+    print(f"📚 KNOWLEDGE BASE (BM25, top-3, {report['queries']} queries per size)")
+    print("="*80)
+    print(f"{'articles':>10} {'terms':>8} {'build s':>9} {'search p50 ms':>14} "
+          f"{'search p99 ms':>14} {'add/upd/del ms':>15}")
+    for r in report["sizes"]:
+        print(f"{r['articles']:>10} {r['terms']:>8} {r['build_s']:>9} {r['search_p50_ms']:>14} "
+              f"{r['search_p99_ms']:>14} {r['update_p50_ms']:>15}")
+    print("="*80)
+
+# ============================================================================
+# SIMULATED LLM
+# ============================================================================
+
+# Answers of the structured agents, keyed by a phrase from their system prompt
+CANNED_RESPONSES = {
+    "Quality Assurance": json.dumps({"verdict": "APPROVED", "score": 9, "feedback": "Complete"}),
+    "Escalation Manager": json.dumps({"escalate": False, "reason": "Routine request"}),
+    "Follow-up Coordinator": json.dumps({"follow_up": False, "timing": "none"})
+}
+DEFAULT_REPLY = "Thanks for reaching out - here is what we found and what happens next."
+
+def canned_reply(system_prompt: str, query: str, intent: str,
+                 responses: Dict[str, str] = CANNED_RESPONSES) -> str:
+    """The simulated answer of the agent whose system prompt this is"""
+    if "Intent Classifier" in system_prompt and "Intent Classifier" not in responses:
+        return json.dumps({"greeting": "Hello!", "intent": intent, "sentiment": "NEUTRAL",
+                           "priority": "MEDIUM", "summary": query, "confidence": 0.9})
+    return next((reply for phrase, reply in responses.items() if phrase in system_prompt), DEFAULT_REPLY)
+
+class SimulatedCompletions:
+    """Stands in for client.chat.completions: fixed latency, canned answers
+    
+    The Greeter answers with the intent stored for the query in labels.
+    """
+    def __init__(self, labels: Dict[str, str], latency_s: float):
+        self.labels = labels
+        self.latency_s = latency_s
+
+    def create(self, **request):
+        time.sleep(self.latency_s)
+        system_prompt = request["messages"][0]["content"]
+        query = next((q for q in self.labels if q in request["messages"][-1]["content"]), "")
+        content = canned_reply(system_prompt, query, self.labels.get(query, "OTHER"))
+        message = SimpleNamespace(content=content, tool_calls=None)
+        usage = SimpleNamespace(prompt_tokens=300, completion_tokens=60, total_tokens=360)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")],
+                               usage=usage)
+
+def simulated_system(labels: Dict[str, str], latency_s: float, **kwargs) -> CustomerCareSystem:
+    """A CustomerCareSystem whose agents call SimulatedCompletions"""
+    unlimited = ResilientClient(limiter=RateLimiter(1e9, 1e12))
+    system = CustomerCareSystem("sk-simulated", verbose=False, resilience=unlimited, **kwargs)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimulatedCompletions(labels, latency_s)))
+    for agent in system.agents.values():
+        agent.client = client
+    return system
+
+# ============================================================================
+# EARLY EXIT
+# ============================================================================
+
+def benchmark_early_exit(tickets: int = 140, llm_latency_s: float = 0.05, workers: int = 8) -> Dict:
+    """Latency and agent calls per intent with and without the early-exit rules
+
+    Both runs use the simulated LLM, so the difference comes from the
+    skipped agents alone. Queries are made unique so no caching kicks in.
+    """
+    batch = synthetic_tickets(tickets)
+    for i, ticket in enumerate(batch):
+        ticket["query"] = f"{ticket['query']} (ticket {i})"
+    labels = {ticket["query"]: ticket["intent"] for ticket in batch}
+    pairs = [(ticket["query"], ticket["customer_id"]) for ticket in batch]
+
+    latencies = {}
+    calls = {}
+    policy = EarlyExitPolicy()
+    for mode, early_exit in (("baseline", None), ("early_exit", policy)):
+        system = simulated_system(labels, llm_latency_s, early_exit=early_exit)
+        latencies[mode] = defaultdict(list)
+        calls[mode] = defaultdict(int)
+        for result in system.handle_batch(pairs, max_workers=workers):
+            intent = batch[result["index"]]["intent"]
+            latencies[mode][intent].append(result["latency"])
+            calls[mode][intent] += sum(usage["calls"] for usage in result.get("usage", {}).values())
+        system.agent_pool.shutdown()
+
+    estimated = policy.stats()
+    report = {"tickets": tickets, "llm_latency_s": llm_latency_s, "workers": workers, "intents": {}}
+    for intent in sorted(latencies["baseline"]):
+        baseline = latencies["baseline"][intent]
+        early = latencies["early_exit"][intent]
+        report["intents"][intent] = {
+            "tickets": len(baseline),
+            "short_circuited": estimated.get(intent, {}).get("short_circuited", 0),
+            "calls_skipped": estimated.get(intent, {}).get("calls_skipped", 0),
+            "baseline_llm_calls": calls["baseline"][intent],
+            "early_exit_llm_calls": calls["early_exit"][intent],
+            "baseline_mean_s": round(sum(baseline) / len(baseline), 3),
+            "early_exit_mean_s": round(sum(early) / len(early), 3),
+            "measured_saved_s": round(sum(baseline) / len(baseline) - sum(early) / len(early), 3),
+            "estimated_saved_s": estimated.get(intent, {}).get("mean_seconds_saved", 0.0)
+        }
+    return report
+
+def print_early_exit(report: Dict):
+    """Print the early-exit benchmark as a table"""
+    print("\n" + "="*80)
+    print(f"⏭️  EARLY EXIT ({report['tickets']} tickets, simulated LLM at {report['llm_latency_s']}s per call, "
+          f"{report['workers']} workers)")
+    print("="*80)
+    print(f"{'intent':>10} {'tickets':>8} {'skipped':>8} {'calls cut':>10} {'baseline s':>11} "
+          f"{'early s':>8} {'saved s':>8} {'est. s':>7}")
+    for intent, r in report["intents"].items():
+        print(f"{intent:>10} {r['tickets']:>8} {r['short_circuited']:>8} {r['calls_skipped']:>10} "
+              f"{r['baseline_mean_s']:>11} {r['early_exit_mean_s']:>8} {r['measured_saved_s']:>8} "
+              f"{r['estimated_saved_s']:>7}")
+    print("="*80)
+
+# ============================================================================
+# CHECKPOINTS
+# ============================================================================
+
+def sample_checkpoint(agents_done: int) -> Dict:
+    """A checkpoint shaped like a real one after agents_done agents"""
+    state = CustomerCareState()
+    state.customer_query = "My laptop stopped working after 3 days, I want a refund for ORD-321"
+    state.customer_id = "67890"
+    state.customer_info = get_customer_store().get_customer("67890")
+    state.intent, state.sentiment, state.priority = "REFUND", "NEGATIVE", "HIGH"
+    state.usage = {node.key: {"model": "gpt-4o-mini", "calls": 1, "prompt_tokens": 900,
+                              "completion_tokens": 150}
+                   for node in AGENT_GRAPH[:agents_done]}
+    outputs = {node.key: "Thanks for reaching out - here is what we found and what happens next. " * 5
+               for node in AGENT_GRAPH[:agents_done]}
+    return {"state": state.to_dict(), "outputs": outputs, "produced": {},
+            "timings": {key: [0.0, 1.2] for key in outputs}, "context_tokens": {}, "skipped": []}
+
+def benchmark_checkpoints(records: int = 20000, threads: int = 4, flush_interval: float = 0.02) -> Dict:
+    """Cost of CheckpointLog.append() under concurrent writers, and fsyncs per record"""
+    checkpoints = [sample_checkpoint(done) for done in range(1, len(AGENT_GRAPH) + 1)]
+    with tempfile.TemporaryDirectory() as directory:
+        log = CheckpointLog(os.path.join(directory, "checkpoints.log"), flush_interval=flush_interval)
+        append_us = [[] for _ in range(threads)]
+
+        def writer(worker: int):
+            for i in range(worker, records, threads):
+                checkpoint = checkpoints[i % len(checkpoints)]
+                started = time.perf_counter()
+                log.append(f"TKT-{i // len(checkpoints)}", checkpoint)
+                append_us[worker].append((time.perf_counter() - started) * 1e6)
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=writer, args=(worker,)) for worker in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        appended_s = time.perf_counter() - started
+        log.flush()
+        durable_s = time.perf_counter() - started
+        stats = log.stats()
+        log.close()
+
+    latencies = [us for worker in append_us for us in worker]
+    return {
+        "records": records,
+        "threads": threads,
+        "flush_interval_s": flush_interval,
+        "append_p50_us": round(percentile(latencies, 50), 1),
+        "append_p99_us": round(percentile(latencies, 99), 1),
+        "appends_per_s": round(records / appended_s),
+        "durable_records_per_s": round(records / durable_s),
+        "fsyncs": stats["batches"],
+        "records_per_fsync": stats["mean_batch"],
+        "mean_fsync_ms": stats["mean_fsync_ms"],
+        "mean_record_bytes": stats["mean_record_bytes"],
+        "json_record_bytes": round(sum(len(json.dumps(c)) for c in checkpoints) / len(checkpoints))
+    }
+
+def print_checkpoints(report: Dict):
+    """Print the checkpoint benchmark"""
+    print("\n" + "="*80)
+    print(f"💾 CHECKPOINT LOG ({report['records']} records from {report['threads']} threads, "
+          f"group commit every {report['flush_interval_s']}s)")
+    print("="*80)
+    print(f"   append() p50/p99: {report['append_p50_us']} / {report['append_p99_us']} µs")
+    print(f"   Throughput: {report['appends_per_s']} appends/s, {report['durable_records_per_s']} durable records/s")
+    print(f"   fsyncs: {report['fsyncs']} ({report['records_per_fsync']} records each, "
+          f"{report['mean_fsync_ms']} ms each)")
+    print(f"   Record size: {report['mean_record_bytes']} bytes on disk vs {report['json_record_bytes']} as JSON")
+    print("="*80)
+
+class SlowSink:
+    """A sink that takes a fixed time per batch, like one round trip to a mail or payments API"""
+    def __init__(self, latency_s: float):
+        self.latency_s = latency_s
+        self.sent = 0
+
+    def send(self, actions: List[Dict]):
+        time.sleep(self.latency_s)
+        self.sent += len(actions)
+
+def benchmark_outbox(actions: int = 5000, threads: int = 8, sink_latency_s: float = 0.02,
+                     batch_size: int = 100) -> Dict:
+    """Cost of queueing a refund or email, batch sizes, and the delay until it is sent"""
+    sink = SlowSink(sink_latency_s)
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = ActionOutbox(os.path.join(directory, "outbox.sqlite3"), sinks={"email": sink, "refund": sink},
+                              batch_size=batch_size)
+        enqueue_us = [[] for _ in range(threads)]
+
+        def writer(worker: int):
+            for i in range(worker, actions, threads):
+                kind = "refund" if i % 2 else "email"
+                payload = {"order_id": f"ORD-{i}", "amount": 25.0} if i % 2 else \
+                    {"recipient": f"customer{i}@example.com", "subject": "Your ticket"}
+                started = time.perf_counter()
+                outbox.enqueue(kind, payload, f"TKT-{i}", outbox.idempotency_key(f"TKT-{i}", kind, payload))
+                enqueue_us[worker].append((time.perf_counter() - started) * 1e6)
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=writer, args=(worker,)) for worker in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        enqueued_s = time.perf_counter() - started
+        # A second pass queues nothing: every key is already in the outbox
+        outbox.enqueue("email", {"recipient": "customer0@example.com", "subject": "Your ticket"}, "TKT-0",
+                       outbox.idempotency_key("TKT-0", "email", {"recipient": "customer0@example.com",
+                                                                 "subject": "Your ticket"}))
+        outbox.flush(timeout=600)
+        sent_s = time.perf_counter() - started
+        stats = outbox.stats()
+        outbox.close()
+
+    latencies = [us for worker in enqueue_us for us in worker]
+    return {
+        "actions": actions,
+        "threads": threads,
+        "sink_latency_s": sink_latency_s,
+        "enqueue_p50_us": round(percentile(latencies, 50), 1),
+        "enqueue_p99_us": round(percentile(latencies, 99), 1),
+        "enqueues_per_s": round(actions / enqueued_s),
+        "sent_per_s": round(sink.sent / sent_s),
+        "inline_sent_per_s": round(threads / sink_latency_s) if sink_latency_s else None,
+        "batches": stats["batches"],
+        "mean_batch": stats["mean_batch"],
+        "max_batch": stats["max_batch"],
+        "dispatch_p50_ms": stats["dispatch_p50_ms"],
+        "dispatch_p99_ms": stats["dispatch_p99_ms"],
+        "duplicates": stats["duplicates"]
+    }
+
+def print_outbox(report: Dict):
+    """Print the outbox benchmark"""
+    print("\n" + "="*80)
+    print(f"📮 ACTION OUTBOX ({report['actions']} actions from {report['threads']} threads, "
+          f"{report['sink_latency_s']}s per sink call)")
+    print("="*80)
+    print(f"   enqueue() p50/p99: {report['enqueue_p50_us']} / {report['enqueue_p99_us']} µs")
+    print(f"   Throughput: {report['enqueues_per_s']} enqueues/s, {report['sent_per_s']} sent/s "
+          f"(vs {report['inline_sent_per_s'] or '-'} sent/s calling the sink inline)")
+    print(f"   Batches: {report['batches']} ({report['mean_batch']} actions each, max {report['max_batch']})")
+    print(f"   Enqueue to sent p50/p99: {report['dispatch_p50_ms']} / {report['dispatch_p99_ms']} ms")
+    print(f"   Duplicates dropped: {report['duplicates']}")
+    print("="*80)
+
+# ============================================================================
+# MOCK OPENAI SERVER
+# ============================================================================
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """A latency distribution: "fixed:0.05", "uniform:0.02,0.2" or "lognormal:0.05,0.4"
+
+    lognormal takes the median (seconds) and sigma of the distribution.
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(*values)
+    if kind == "lognormal" and len(values) == 2:
+        median, sigma = values
+        return lambda rng: rng.lognormvariate(math.log(median), sigma)
+    raise ValueError(f"Unknown latency distribution: {spec!r}")
+
+class MockOpenAIServer:
+    """Local HTTP stand-in for the chat completions endpoint
+
+    Unlike SimulatedCompletions, requests go through the real OpenAI
+    client, its connection pool and ResilientClient. Each request waits
+    for a delay drawn from the latency distribution, fails with a 429,
+    500 or 503 at error_rate, and otherwise answers with canned_reply()
+    (streamed as server-sent events when asked). The Greeter's intent
+    comes from labels (query -> intent). Like the API's prompt cache, it
+    reports the leading messages it has seen before (same model) as
+    cached_tokens; unlike it, there is no 1024-token minimum. With
+    tool_calls (tool name -> arguments), a request offering one of those
+    tools is first answered with calls to them.
+    """
+    GREETER_TASK = "Analyze this customer query: "
+
+    def __init__(self, labels: Optional[Dict[str, str]] = None, latency: str = "lognormal:0.05,0.4",
+                 error_rate: float = 0.0, responses: Dict[str, str] = CANNED_RESPONSES,
+                 host: str = "127.0.0.1", port: int = 0, seed: int = 7,
+                 tool_calls: Optional[Dict[str, Dict]] = None):
+        self.labels = labels or {}
+        self.tool_calls = tool_calls or {}
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.responses = responses
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = defaultdict(int)
+        self.prefixes = set()   # Hashes of message prefixes seen, per model
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockOpenAIServer":
+        """Serve from a background thread"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # Keep-alive, like the real API
+            wbufsize = 1 << 16              # Headers and body leave in one write (no Nagle delay)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, headers, payload = server.respond(self.path, json.loads(body or b"{}"))
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def respond(self, path: str, request: Dict) -> Tuple[int, Dict[str, str], bytes]:
+        """Status, headers and body for one request"""
+        with self.lock:
+            delay = self.latency(self.rng)
+            failure = self.rng.choice((429, 500, 503)) if self.rng.random() < self.error_rate else None
+            self.stats["requests"] += 1
+            self.stats["streamed"] += bool(request.get("stream"))
+            if failure:
+                self.stats[f"errors_{failure}"] += 1
+        time.sleep(delay)
+        if not path.endswith("/chat/completions"):
+            return 404, {"Content-Type": "application/json"}, b'{"error": {"message": "Not found"}}'
+        if failure:
+            error = {"error": {"message": "Simulated failure", "type": "server_error", "code": failure}}
+            headers = {"Content-Type": "application/json"}
+            if failure == 429:
+                headers["retry-after"] = "0.1"
+            return failure, headers, json.dumps(error).encode()
+
+        messages = request.get("messages", [])
+        system_prompt = messages[0]["content"] if messages else ""
+        task = messages[-1]["content"] if messages else ""
+        query = task[len(self.GREETER_TASK):] if task.startswith(self.GREETER_TASK) else ""
+        content = canned_reply(system_prompt, query, self.labels.get(query, "OTHER"), self.responses)
+        prompt_tokens = sum(len(str(message.get("content") or "")) for message in messages) // 4
+        completion_tokens = max(1, len(content) // 4)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_tokens_details": {"cached_tokens": self._cached_tokens(request)}}
+        head = {"id": f"chatcmpl-{uuid.uuid4().hex}", "created": int(time.time()),
+                "model": request.get("model", "gpt-4o-mini")}
+
+        if not request.get("stream"):
+            message, finish_reason = {"role": "assistant", "content": content}, "stop"
+            calls = self._tool_calls(request)
+            if calls:
+                message, finish_reason = {"role": "assistant", "content": None, "tool_calls": calls}, "tool_calls"
+            body = dict(head, object="chat.completion", usage=usage, choices=[
+                {"index": 0, "message": message, "finish_reason": finish_reason}])
+            return 200, {"Content-Type": "application/json"}, json.dumps(body).encode()
+
+        events = [dict(head, object="chat.completion.chunk", choices=[
+                      {"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}])
+                  for piece in re.findall(r"\S+\s*", content)]
+        events.append(dict(head, object="chat.completion.chunk",
+                           choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            events.append(dict(head, object="chat.completion.chunk", choices=[], usage=usage))
+        payload = "".join(f"data: {json.dumps(event)}\n\n" for event in events) + "data: [DONE]\n\n"
+        return 200, {"Content-Type": "text/event-stream"}, payload.encode()
+
+    def _tool_calls(self, request: Dict) -> List[Dict]:
+        """Calls to the configured tools the request offers, unless it already has their results"""
+        if any(message.get("role") == "tool" for message in request.get("messages", [])):
+            return []
+        offered = {tool["function"]["name"] for tool in request.get("tools", [])}
+        calls = [{"id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+                  "function": {"name": name, "arguments": json.dumps(arguments)}}
+                 for name, arguments in self.tool_calls.items() if name in offered]
+        with self.lock:
+            self.stats["tool_calls"] += len(calls)
+        return calls
+
+    def _cached_tokens(self, request: Dict) -> int:
+        """Tokens of the longest run of leading messages seen in an earlier request"""
+        digest = hashlib.sha256(request.get("model", "").encode())
+        cached = seen = 0
+        with self.lock:
+            for message in request.get("messages", []):
+                digest.update(json.dumps(message, sort_keys=True).encode())
+                seen += len(str(message.get("content") or "")) // 4
+                prefix = digest.copy().hexdigest()
+                if prefix in self.prefixes:
+                    cached = seen
+                else:
+                    self.prefixes.add(prefix)
+        return cached
+
+# ============================================================================
+# LOAD TEST
+# ============================================================================
+
+def load_tickets(corpus: str, tickets: int) -> List[Dict]:
+    """The menu scenarios (repeated up to tickets) or synthetic tickets"""
+    if corpus == "scenarios":
+        scenarios = scenario_tickets()
+        return [dict(scenarios[i % len(scenarios)]) for i in range(tickets)]
+    return synthetic_tickets(tickets)
+
+def latency_summary(values: List[float]) -> Dict:
+    """Mean and tail latency of a list of durations, in seconds"""
+    return {
+        "count": len(values),
+        "mean_s": round(sum(values) / len(values), 4) if values else 0.0,
+        "p50_s": round(percentile(values, 50), 4),
+        "p95_s": round(percentile(values, 95), 4),
+        "p99_s": round(percentile(values, 99), 4)
+    }
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of this process (None where unsupported)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def git_commit() -> Optional[str]:
+    """Short hash of the checked-out commit, to label the report"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_run(batch: List[Dict], base_url: str, concurrency: int, trace_memory: bool = False,
+             speculate: bool = False) -> Dict:
+    """Run a batch through a fresh system pointed at base_url"""
+    unlimited = ResilientClient(limiter=RateLimiter(1e9, 1e12), backoff_base=0.05)
+    with tempfile.TemporaryDirectory() as directory:
+        approvals = ApprovalQueue(os.path.join(directory, "approvals.sqlite3"))
+        outbox = ActionOutbox(os.path.join(directory, "outbox.sqlite3"),
+                              sinks={"email": FileSink(os.path.join(directory, "sent_emails.jsonl")),
+                                     "refund": FileSink(os.path.join(directory, "refunds.jsonl"))})
+        # Up to three agents of a ticket run at once
+        system = CustomerCareSystem("sk-mock", verbose=False, resilience=unlimited,
+                                    agent_workers=max(16, concurrency * 3), approval_queue=approvals,
+                                    speculation=SpeculationPolicy() if speculate else None, outbox=outbox)
+        client = OpenAI(api_key="sk-mock", base_url=base_url, max_retries=0)
+        system.client = client
+        for agent in system.agents.values():
+            agent.client = client
+
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        results = list(system.handle_batch(((t["query"], t["customer_id"]) for t in batch),
+                                           max_workers=concurrency))
+        elapsed = time.perf_counter() - started
+        traced_peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        system.agent_pool.shutdown()
+        approvals.close()
+        outbox.flush()
+        outbox_stats = outbox.stats()
+        outbox.close()
+
+    agents = defaultdict(list)
+    tokens = []
+    cached = []
+    for result in results:
+        for key, timing in result.get("schedule", {}).get("agents", {}).items():
+            agents[key].append(timing["duration_s"])
+        tokens.append(sum(usage["prompt_tokens"] + usage["completion_tokens"]
+                          for usage in result.get("usage", {}).values()))
+        cached.append(sum(usage.get("cached_tokens", 0) for usage in result.get("usage", {}).values()))
+    client_stats = system.client_stats()
+    return {
+        "concurrency": concurrency,
+        "tickets": len(results),
+        "failed": sum(result["status"] == "ERROR" for result in results),
+        "agent_errors": sum(len(result.get("agent_errors", {})) for result in results),
+        "elapsed_s": round(elapsed, 3),
+        "tickets_per_s": round(len(results) / elapsed, 2),
+        "end_to_end": latency_summary([result["latency"] for result in results]),
+        "agents": {node.key: latency_summary(agents[node.key]) for node in AGENT_GRAPH if agents[node.key]},
+        "tokens_per_ticket": round(sum(tokens) / len(tokens), 1) if tokens else 0.0,
+        "cached_tokens_per_ticket": round(sum(cached) / len(cached), 1) if cached else 0.0,
+        "api_attempts": client_stats.get("attempts", 0),
+        "api_retries": client_stats.get("retries", 0),
+        "speculation": system.speculation_stats() if speculate else None,
+        "outbox": outbox_stats,
+        "peak_rss_mb": peak_rss_mb(),
+        "traced_peak_mb": round(traced_peak / 2**20, 1) if traced_peak is not None else None
+    }
+
+def benchmark_load(corpus: str = "scenarios", tickets: int = 200, concurrency: List[int] = (1, 8, 32),
+                   latency: str = "lognormal:0.05,0.4", error_rate: float = 0.0,
+                   responses: Optional[Dict[str, str]] = None, base_url: Optional[str] = None,
+                   trace_memory: bool = False, speculate: bool = False) -> Dict:
+    """Throughput and per-agent latency of the full pipeline at each concurrency
+
+    Runs against a MockOpenAIServer started in this process, or against
+    base_url (e.g. a separate "mock-server" process, so serving the
+    responses doesn't compete with the pipeline for the interpreter).
+    With speculate, the Researcher is started on a predicted intent.
+    """
+    batch = load_tickets(corpus, tickets)
+    server = None
+    if base_url is None:
+        labels = {ticket["query"]: ticket["intent"] for ticket in batch}
+        server = MockOpenAIServer(labels, latency, error_rate, {**CANNED_RESPONSES, **(responses or {})})
+        base_url = server.start().base_url
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "corpus": corpus,
+        "tickets": tickets,
+        "latency": latency if server else "external",
+        "error_rate": error_rate if server else None,
+        "speculate": speculate,
+        "runs": []
+    }
+    try:
+        for workers in concurrency:
+            report["runs"].append(load_run(batch, base_url, workers, trace_memory, speculate))
+    finally:
+        if server is not None:
+            report["server"] = dict(server.stats)
+            server.close()
+    return report
+
+def print_load(report: Dict):
+    """Print the load test: one summary row per concurrency, then per-agent tails"""
+    print("\n" + "="*80)
+    print(f"🚦 LOAD TEST ({report['tickets']} {report['corpus']} tickets, latency {report['latency']}, "
+          f"error rate {report['error_rate']}, commit {report['commit']})")
+    print("="*80)
+    print(f"{'workers':>8} {'tickets/s':>10} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} "
+          f"{'tokens':>8} {'cached':>7} {'retries':>8} {'failed':>7} {'RSS MB':>7}")
+    for run in report["runs"]:
+        e2e = run["end_to_end"]
+        print(f"{run['concurrency']:>8} {run['tickets_per_s']:>10} {e2e['p50_s']:>8} {e2e['p95_s']:>8} "
+              f"{e2e['p99_s']:>8} {run['tokens_per_ticket']:>8} {run['cached_tokens_per_ticket']:>7} "
+              f"{run['api_retries']:>8} "
+              f"{run['failed']:>7} {run['peak_rss_mb'] or '-':>7}")
+    for run in report["runs"]:
+        if run["speculation"]:
+            speculation = run["speculation"]
+            print(f"   Speculation at {run['concurrency']} workers: {speculation['hit_rate']:.0%} hits, "
+                  f"{speculation['mean_seconds_saved']}s saved per ticket, "
+                  f"{speculation['tokens_wasted']} tokens wasted")
+    for run in report["runs"]:
+        outbox = run["outbox"]
+        if not outbox["enqueued"]:
+            continue
+        print(f"   Outbox at {run['concurrency']} workers: {outbox['sent']} actions sent in "
+              f"{outbox['batches']} batches, {outbox['duplicates']} duplicates, "
+              f"p99 {outbox['dispatch_p99_ms']} ms to send")
+    for run in report["runs"]:
+        print(f"\n   Per agent at {run['concurrency']} workers (p50 / p95 / p99 s):")
+        for key, tails in run["agents"].items():
+            print(f"   {key:>14}: {tails['p50_s']} / {tails['p95_s']} / {tails['p99_s']}")
+    if "server" in report:
+        print(f"\n   Mock server: {report['server']}")
+    print("="*80)
+
+def serve_mock(port: int, latency: str, error_rate: float, responses: Optional[Dict[str, str]], tickets: int):
+    """Run a MockOpenAIServer in the foreground (for load tests with --base-url)
+
+    The Greeter's intents are known for the menu scenarios and the first
+    tickets synthetic tickets.
+    """
+    labels = {ticket["query"]: ticket["intent"] for ticket in scenario_tickets() + synthetic_tickets(tickets)}
+    server = MockOpenAIServer(labels, latency, error_rate, {**CANNED_RESPONSES, **(responses or {})},
+                              port=port)
+    print(f"🧪 Mock OpenAI server on {server.base_url} (latency {latency}, error rate {error_rate})")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+# ============================================================================
+# MAIN
+# ============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Customer care benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    fast_path = commands.add_parser("fast-path", help="local classifier vs LLM Greeter")
+    fast_path.add_argument("--csv", default="data/intent_training.csv")
+    fast_path.add_argument("--threshold", type=float, help="fixed threshold (default: calibrated)")
+    fast_path.add_argument("--target-accuracy", type=float, default=0.95)
+    fast_path.add_argument("--synthetic", type=int, default=500)
+    fast_path.add_argument("--llm-latency", type=float, default=1.5)
+    fast_path.add_argument("--json", help="also write the report to this file")
+
+    knowledge_base = commands.add_parser("knowledge-base", help="BM25 search latency by corpus size")
+    knowledge_base.add_argument("--sizes", default="10,100,1000,10000,100000")
+    knowledge_base.add_argument("--queries", type=int, default=200)
+    knowledge_base.add_argument("--json", help="also write the report to this file")
+
+    early_exit = commands.add_parser("early-exit", help="agent calls and latency saved per intent")
+    early_exit.add_argument("--tickets", type=int, default=140)
+    early_exit.add_argument("--llm-latency", type=float, default=0.05)
+    early_exit.add_argument("--workers", type=int, default=8)
+    early_exit.add_argument("--json", help="also write the report to this file")
+
+    checkpoint_log = commands.add_parser("checkpoints", help="checkpoint append cost and fsync batching")
+    checkpoint_log.add_argument("--records", type=int, default=20000)
+    checkpoint_log.add_argument("--threads", type=int, default=4)
+    checkpoint_log.add_argument("--flush-interval", type=float, default=0.02)
+    checkpoint_log.add_argument("--json", help="also write the report to this file")
+
+    outbox = commands.add_parser("outbox", help="enqueue cost, batching and send delay of the action outbox")
+    outbox.add_argument("--actions", type=int, default=5000)
+    outbox.add_argument("--threads", type=int, default=8)
+    outbox.add_argument("--sink-latency", type=float, default=0.02)
+    outbox.add_argument("--batch-size", type=int, default=100)
+    outbox.add_argument("--json", help="also write the report to this file")
+
+    load = commands.add_parser("load", help="throughput and latency against a mock OpenAI server")
+    load.add_argument("--corpus", choices=("scenarios", "synthetic"), default="scenarios")
+    load.add_argument("--tickets", type=int, default=200)
+    load.add_argument("--concurrency", default="1,8,32")
+    load.add_argument("--latency", default="lognormal:0.05,0.4",
+                      help="fixed:S, uniform:MIN,MAX or lognormal:MEDIAN,SIGMA (seconds)")
+    load.add_argument("--error-rate", type=float, default=0.0)
+    load.add_argument("--responses", help="JSON file of canned replies keyed by system prompt phrase")
+    load.add_argument("--base-url", help="use an already running mock server")
+    load.add_argument("--trace-memory", action="store_true", help="also measure Python allocations")
+    load.add_argument("--speculate", action="store_true", help="start the Researcher on a predicted intent")
+    load.add_argument("--json", help="also write the report to this file")
+
+    mock_server = commands.add_parser("mock-server", help="run the mock OpenAI server in the foreground")
+    mock_server.add_argument("--port", type=int, default=8089)
+    mock_server.add_argument("--latency", default="lognormal:0.05,0.4")
+    mock_server.add_argument("--error-rate", type=float, default=0.0)
+    mock_server.add_argument("--responses")
+    mock_server.add_argument("--tickets", type=int, default=10000,
+                             help="synthetic tickets whose intents the Greeter knows")
+
+    args = parser.parse_args()
+    responses = None
+    if getattr(args, "responses", None):
+        with open(args.responses) as f:
+            responses = json.load(f)
+    if args.command == "fast-path":
+        report = benchmark_fast_path(args.csv, args.threshold, args.synthetic, args.llm_latency,
+                                     args.target_accuracy)
+        print_fast_path(report)
+    elif args.command == "knowledge-base":
+        sizes = [int(size) for size in args.sizes.split(",")]
+        report = benchmark_knowledge_base(sizes, args.queries)
+        print_knowledge_base(report)
+    elif args.command == "early-exit":
+        report = benchmark_early_exit(args.tickets, args.llm_latency, args.workers)
+        print_early_exit(report)
+    elif args.command == "checkpoints":
+        report = benchmark_checkpoints(args.records, args.threads, args.flush_interval)
+        print_checkpoints(report)
+    elif args.command == "outbox":
+        report = benchmark_outbox(args.actions, args.threads, args.sink_latency, args.batch_size)
+        print_outbox(report)
+    elif args.command == "load":
+        concurrency = [int(workers) for workers in args.concurrency.split(",")]
+        report = benchmark_load(args.corpus, args.tickets, concurrency, args.latency, args.error_rate,
+                                responses, args.base_url, args.trace_memory, args.speculate)
+        print_load(report)
+    elif args.command == "mock-server":
+        serve_mock(args.port, args.latency, args.error_rate, responses, args.tickets)
+        return
+
+    if getattr(args, "json", None):
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
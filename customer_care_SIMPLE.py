@@ -7,18 +7,55 @@ DSA 2020A Lab 2 Assignment
 """
 
 import os
+import re
+import csv
+import sys
 import json
+import math
+import argparse
+import random
+import heapq
+import zlib
+import copy
+import queue
+import asyncio
+import builtins
+import time
+import hashlib
+import uuid
+import sqlite3
+import struct
+import threading
+import multiprocessing
+import contextvars
+import smtplib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial
+import dataclasses
+from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
-from typing import Dict, List, Optional
+from email.message import EmailMessage
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 # Try to import OpenAI
 try:
-    from openai import OpenAI
+    import httpx
+    import openai
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAI
 except ImportError:
     print("ERROR: OpenAI library not installed!")
     print("Install it with: python -m pip install openai")
     exit(1)
 
+# NumPy is only needed for the semantic intent cache and local classifier
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
@@ -47,182 +84,3246 @@ def get_api_key():
     return api_key
 
 # ============================================================================
-# SHARED STATE
+# TRACING
+# ============================================================================
+
+# Monotonic clock -> Unix time, for exported spans
+_UNIX_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+class TraceRecord:
+    """One span: a ticket, an agent call or a tool call"""
+    __slots__ = ("kind", "name", "trace_id", "span_id", "parent_id", "ticket_id",
+                 "start_ns", "end_ns", "status", "model", "prompt_tokens",
+                 "completion_tokens", "cached_tokens", "cache_hit", "detail")
+    
+    def __init__(self, kind: str, name: str, trace_id: str, parent_id: str, ticket_id: str,
+                 start_ns: int, end_ns: int, status: str = "ok", model: str = "",
+                 prompt_tokens: int = 0, completion_tokens: int = 0, cache_hit: bool = False,
+                 detail: str = "", span_id: Optional[str] = None, cached_tokens: int = 0):
+        self.kind = kind
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id or os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.ticket_id = ticket_id
+        self.start_ns = start_ns    # time.monotonic_ns()
+        self.end_ns = end_ns
+        self.status = status        # "ok", "error" or "invalid"
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_tokens = cached_tokens   # Prompt tokens served from the API's prompt cache
+        self.cache_hit = cache_hit
+        self.detail = detail[:200]
+        
+    @property
+    def ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+        
+    def to_span(self) -> Dict:
+        """The record as an OpenTelemetry-style span"""
+        attributes = {"ticket.id": self.ticket_id}
+        if self.kind == "agent":
+            attributes.update({
+                "agent.name": self.name,
+                "llm.model": self.model,
+                "llm.usage.prompt_tokens": self.prompt_tokens,
+                "llm.usage.completion_tokens": self.completion_tokens,
+                "llm.usage.cached_tokens": self.cached_tokens,
+                "cache.hit": self.cache_hit
+            })
+        elif self.kind == "tool":
+            attributes["tool.name"] = self.name
+        if self.detail:
+            attributes["detail"] = self.detail
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": f"{self.kind}.{self.name}",
+            "start_time_unix_nano": self.start_ns + _UNIX_OFFSET_NS,
+            "end_time_unix_nano": self.end_ns + _UNIX_OFFSET_NS,
+            "duration_ms": round(self.ms, 3),
+            "status": {"code": "OK" if self.status == "ok" else "ERROR"},
+            "attributes": attributes
+        }
+
+class TraceBuffer:
+    """Fixed-size ring buffer of trace records shared by all queries
+    
+    Memory stays bounded in long-running workers: once capacity records
+    are held, each new one overwrites the oldest.
+    """
+    def __init__(self, capacity: int = 10_000):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.next = 0          # Total records ever added; next slot is next % capacity
+        self.lock = threading.Lock()
+        
+    def add(self, record: TraceRecord):
+        with self.lock:
+            self.slots[self.next % self.capacity] = record
+            self.next += 1
+        
+    def records(self, trace_id: Optional[str] = None) -> List[TraceRecord]:
+        """Records still in the buffer, oldest first (optionally of one trace)"""
+        with self.lock:
+            start = max(0, self.next - self.capacity)
+            held = [self.slots[i % self.capacity] for i in range(start, self.next)]
+        return [r for r in held if trace_id is None or r.trace_id == trace_id]
+        
+    def export_jsonl(self, path: str, trace_id: Optional[str] = None) -> int:
+        """Append the buffered spans to a JSONL file; returns how many"""
+        records = self.records(trace_id)
+        with open(path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record.to_span(), separators=(",", ":")) + "\n")
+        return len(records)
+        
+    def clear(self):
+        with self.lock:
+            self.slots = [None] * self.capacity
+            self.next = 0
+
+TRACES = TraceBuffer()
+
+# ============================================================================
+# SHARED STATE
+# ============================================================================
+
+class CustomerCareState:
+    """Shared memory across all agents"""
+    def __init__(self):
+        self.customer_query = ""
+        self.customer_id = ""
+        self.intent = ""
+        self.sentiment = ""
+        self.priority = ""
+        self.intent_source = ""  # "llm" or the shortcut that classified the query
+        self.intent_confidence = 0.0
+        self.research_findings = []
+        self.customer_info = {}
+        self.proposed_solution = ""
+        self.final_message = ""
+        self.actions_taken = []
+        self.requires_human = False
+        self.escalation_reason = ""
+        self.quality_score = 0
+        self.quality_feedback = ""
+        self.follow_up_needed = False
+        self.escalation_recommended = False
+        self.parse_failures = []  # Agents that gave no valid structured answer
+        self.tool_calls = []      # Tools the agents called, with latency
+        self.agent_errors = {}    # Agent name -> API error that left it without an answer
+        self.usage = {}           # Agent name -> model and tokens used
+        self.routing = {}         # Agent key -> routing decision
+        self.ticket_id = ""
+        self.pending_actions = []  # Outbox tool calls not carried out yet (or held for approval)
+        self.refunds = {}          # Order id -> dollars refunded or held on this ticket
+        self.trace_id = os.urandom(16).hex()   # Spans of this query are kept in TRACES
+        self.span_id = os.urandom(8).hex()     # The query's root span
+        
+    def log(self, agent, action, result, started_ns: Optional[int] = None, status: str = "ok",
+            model: str = "", cache_hit: bool = False):
+        """Trace an agent interaction"""
+        usage = self.usage.get(agent, {})
+        end_ns = time.monotonic_ns()
+        TRACES.add(TraceRecord(
+            "agent", agent, self.trace_id, self.span_id, self.ticket_id,
+            started_ns or end_ns, end_ns, status, model or usage.get("model", ""),
+            usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), cache_hit,
+            f"{action} -> {result or ''}", cached_tokens=usage.get("cached_tokens", 0)
+        ))
+        
+    def reset(self):
+        """Reset for new query"""
+        self.__init__()
+        
+    def to_dict(self) -> Dict:
+        """Plain-data copy of the state (JSON serializable)"""
+        return copy.deepcopy(vars(self))
+        
+    @classmethod
+    def from_dict(cls, data: Dict) -> "CustomerCareState":
+        """Rebuild a state saved with to_dict()"""
+        restored = cls()
+        restored.__dict__.update(copy.deepcopy(data))
+        return restored
+
+# Global state (used when no query is active in the current thread/task)
+state = CustomerCareState()
+
+# Each query runs with its own state; tools and agents look it up here
+_current_state = contextvars.ContextVar("customer_care_state", default=state)
+
+def current_state() -> CustomerCareState:
+    """Get the state of the query running in this thread/task"""
+    return _current_state.get()
+
+# ============================================================================
+# KNOWLEDGE BASE
+# ============================================================================
+
+# Built-in policies, used when no knowledge base path is configured
+DEFAULT_ARTICLES = {
+    "refund": "Refund Policy: Full refunds within 30 days. Process time: 5-7 business days.",
+    "return": "Return Process: Contact support → Receive label → Ship back → Refund processed.",
+    "shipping": "Shipping: Standard (5-7 days) Free, Express (2-3 days) $15, Overnight $30",
+    "tracking": "Tracking available 24-48 hours after order.",
+    "account": "Account: Password reset via email. 2FA in Settings.",
+    "billing": "Billing: Charges appear as 'ACME INC'. Contact billing@acme.com",
+    "password": "Password Reset: Click 'Forgot Password' → Check email for reset link.",
+    "warranty": "Warranty: 1 year on electronics. 2 years premium. Claims: warranty@acme.com",
+    "exchange": "Exchanges: Available within 30 days. Free for size/color changes."
+}
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "from", "has", "have",
+    "i", "if", "in", "into", "is", "it", "its", "me", "my", "of", "on", "or", "our", "so",
+    "that", "the", "their", "this", "to", "was", "we", "were", "will", "with", "you", "your"
+}
+
+def index_terms(text: str) -> List[str]:
+    """Search terms: lowercase words without stop words or plural 's'"""
+    terms = []
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if word in STOP_WORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+class KnowledgeBase:
+    """Policy articles in an inverted index, ranked with BM25
+    
+    Articles can be added, updated or deleted one at a time; only the
+    postings of that article's terms change. A search only touches the
+    postings of the query's terms.
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.articles = {}   # doc_id -> text
+        self.postings = {}   # term -> {doc_id: term frequency}
+        self.lengths = {}    # doc_id -> number of terms
+        self.total_length = 0
+        self.lock = threading.RLock()
+        
+    @classmethod
+    def from_articles(cls, articles: Dict[str, str]) -> "KnowledgeBase":
+        """Build from a {doc_id: text} dict"""
+        kb = cls()
+        for doc_id, text in articles.items():
+            kb.add(doc_id, text)
+        return kb
+        
+    @classmethod
+    def from_path(cls, path: str) -> "KnowledgeBase":
+        """Load a JSONL file of {"id", "text"} records, or a directory of .md/.txt files"""
+        kb = cls()
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                doc_id, ext = os.path.splitext(name)
+                if ext in (".md", ".txt"):
+                    with open(os.path.join(path, name), encoding="utf-8") as f:
+                        kb.add(doc_id, f.read().strip())
+        else:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        kb.add(str(record["id"]), record["text"])
+        return kb
+        
+    def add(self, doc_id: str, text: str):
+        """Add an article, replacing any article with the same id"""
+        # The id is indexed too, so a search for "refund" finds the refund article
+        terms = index_terms(f"{doc_id} {text}")
+        with self.lock:
+            if doc_id in self.articles:
+                self.remove(doc_id)
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                self.postings.setdefault(term, {})[doc_id] = count
+            self.articles[doc_id] = text
+            self.lengths[doc_id] = len(terms)
+            self.total_length += len(terms)
+            
+    update = add
+        
+    def remove(self, doc_id: str):
+        """Delete an article"""
+        with self.lock:
+            text = self.articles.pop(doc_id, None)
+            if text is None:
+                return
+            for term in set(index_terms(f"{doc_id} {text}")):
+                docs = self.postings.get(term)
+                if docs is not None:
+                    docs.pop(doc_id, None)
+                    if not docs:
+                        del self.postings[term]
+            self.total_length -= self.lengths.pop(doc_id)
+        
+    def search(self, query: str, top_k: int = 3) -> List[Tuple[str, float, str]]:
+        """Best matching articles as (doc_id, score, text)
+        
+        Terms are scored rarest first. Once the remaining terms could not
+        lift a new article past the current top_k (MaxScore pruning), only
+        articles that already matched are rescored.
+        """
+        with self.lock:
+            count = len(self.articles)
+            if not count:
+                return []
+            average_length = self.total_length / count
+            
+            weighted = []
+            for term in set(index_terms(query)):
+                docs = self.postings.get(term)
+                if docs:
+                    idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+                    weighted.append((idf, docs))
+            weighted.sort(key=lambda item: item[0], reverse=True)
+            
+            # Most any remaining term can add: idf * (k1 + 1)
+            remaining = sum(idf for idf, _ in weighted) * (self.k1 + 1)
+            scores = {}
+            for idf, docs in weighted:
+                if len(scores) >= top_k and \
+                        heapq.nlargest(top_k, scores.values())[-1] >= remaining:
+                    candidates = ((doc_id, docs[doc_id]) for doc_id in list(scores) if doc_id in docs)
+                else:
+                    candidates = docs.items()
+                for doc_id, tf in candidates:
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / average_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+                remaining -= idf * (self.k1 + 1)
+            
+            best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+            return [(doc_id, round(score, 4), self.articles[doc_id]) for doc_id, score in best]
+        
+    def __len__(self) -> int:
+        return len(self.articles)
+
+_knowledge_base = None
+_knowledge_base_lock = threading.Lock()
+
+def get_knowledge_base() -> KnowledgeBase:
+    """The knowledge base used by search_knowledge_base, loaded once
+    
+    Loads the path in CUSTOMER_CARE_KB_PATH if set, else DEFAULT_ARTICLES.
+    """
+    global _knowledge_base
+    if _knowledge_base is None:
+        with _knowledge_base_lock:
+            if _knowledge_base is None:
+                path = os.getenv("CUSTOMER_CARE_KB_PATH")
+                _knowledge_base = (KnowledgeBase.from_path(path) if path
+                                   else KnowledgeBase.from_articles(DEFAULT_ARTICLES))
+    return _knowledge_base
+
+def set_knowledge_base(kb: KnowledgeBase):
+    """Replace the knowledge base used by search_knowledge_base"""
+    global _knowledge_base
+    _knowledge_base = kb
+
+# ============================================================================
+# CUSTOMER & ORDER DATA
+# ============================================================================
+
+# Demo records loaded into a new CustomerStore
+DEFAULT_CUSTOMERS = [
+    # customer_id, name, email, tier, lifetime_value, notes
+    ("12345", "Jane Smith", "jane@email.com", "Premium", "$2,450", "VIP customer - expedited service"),
+    ("67890", "John Doe", "john@email.com", "Standard", "$340", "First major purchase"),
+    ("11111", "Sarah Johnson", "sarah@email.com", "Gold", "$5,200", "Loyal long-term customer")
+]
+
+DEFAULT_ORDERS = [
+    # order_id, customer_id, amount, status, location, eta, delivered_date
+    ("ORD-789", "12345", 85.0, "Delivered", None, None, "2024-02-10"),
+    ("ORD-321", "67890", 1500.0, None, None, None, None),
+    ("ORD-555", "11111", 220.0, "In Transit", "Chicago, IL", "2024-02-18", None)
+]
+
+UNKNOWN_CUSTOMER = {"name": "Valued Customer", "tier": "Standard", "notes": "New customer"}
+
+# Customer tiers that get the premium model and always get the escalation check
+PREMIUM_TIERS = ("Premium",)
+UNKNOWN_SHIPMENT = {"status": "Not Found", "message": "Check back in 24-48 hours"}
+
+class CustomerStore:
+    """Customers and orders in SQLite, behind a connection pool
+    
+    Records come back as plain dicts. Looked-up customers stay in an LRU
+    cache, and prefetch() fills it for a whole batch with one query.
+    """
+    def __init__(self, path: Optional[str] = None, pool_size: int = 4, max_cached: int = 10_000):
+        if path is None:
+            # A private in-memory database shared by this store's connections
+            path = f"file:customer_store_{id(self)}?mode=memory&cache=shared"
+        self.path = path
+        self.max_cached = max_cached
+        self.cache = OrderedDict()   # customer_id -> record
+        self.lock = threading.Lock()
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            self.pool.put(sqlite3.connect(path, uri=path.startswith("file:"), check_same_thread=False))
+        
+        with self.connection() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS customers (
+                customer_id TEXT PRIMARY KEY, name TEXT, email TEXT, tier TEXT,
+                lifetime_value TEXT, notes TEXT)""")
+            db.execute("""CREATE TABLE IF NOT EXISTS orders (
+                order_id TEXT PRIMARY KEY, customer_id TEXT, amount REAL, status TEXT,
+                location TEXT, eta TEXT, delivered_date TEXT)""")
+            db.execute("CREATE INDEX IF NOT EXISTS orders_customer ON orders (customer_id)")
+            if db.execute("SELECT COUNT(*) FROM customers").fetchone()[0] == 0:
+                db.executemany("INSERT INTO customers VALUES (?, ?, ?, ?, ?, ?)", DEFAULT_CUSTOMERS)
+                db.executemany("INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?)", DEFAULT_ORDERS)
+            db.commit()
+        
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection"""
+        db = self.pool.get()
+        try:
+            yield db
+        finally:
+            self.pool.put(db)
+        
+    def _load(self, customer_ids: List[str]) -> Dict[str, Dict]:
+        """Customers and their orders in one query"""
+        placeholders = ", ".join("?" for _ in customer_ids)
+        with self.connection() as db:
+            rows = db.execute(f"""
+                SELECT c.customer_id, c.name, c.email, c.tier, c.lifetime_value, c.notes,
+                       o.order_id, o.amount
+                FROM customers c LEFT JOIN orders o ON o.customer_id = c.customer_id
+                WHERE c.customer_id IN ({placeholders})
+                ORDER BY c.customer_id, o.rowid""", customer_ids).fetchall()
+        
+        records = {}
+        for customer_id, name, email, tier, lifetime_value, notes, order_id, amount in rows:
+            record = records.get(customer_id)
+            if record is None:
+                record = records[customer_id] = {
+                    "name": name,
+                    "email": email,
+                    "tier": tier,
+                    "lifetime_value": lifetime_value,
+                    "recent_orders": [],
+                    "notes": notes
+                }
+            if order_id:
+                record["recent_orders"].append(f"{order_id}: ${amount:,.0f}")
+        return records
+        
+    def _remember(self, records: Dict[str, Dict]):
+        """Add records to the LRU cache"""
+        with self.lock:
+            for customer_id, record in records.items():
+                self.cache[customer_id] = record
+                self.cache.move_to_end(customer_id)
+            while len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+        
+    def prefetch(self, customer_ids: Iterable[str]):
+        """Load every listed customer (and their orders) with a single query"""
+        with self.lock:
+            missing = sorted({cid for cid in customer_ids if cid and cid not in self.cache})
+        if missing:
+            # Remember unknown ids too, so they don't cost a query later
+            records = {cid: dict(UNKNOWN_CUSTOMER) for cid in missing}
+            records.update(self._load(missing))
+            self._remember(records)
+        
+    def get_customer(self, customer_id: str) -> Dict:
+        """Customer record (a copy), or the new-customer default"""
+        with self.lock:
+            record = self.cache.get(customer_id)
+            if record is not None:
+                self.cache.move_to_end(customer_id)
+        if record is None:
+            self.prefetch([customer_id])
+            with self.lock:
+                record = self.cache.get(customer_id, UNKNOWN_CUSTOMER)
+        return copy.deepcopy(record)
+        
+    def get_tracking(self, order_id: str) -> Dict:
+        """Shipment status of an order"""
+        with self.connection() as db:
+            row = db.execute("SELECT status, location, eta, delivered_date FROM orders WHERE order_id = ?",
+                             (order_id,)).fetchone()
+        if row is None or row[0] is None:
+            return dict(UNKNOWN_SHIPMENT)
+        status, location, eta, delivered_date = row
+        if delivered_date:
+            return {"status": status, "date": delivered_date}
+        return {"status": status, "location": location, "eta": eta}
+        
+    def get_order(self, order_id: str) -> Optional[Dict]:
+        """Owner and amount of an order, or None if there is no such order"""
+        with self.connection() as db:
+            row = db.execute("SELECT customer_id, amount FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        if row is None:
+            return None
+        return {"order_id": order_id, "customer_id": row[0], "amount": row[1]}
+
+_customer_store = None
+_customer_store_lock = threading.Lock()
+
+def get_customer_store() -> CustomerStore:
+    """The store used by lookup_customer and track_shipment"""
+    global _customer_store
+    if _customer_store is None:
+        with _customer_store_lock:
+            if _customer_store is None:
+                _customer_store = CustomerStore(os.getenv("CUSTOMER_CARE_DB_PATH"))
+    return _customer_store
+
+def set_customer_store(store: CustomerStore):
+    """Replace the store used by lookup_customer and track_shipment"""
+    global _customer_store
+    _customer_store = store
+
+# ============================================================================
+# ACTION OUTBOX
+# ============================================================================
+
+class FileSink:
+    """Appends sent actions to a JSONL file (stands in for a downstream service)"""
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        
+    def send(self, actions: List[Dict]):
+        lines = "".join(json.dumps(action, separators=(",", ":")) + "\n" for action in actions)
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+class SmtpSink:
+    """Sends email actions through an SMTP server, one connection per batch
+    
+    Point it at a local debugging server (e.g. python -m aiosmtpd -n -l
+    localhost:1025) to see the emails without sending them. A batch that
+    fails part-way is sent again; the X-Idempotency-Key header lets the
+    receiving side drop the repeats.
+    """
+    def __init__(self, host: str = "localhost", port: int = 1025, sender: str = "support@acme.com"):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        
+    def send(self, actions: List[Dict]):
+        with smtplib.SMTP(self.host, self.port, timeout=10) as smtp:
+            for action in actions:
+                email = action["payload"]
+                message = EmailMessage()
+                message["From"] = self.sender
+                message["To"] = email["recipient"]
+                message["Subject"] = email["subject"]
+                message["Message-ID"] = f"<{action['id']}@acme.com>"
+                message["X-Idempotency-Key"] = action["idempotency_key"]
+                message.set_content(email.get("body") or email["subject"])
+                smtp.send_message(message)
+
+class ActionOutbox:
+    """Side effects (refunds, emails) queued in a SQLite file and sent in the background
+    
+    enqueue() commits the action and returns its id at once, so a slow
+    downstream service adds nothing to ticket latency and a crash loses
+    nothing. A dispatcher thread sends pending actions in batches to the
+    sink registered for their kind; failed batches are retried up to
+    max_attempts times. Each action has an idempotency key (by default
+    from its ticket and arguments), so a retried or resumed ticket
+    queues an action only once.
+    """
+    def __init__(self, path: str = "outbox.sqlite3", sinks: Optional[Dict[str, object]] = None,
+                 batch_size: int = 100, flush_interval: float = 0.05, max_attempts: int = 5,
+                 retry_delay: float = 1.0):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")    # WAL stays consistent; no fsync per commit
+        self.db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+            id TEXT PRIMARY KEY, idempotency_key TEXT NOT NULL UNIQUE, kind TEXT NOT NULL,
+            ticket_id TEXT, payload TEXT NOT NULL, status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0, enqueued_at REAL NOT NULL, sent_at REAL, error TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, enqueued_at)")
+        self.db.commit()
+        self.sinks = sinks if sinks is not None else {"email": FileSink("sent_emails.jsonl"),
+                                                      "refund": FileSink("refunds.jsonl")}
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.counters = {"enqueued": 0, "duplicates": 0, "batches": 0, "send_errors": 0}
+        self.batch_sizes = deque(maxlen=10_000)     # Recent batches
+        self.dispatch_ms = deque(maxlen=10_000)     # Recent enqueue -> sent delays
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.dispatcher = threading.Thread(target=self._dispatch_loop, name="outbox-dispatcher", daemon=True)
+        self.dispatcher.start()
+        
+    @staticmethod
+    def idempotency_key(ticket_id: str, kind: str, fields: Dict) -> str:
+        """Key identifying one action of one ticket"""
+        blob = json.dumps([ticket_id, kind, fields], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:32]
+        
+    def enqueue(self, kind: str, payload: Dict, ticket_id: str = "",
+                idempotency_key: Optional[str] = None, prefix: str = "ACT") -> Tuple[str, bool]:
+        """Store an action for sending; returns (action id, whether it is new)
+        
+        An action whose idempotency key is already queued (or sent) is not
+        queued again; the id of the earlier one is returned.
+        """
+        key = idempotency_key or uuid.uuid4().hex
+        row = (kind, ticket_id, json.dumps(payload, separators=(",", ":")), time.time())
+        with self.lock:
+            while True:
+                action_id = f"{prefix}-{uuid.uuid4().hex[:16].upper()}"
+                inserted = self.db.execute(
+                    "INSERT OR IGNORE INTO outbox (id, idempotency_key, kind, ticket_id, payload, status, "
+                    "enqueued_at) VALUES (?, ?, ?, ?, ?, 'pending', ?)", (action_id, key) + row).rowcount
+                if inserted:
+                    break
+                existing = self.db.execute("SELECT id FROM outbox WHERE idempotency_key = ?", (key,)).fetchone()
+                if existing:
+                    action_id = existing[0]
+                    break
+                # Otherwise the random id was taken; draw another
+            self.db.commit()
+            self.counters["enqueued" if inserted else "duplicates"] += 1
+        if inserted:
+            self.wakeup.set()
+        return action_id, bool(inserted)
+        
+    def _dispatch_loop(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            while True:
+                dispatched, failed = self._dispatch_batch()
+                if failed:
+                    self.stopped.wait(self.retry_delay)
+                    break
+                if dispatched < self.batch_size:
+                    break
+        
+    def _dispatch_batch(self) -> Tuple[int, bool]:
+        """Send the oldest pending actions; returns (how many, whether a sink failed)"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, idempotency_key, kind, ticket_id, payload, enqueued_at FROM outbox "
+                "WHERE status = 'pending' ORDER BY enqueued_at LIMIT ?", (self.batch_size,)).fetchall()
+        by_kind = {}
+        for action_id, key, kind, ticket_id, payload, enqueued_at in rows:
+            by_kind.setdefault(kind, []).append({"id": action_id, "idempotency_key": key, "kind": kind,
+                                                 "ticket_id": ticket_id, "payload": json.loads(payload),
+                                                 "enqueued_at": enqueued_at})
+        failed = False
+        for kind, actions in by_kind.items():
+            ids = [(action["id"],) for action in actions]
+            try:
+                sink = self.sinks.get(kind)
+                if sink is None:
+                    raise KeyError(f"No sink for {kind} actions")
+                sink.send(actions)
+            except Exception as e:
+                failed = True
+                with self.lock:
+                    self.db.executemany(
+                        "UPDATE outbox SET attempts = attempts + 1, error = ?, status = CASE "
+                        "WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END WHERE id = ?",
+                        [(f"{type(e).__name__}: {e}", self.max_attempts, action_id) for (action_id,) in ids])
+                    self.db.commit()
+                    self.counters["send_errors"] += 1
+                continue
+            sent_at = time.time()
+            with self.lock:
+                self.db.executemany("UPDATE outbox SET status = 'sent', sent_at = ?, attempts = attempts + 1 "
+                                    "WHERE id = ?", [(sent_at, action_id) for (action_id,) in ids])
+                self.db.commit()
+                self.counters["batches"] += 1
+                self.batch_sizes.append(len(actions))
+                self.dispatch_ms.extend((sent_at - action["enqueued_at"]) * 1000 for action in actions)
+        return len(rows), failed
+        
+    def depth(self) -> int:
+        """Actions waiting to be sent"""
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+        
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until every pending action is sent; False if the timeout ran out first"""
+        deadline = time.monotonic() + timeout
+        while self.depth():
+            if time.monotonic() >= deadline:
+                return False
+            self.wakeup.set()
+            time.sleep(0.005)
+        return True
+        
+    def failed(self, limit: int = 50) -> List[Dict]:
+        """Actions that gave up after max_attempts, newest first"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, kind, ticket_id, payload, attempts, error FROM outbox WHERE status = 'failed' "
+                "ORDER BY enqueued_at DESC LIMIT ?", (limit,)).fetchall()
+        return [{"id": action_id, "kind": kind, "ticket_id": ticket_id, "payload": json.loads(payload),
+                 "attempts": attempts, "error": error}
+                for action_id, kind, ticket_id, payload, attempts, error in rows]
+        
+    def stats(self) -> Dict:
+        """Outbox depth, batch sizes and enqueue-to-sent latency"""
+        with self.lock:
+            statuses = dict(self.db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+            report = dict(self.counters)
+            sizes = list(self.batch_sizes)
+            delays = list(self.dispatch_ms)
+        report.update({
+            "depth": statuses.get("pending", 0),
+            "sent": statuses.get("sent", 0),
+            "failed": statuses.get("failed", 0),
+            "mean_batch": round(sum(sizes) / len(sizes), 1) if sizes else 0.0,
+            "max_batch": max(sizes, default=0),
+            "dispatch_p50_ms": round(percentile(delays, 50), 2),
+            "dispatch_p99_ms": round(percentile(delays, 99), 2)
+        })
+        return report
+        
+    def close(self, timeout: float = 5.0):
+        """Send what is pending (up to timeout), then stop the dispatcher"""
+        self.flush(timeout)
+        self.stopped.set()
+        self.wakeup.set()
+        self.dispatcher.join()
+        with self.lock:
+            self.db.close()
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_outbox() -> ActionOutbox:
+    """The outbox used by issue_refund and deliver_email, opened when first needed
+    
+    Stored at CUSTOMER_CARE_OUTBOX_PATH if set, else outbox.sqlite3.
+    """
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = ActionOutbox(os.getenv("CUSTOMER_CARE_OUTBOX_PATH", "outbox.sqlite3"))
+    return _outbox
+
+def set_outbox(outbox: ActionOutbox):
+    """Replace the outbox used by issue_refund and deliver_email"""
+    global _outbox
+    _outbox = outbox
+
+# ============================================================================
+# SIMULATED TOOLS (Same as before)
+# ============================================================================
+
+def search_knowledge_base(query: str, top_k: int = 3) -> str:
+    """Search company policies"""
+    results = [f"{doc_id.upper()}: {text}" for doc_id, score, text in get_knowledge_base().search(query, top_k)]
+    return "\n".join(results) if results else "No specific policy found. Contact: support@acme.com"
+
+# Refunds per ticket above this total wait for a human
+REFUND_APPROVAL_LIMIT = 100.0
+
+def lookup_customer(customer_id: str) -> Dict:
+    """Look up customer information (only the customer the ticket is about)"""
+    state = current_state()
+    if customer_id != state.customer_id or state.customer_id in ("", "Unknown"):
+        raise PermissionError("Only the customer on this ticket can be looked up")
+    return get_customer_store().get_customer(customer_id)
+
+def customer_order(order_id: str) -> Dict:
+    """An order of the customer on this ticket; PermissionError for anyone else's"""
+    order = get_customer_store().get_order(order_id)
+    if order is None or order["customer_id"] != current_state().customer_id:
+        raise PermissionError(f"{order_id} is not an order of this customer")
+    return order
+
+def process_refund(order_id: str, amount: float, reason: str) -> str:
+    """Process refund (checks for human approval)"""
+    state = current_state()
+    order = customer_order(order_id)
+    if amount <= 0:
+        raise ValueError("Refund amount must be positive")
+    action = {"tool": "process_refund", "arguments": {"order_id": order_id, "amount": amount, "reason": reason}}
+    if action in state.pending_actions:
+        return f"✓ Refund of ${amount} for {order_id} already requested"
+    refunded = state.refunds.get(order_id, 0.0)
+    if refunded + amount > order["amount"]:
+        raise ValueError(f"Refunds for {order_id} would exceed its total of ${order['amount']}")
+    # The limit is on the ticket's total, so splitting a refund does not avoid it
+    held = sum(state.refunds.values()) + amount > REFUND_APPROVAL_LIMIT
+    state.refunds[order_id] = refunded + amount
+    # Carried out by issue_refund() when the Resolver is done, or once a human approves the ticket
+    state.pending_actions.append(action)
+    if held:
+        state.requires_human = True
+        state.escalation_reason = f"Refunds over ${REFUND_APPROVAL_LIMIT:.0f} require approval: " \
+                                  f"${amount} for {order_id}"
+        return f"⚠️ ESCALATED: ${amount} refund requires human approval. Reason: {reason}"
+    return f"✓ Refund of ${amount} for {order_id} accepted. It is submitted when the resolution is complete."
+
+def issue_refund(order_id: str, amount: float, reason: str) -> str:
+    """Submit a refund held by process_refund (already checked and counted)"""
+    state = current_state()
+    outbox = get_outbox()
+    # One refund per order and amount per ticket, however often the agent asks
+    key = outbox.idempotency_key(state.ticket_id, "refund", {"order_id": order_id, "amount": amount}) \
+        if state.ticket_id else None
+    ref, new = outbox.enqueue("refund", {"order_id": order_id, "amount": amount, "reason": reason,
+                                         "customer_id": state.customer_id},
+                              state.ticket_id, key, prefix="REF")
+    if not new:
+        return f"✓ Refund already submitted: ${amount} for {order_id}. Reference: {ref}."
+    result = f"✓ Refund submitted: ${amount} for {order_id}. Reference: {ref}. ETA: 5-7 days."
+    state.actions_taken.append(result)
+    return result
+
+def send_email(subject: str) -> str:
+    """Send email to customer (held like refunds, so a rejected ticket sends nothing)"""
+    state = current_state()
+    # Always the address on file; the model never picks the recipient
+    recipient = get_customer_store().get_customer(state.customer_id).get("email")
+    if not recipient:
+        raise PermissionError("The customer on this ticket has no email address on file")
+    action = {"tool": "send_email", "arguments": {"recipient": recipient, "subject": subject}}
+    if action not in state.pending_actions:
+        # Carried out by deliver_email() when the Resolver is done, or once a human approves the ticket
+        state.pending_actions.append(action)
+    return f"✓ Email to {recipient} accepted. Subject: {subject}. It is sent when the resolution is complete."
+
+def deliver_email(recipient: str, subject: str) -> str:
+    """Queue an email held by send_email in the outbox"""
+    state = current_state()
+    outbox = get_outbox()
+    key = outbox.idempotency_key(state.ticket_id, "email", {"recipient": recipient, "subject": subject}) \
+        if state.ticket_id else None
+    email_id, new = outbox.enqueue("email", {"recipient": recipient, "subject": subject,
+                                             "customer_id": state.customer_id},
+                                   state.ticket_id, key, prefix="EMAIL")
+    if not new:
+        return f"✓ Email already queued for {recipient}. ID: {email_id}"
+    result = f"✓ Email queued for {recipient}. Subject: {subject}. ID: {email_id}"
+    state.actions_taken.append(result)
+    return result
+
+def track_shipment(order_id: str) -> Dict:
+    """Track package (only the orders of the customer on this ticket)"""
+    customer_order(order_id)
+    return get_customer_store().get_tracking(order_id)
+
+# ============================================================================
+# TOOL REGISTRY
+# ============================================================================
+
+class ToolRegistry:
+    """Tools the agents can call, with their JSON schemas
+    
+    When the model asks for several tools in one turn they run
+    concurrently on a shared thread pool. Latency is recorded per tool.
+    """
+    def __init__(self, max_workers: int = 8):
+        self.tools = {}   # name -> (function, OpenAI tool schema)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self.stats = {}   # name -> {"calls", "errors", "total_ms", "max_ms"}
+        self.lock = threading.Lock()
+        
+    def register(self, function, description: str, parameters: Dict):
+        """Make a function available as a tool"""
+        self.tools[function.__name__] = (function, {
+            "type": "function",
+            "function": {
+                "name": function.__name__,
+                "description": description,
+                "parameters": {"type": "object", "properties": parameters,
+                               "required": list(parameters)}
+            }
+        })
+        self.stats[function.__name__] = {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+        
+    def schemas(self, names: Iterable[str]) -> List[Dict]:
+        """OpenAI tool definitions for the named tools"""
+        return [self.tools[name][1] for name in names]
+        
+    def _call(self, agent: str, name: str, arguments: str) -> str:
+        """Run one tool call and return its result as text"""
+        started = time.perf_counter()
+        started_ns = time.monotonic_ns()
+        failed = False
+        try:
+            function = self.tools[name][0]
+            result = function(**json.loads(arguments or "{}"))
+            output = result if isinstance(result, str) else json.dumps(result, separators=(",", ":"))
+        except Exception as e:
+            failed = True
+            output = f"Error: {type(e).__name__}: {e}"
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        state = current_state()
+        TRACES.add(TraceRecord("tool", name, state.trace_id, state.span_id, state.ticket_id,
+                               started_ns, time.monotonic_ns(), "error" if failed else "ok",
+                               detail=arguments or ""))
+        
+        with self.lock:
+            stats = self.stats.setdefault(name, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["calls"] += 1
+            stats["errors"] += failed
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        state.tool_calls.append({
+            "agent": agent, "tool": name, "arguments": arguments,
+            "ms": round(elapsed_ms, 3), "ok": not failed
+        })
+        return output
+        
+    def _submit(self, agent: str, tool_calls) -> List[Future]:
+        return [
+            # Each call runs with the query's state
+            self.pool.submit(contextvars.copy_context().run, self._call,
+                             agent, call.function.name, call.function.arguments)
+            for call in tool_calls
+        ]
+        
+    def execute(self, agent: str, tool_calls) -> List[Dict]:
+        """Run a turn's tool calls concurrently; returns the tool messages"""
+        futures = self._submit(agent, tool_calls)
+        return [
+            {"role": "tool", "tool_call_id": call.id, "content": future.result()}
+            for call, future in zip(tool_calls, futures)
+        ]
+        
+    async def aexecute(self, agent: str, tool_calls) -> List[Dict]:
+        """execute() without blocking the event loop"""
+        outputs = await asyncio.gather(*(asyncio.wrap_future(future)
+                                         for future in self._submit(agent, tool_calls)))
+        return [
+            {"role": "tool", "tool_call_id": call.id, "content": output}
+            for call, output in zip(tool_calls, outputs)
+        ]
+        
+    def report(self) -> Dict:
+        """Calls, errors and latency per tool"""
+        with self.lock:
+            return {
+                name: {
+                    "calls": stats["calls"],
+                    "errors": stats["errors"],
+                    "mean_ms": round(stats["total_ms"] / stats["calls"], 3) if stats["calls"] else 0.0,
+                    "max_ms": round(stats["max_ms"], 3)
+                }
+                for name, stats in self.stats.items()
+            }
+
+TOOLS = ToolRegistry()
+TOOLS.register(search_knowledge_base, "Search company policies (refunds, returns, shipping, "
+               "tracking, account, billing, warranty, exchanges).",
+               {"query": {"type": "string", "description": "What to look up"}})
+TOOLS.register(lookup_customer, "Look up the profile, tier and recent orders of the customer on this ticket.",
+               {"customer_id": {"type": "string"}})
+TOOLS.register(track_shipment, "Get the shipping status of one of this customer's orders.",
+               {"order_id": {"type": "string", "description": "Order id such as ORD-555"}})
+TOOLS.register(process_refund, "Refund one of this customer's orders. Refunds totalling over $100 per "
+               "ticket are held for human approval.",
+               {"order_id": {"type": "string"},
+                "amount": {"type": "number", "minimum": 0.01,
+                           "description": "Refund amount in dollars, at most the order total"},
+                "reason": {"type": "string"}})
+TOOLS.register(send_email, "Send an email to the customer on this ticket, at the address on file.",
+               {"subject": {"type": "string"}})
+
+# ============================================================================
+# STRUCTURED OUTPUTS
+# ============================================================================
+
+INTENTS = ("REFUND", "RETURN", "SHIPPING", "TRACKING", "ACCOUNT", "BILLING", "OTHER")
+SENTIMENTS = ("POSITIVE", "NEUTRAL", "NEGATIVE", "URGENT")
+PRIORITIES = ("LOW", "MEDIUM", "HIGH", "CRITICAL")
+
+@dataclass
+class GreeterOutput:
+    greeting: str
+    intent: str = dataclasses.field(metadata={"choices": INTENTS})
+    sentiment: str = dataclasses.field(metadata={"choices": SENTIMENTS})
+    priority: str = dataclasses.field(metadata={"choices": PRIORITIES})
+    summary: str
+    confidence: float = dataclasses.field(metadata={"range": (0.0, 1.0)})  # In the intent
+    
+    def to_text(self) -> str:
+        return (f"GREETING: {self.greeting}\nINTENT: {self.intent}\nSENTIMENT: {self.sentiment}\n"
+                f"PRIORITY: {self.priority}\nSUMMARY: {self.summary}")
+
+@dataclass
+class QualityOutput:
+    verdict: str = dataclasses.field(metadata={"choices": ("APPROVED", "NEEDS_REVISION")})
+    score: int = dataclasses.field(metadata={"range": (1, 10)})
+    feedback: str
+    
+    def to_text(self) -> str:
+        return f"{self.verdict} ({self.score}/10): {self.feedback}"
+
+@dataclass
+class EscalationOutput:
+    escalate: bool
+    reason: str
+    
+    def to_text(self) -> str:
+        return f"{'ESCALATE' if self.escalate else 'NO_ESCALATION'}: {self.reason}"
+
+@dataclass
+class FollowUpOutput:
+    follow_up: bool
+    timing: str
+    
+    def to_text(self) -> str:
+        return f"{'FOLLOW_UP' if self.follow_up else 'NO_FOLLOW_UP'}: {self.timing}"
+
+def schema_prompt(schema) -> str:
+    """Output instructions for a structured agent"""
+    keys = {}
+    for f in dataclasses.fields(schema):
+        if "choices" in f.metadata:
+            keys[f.name] = " | ".join(f.metadata["choices"])
+        elif "range" in f.metadata:
+            kind = "number" if f.type in (float, "float") else "integer"
+            keys[f.name] = "{} {} to {}".format(kind, *f.metadata["range"])
+        else:
+            keys[f.name] = "true or false" if f.type in (bool, "bool") else "text"
+    return "Respond with only a JSON object with exactly these keys: " + json.dumps(keys)
+
+def parse_structured(schema, content: str):
+    """Validate an agent's JSON answer into the schema's dataclass
+    
+    Raises ValueError describing the first problem found.
+    """
+    text = (content or "").strip()
+    if text.startswith("```"):
+        text = text.strip("`").removeprefix("json").strip()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"not valid JSON ({e.msg})")
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    
+    values = {}
+    for f in dataclasses.fields(schema):
+        if f.name not in data:
+            raise ValueError(f"missing key '{f.name}'")
+        value = data[f.name]
+        if f.type in (bool, "bool"):
+            if isinstance(value, str) and value.strip().lower() in ("true", "yes", "false", "no"):
+                value = value.strip().lower() in ("true", "yes")
+            if not isinstance(value, bool):
+                raise ValueError(f"'{f.name}' must be true or false")
+        elif f.type in (int, "int", float, "float"):
+            number = float if f.type in (float, "float") else int
+            try:
+                value = number(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"'{f.name}' must be {'a number' if number is float else 'an integer'}")
+            low, high = f.metadata.get("range", (value, value))
+            if not low <= value <= high:
+                raise ValueError(f"'{f.name}' must be between {low} and {high}")
+        else:
+            value = str(value).strip()
+            choices = f.metadata.get("choices")
+            if choices:
+                value = value.upper()
+                if value not in choices:
+                    raise ValueError(f"'{f.name}' must be one of {', '.join(choices)}")
+        values[f.name] = value
+    return schema(**values)
+
+def answer_text(answer) -> str:
+    """An agent's answer as text, for context and console output"""
+    if answer is None:
+        return "(no valid answer)"
+    return answer.to_text() if hasattr(answer, "to_text") else answer
+
+# Models that accept response_format={"type": "json_object"}
+JSON_MODE_MODELS = ("gpt-4o", "gpt-4-turbo", "gpt-4-1106", "gpt-4-0125", "gpt-4.1",
+                    "gpt-3.5-turbo-1106", "gpt-3.5-turbo-0125")
+
+# ============================================================================
+# RESILIENT LLM CALLS
+# ============================================================================
+
+class CircuitOpenError(RuntimeError):
+    """The API has been failing; calls are refused until the breaker resets"""
+
+def parse_duration(text: str) -> float:
+    """Seconds in a rate-limit header value such as 1s, 6m0s or 20ms"""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    matches = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", text or "")
+    if not matches:
+        try:
+            return float(text)
+        except (TypeError, ValueError):
+            return 0.0
+    return sum(float(amount) * units[unit] for amount, unit in matches)
+
+class RateLimiter:
+    """Token buckets for requests and tokens per minute, shared by all queries
+    
+    Callers reserve capacity before each call and wait out any shortfall.
+    The limits start at the configured guesses and follow the
+    x-ratelimit-* headers the API sends back.
+    """
+    def __init__(self, requests_per_minute: float = 500, tokens_per_minute: float = 30_000):
+        self.limits = {"requests": float(requests_per_minute), "tokens": float(tokens_per_minute)}
+        self.levels = dict(self.limits)   # Capacity left in each bucket
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        self.updated = now
+        for bucket, limit in self.limits.items():
+            self.levels[bucket] = min(limit, self.levels[bucket] + elapsed * limit / 60)
+        
+    def reserve(self, tokens: int) -> float:
+        """Take capacity for one call; returns the seconds to wait before making it"""
+        with self.lock:
+            self._refill(time.monotonic())
+            # A single call larger than the bucket would otherwise wait forever
+            tokens = min(tokens, self.limits["tokens"])
+            self.levels["requests"] -= 1
+            self.levels["tokens"] -= tokens
+            return max(max(0.0, -self.levels[bucket]) * 60 / self.limits[bucket]
+                       for bucket in self.limits)
+        
+    def settle(self, reserved: int, used: int):
+        """Give back (or take) the difference between estimated and actual tokens"""
+        with self.lock:
+            self.levels["tokens"] = min(self.limits["tokens"], self.levels["tokens"] + reserved - used)
+        
+    def update(self, headers):
+        """Adapt to the limits and remaining capacity reported by the API"""
+        if not headers:
+            return
+        with self.lock:
+            self._refill(time.monotonic())
+            for bucket in self.limits:
+                limit = headers.get(f"x-ratelimit-limit-{bucket}")
+                remaining = headers.get(f"x-ratelimit-remaining-{bucket}")
+                try:
+                    if limit is not None:
+                        self.limits[bucket] = max(1.0, float(limit))
+                    if remaining is not None:
+                        self.levels[bucket] = min(self.levels[bucket], float(remaining))
+                except ValueError:
+                    continue
+
+class CircuitBreaker:
+    """Stops calling the API after repeated failures, then probes it again
+    
+    After failure_threshold consecutive failures the breaker opens and
+    calls fail fast for reset_timeout seconds. Then one trial call is let
+    through: success closes the breaker, failure opens it again. A trial
+    that ends any other way (rate limited, rejected request, cancelled)
+    is released so the next call can try.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.opened = 0   # Times the breaker has opened
+        self.lock = threading.Lock()
+        
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+        
+    def allow(self) -> bool:
+        """Raise CircuitOpenError unless a call may go through now; True if it is the trial call"""
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return False
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            raise CircuitOpenError(f"LLM API circuit open after {self.failures} consecutive failures")
+        
+    def record(self, success: bool):
+        with self.lock:
+            self.trial_running = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    self.opened += 1
+                self.opened_at = time.monotonic()
+        
+    def release(self):
+        """End the trial call without a verdict on the API's health"""
+        with self.lock:
+            self.trial_running = False
+
+class ResilientClient:
+    """Timeouts, retries, rate limiting and circuit breaking for LLM calls
+    
+    One instance is shared by every agent (blocking and async), so the
+    rate limiter sees the whole system's traffic. Failed calls are retried
+    with jittered exponential backoff when the error is transient
+    (timeouts, connection errors, 429 and 5xx responses).
+    """
+    def __init__(self, timeout: float = 30.0, max_retries: int = 4,
+                 backoff_base: float = 0.5, backoff_max: float = 20.0,
+                 limiter: Optional[RateLimiter] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limiter = limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.stats = {"attempts": 0, "retries": 0, "failures": 0, "rate_limited": 0,
+                      "timeouts": 0, "circuit_rejections": 0, "throttle_wait_s": 0.0}
+        self.lock = threading.Lock()
+        
+    def _count(self, counter: str, amount=1):
+        with self.lock:
+            self.stats[counter] += amount
+        
+    @staticmethod
+    def _estimate_tokens(request: Dict) -> int:
+        prompt = sum(count_tokens(message.get("content") or "") for message in request["messages"])
+        return prompt + request.get("max_tokens", 0)
+        
+    @staticmethod
+    def _retryable(error: Exception) -> bool:
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError,
+                              httpx.TimeoutException, httpx.TransportError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in (408, 409, 429) or error.status_code >= 500
+        return False
+        
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Full-jitter backoff, but never sooner than the server's retry-after"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = parse_duration(response.headers.get("retry-after", ""))
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+        
+    def _before(self, request: Dict) -> Tuple[Dict, int, float, bool]:
+        """Breaker check and rate-limit reservation; returns (request, tokens, wait, is trial call)"""
+        try:
+            trial = self.breaker.allow()
+        except CircuitOpenError:
+            self._count("circuit_rejections")
+            raise
+        tokens = self._estimate_tokens(request)
+        wait_s = self.limiter.reserve(tokens)
+        self._count("attempts")
+        if wait_s:
+            self._count("throttle_wait_s", wait_s)
+        return dict(request, timeout=self.timeout), tokens, wait_s, trial
+        
+    def _parse(self, raw):
+        """Learn from the response headers; returns the parsed response (or stream)"""
+        if hasattr(raw, "parse"):
+            self.limiter.update(raw.headers)
+            return raw.parse()
+        return raw
+        
+    def _after(self, request: Dict, response, tokens: int):
+        """Settle the reserved tokens with those used and record a healthy call"""
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            used = usage.total_tokens
+        else:
+            # A stream without a usage chunk: the prompt estimate plus the tokens received
+            message = response.choices[0].message if response.choices else None
+            used = tokens - request.get("max_tokens", 0) + count_tokens(getattr(message, "content", None) or "")
+        self.limiter.settle(tokens, used)
+        self.breaker.record(True)
+        return response
+        
+    def _failed(self, error: Exception, attempt: int, retry: bool = True) -> float:
+        """Record a failed attempt; returns the backoff, or raises if not retrying"""
+        response = getattr(error, "response", None)
+        if response is not None:
+            self.limiter.update(response.headers)
+        if isinstance(error, openai.RateLimitError):
+            # The limiter handles 429s; they say nothing about the API's health
+            self._count("rate_limited")
+        elif self._retryable(error):
+            # Not a rejected request (400, 404...): those are our fault, not an outage
+            self.breaker.record(False)
+        if isinstance(error, (openai.APITimeoutError, httpx.TimeoutException)):
+            self._count("timeouts")
+        if not retry or not self._retryable(error) or attempt >= self.max_retries:
+            self._count("failures")
+            raise error
+        self._count("retries")
+        return self._backoff(attempt, error)
+        
+    def call(self, completions, on_token: Optional[Callable[[str], None]] = None, **request):
+        """Blocking chat.completions.create with the policy applied
+        
+        A streamed response is read to the end here, passing each delta to
+        on_token, so the call is settled and judged only once it is
+        complete. A stream that fails after passing text on is not retried.
+        """
+        attempt = 0
+        while True:
+            request_kwargs, tokens, wait_s, trial = self._before(request)
+            create = getattr(completions, "with_raw_response", completions).create
+            received = []
+            try:
+                time.sleep(wait_s)
+                response = self._parse(create(**request_kwargs))
+                if request.get("stream"):
+                    response = _collect_stream(response, on_token, received)
+                return self._after(request, response, tokens)
+            except Exception as e:
+                delay = self._failed(e, attempt, retry=not received)
+            finally:
+                if trial:
+                    self.breaker.release()
+            time.sleep(delay)
+            attempt += 1
+        
+    async def acall(self, completions, on_token: Optional[Callable[[str], None]] = None, **request):
+        """Async chat.completions.create with the policy applied (streams as in call())"""
+        attempt = 0
+        while True:
+            request_kwargs, tokens, wait_s, trial = self._before(request)
+            create = getattr(completions, "with_raw_response", completions).create
+            received = []
+            try:
+                await asyncio.sleep(wait_s)
+                response = self._parse(await create(**request_kwargs))
+                if request.get("stream"):
+                    response = await _collect_stream_async(response, on_token, received)
+                return self._after(request, response, tokens)
+            except Exception as e:
+                delay = self._failed(e, attempt, retry=not received)
+            finally:
+                # Also when the call is cancelled (CancelledError is not an Exception)
+                if trial:
+                    self.breaker.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+        
+    def report(self) -> Dict:
+        """Call counters plus the limiter and breaker state"""
+        with self.lock:
+            report = dict(self.stats)
+        report["throttle_wait_s"] = round(report["throttle_wait_s"], 3)
+        report["circuit"] = self.breaker.state
+        report["circuit_opened"] = self.breaker.opened
+        report["limits_per_minute"] = dict(self.limiter.limits)
+        return report
+
+# ============================================================================
+# PROMPT TEMPLATES
+# ============================================================================
+
+def cached_tokens(usage) -> int:
+    """Prompt tokens the API served from its prompt cache"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):   # SDKs that predate the field keep it as a dict
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", None) or 0
+
+class PromptTemplate:
+    """An agent's prompt, laid out so its prefix can be cached by the API
+    
+    The system message (role, goal, instructions and output format) is
+    built once and is byte-identical on every query. Prompt caching
+    matches prompts from their first token, so everything that changes
+    per query (the context, then the task) comes after it.
+    """
+    def __init__(self, role: str, goal: str, instructions: str, output_format: str):
+        self.system_prompt = f"""You are {role}.
+
+Your goal: {goal}
+
+Instructions: {instructions}
+
+Be concise but thorough. {output_format}"""
+        self.system_message = {"role": "system", "content": self.system_prompt}
+        
+    @classmethod
+    def for_agent(cls, agent: "SimpleAgent") -> "PromptTemplate":
+        output_format = schema_prompt(agent.schema) if agent.schema else "Format your response clearly."
+        return cls(agent.role, agent.goal, agent.instructions, output_format)
+        
+    def render(self, task: str, context: str) -> List[Dict]:
+        """The chat messages for one task"""
+        return [
+            self.system_message,
+            {"role": "user", "content": f"Context from previous agents:\n{context}"},
+            {"role": "user", "content": task}
+        ]
+
+class PromptRegistry:
+    """The compiled prompt template of each agent, by agent name"""
+    def __init__(self):
+        self.templates = {}
+        
+    def compile(self, agent: "SimpleAgent") -> PromptTemplate:
+        """Build (or reuse) the agent's template and attach it to the agent"""
+        template = self.templates.get(agent.name)
+        if template is None:
+            template = self.templates[agent.name] = PromptTemplate.for_agent(agent)
+        agent.prompt = template
+        return template
+        
+    def __getitem__(self, name: str) -> PromptTemplate:
+        return self.templates[name]
+
+# ============================================================================
+# AI AGENTS (Using OpenAI API Directly)
+# ============================================================================
+
+def _streamed_response(parts: List[str], usage):
+    """A completion-shaped response assembled from streamed chunks"""
+    message = SimpleNamespace(content="".join(parts), tool_calls=None)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")],
+                           usage=usage)
+
+def _collect_stream(stream, on_token: Callable[[str], None], parts: Optional[List[str]] = None):
+    """Read a streamed completion, passing each text delta to on_token
+    
+    Deltas are appended to parts (if given), so the caller can tell how
+    far a stream that failed had got.
+    """
+    parts = [] if parts is None else parts
+    usage = None
+    for chunk in stream:
+        usage = getattr(chunk, "usage", None) or usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            on_token(parts[-1])
+    return _streamed_response(parts, usage)
+
+async def _collect_stream_async(stream, on_token: Callable[[str], None], parts: Optional[List[str]] = None):
+    """Read a streamed completion without blocking the event loop"""
+    parts = [] if parts is None else parts
+    usage = None
+    async for chunk in stream:
+        usage = getattr(chunk, "usage", None) or usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            on_token(parts[-1])
+    return _streamed_response(parts, usage)
+
+def _create_direct(create, on_token: Optional[Callable[[str], None]] = None, **request):
+    """One API call without a ResilientClient; a streamed response is read to the end"""
+    response = create(**request)
+    return _collect_stream(response, on_token) if request.get("stream") else response
+
+async def _acreate_direct(create, on_token: Optional[Callable[[str], None]] = None, **request):
+    response = await create(**request)
+    return await _collect_stream_async(response, on_token) if request.get("stream") else response
+
+class ToolRound:
+    """A step asking the driver to run the tool calls of one model turn"""
+    __slots__ = ("agent", "tool_calls")
+    
+    def __init__(self, agent: str, tool_calls):
+        self.agent = agent
+        self.tool_calls = tool_calls
+
+def _drive(steps, create, on_token: Optional[Callable[[str], None]] = None):
+    """Run an agent's steps, making each requested API call with create()"""
+    try:
+        request = next(steps)
+        while True:
+            if isinstance(request, ToolRound):
+                request = steps.send(TOOLS.execute(request.agent, request.tool_calls))
+                continue
+            try:
+                response = create(on_token=on_token, **request)
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(response)
+    except StopIteration as done:
+        return done.value
+
+async def _drive_async(steps, create, on_token: Optional[Callable[[str], None]] = None):
+    """Run an agent's steps, awaiting each requested API call and tool round"""
+    try:
+        request = next(steps)
+        while True:
+            if isinstance(request, ToolRound):
+                request = steps.send(await TOOLS.aexecute(request.agent, request.tool_calls))
+                continue
+            try:
+                response = await create(on_token=on_token, **request)
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(response)
+    except StopIteration as done:
+        return done.value
+
+class SimpleAgent:
+    """Simple AI agent using OpenAI
+    
+    With an output schema, the agent answers in JSON that is validated
+    into the schema's dataclass. Invalid answers get up to max_reasks
+    short follow-up requests; after that run() returns None.
+    
+    With tools, the model may call them for up to max_tool_rounds turns
+    before giving its answer.
+    
+    Given an on_token callback, a plain-text agent streams its answer and
+    passes each text delta to the callback as it arrives.
+    """
+    
+    def __init__(self, client: OpenAI, name: str, role: str, goal: str, instructions: str,
+                 cache: Optional["ResponseCache"] = None, cacheable: bool = True,
+                 schema=None, max_reasks: int = 1, tools: Tuple[str, ...] = (),
+                 max_tool_rounds: int = 3):
+        self.client = client
+        self.name = name
+        self.role = role
+        self.goal = goal
+        self.instructions = instructions
+        self.model = "gpt-4"
+        self.temperature = 0.7
+        self.max_tokens = 500
+        self.cache = cache
+        self.cacheable = cacheable  # False for agents whose answer must stay fresh
+        self.schema = schema
+        self.max_reasks = max_reasks
+        self.tools = tools  # Names of TOOLS entries the model may call
+        self.max_tool_rounds = max_tool_rounds
+        self.resilience = None  # Shared ResilientClient, set by CustomerCareSystem
+        self.prompt = None      # PromptTemplate, compiled by CustomerCareSystem or on first use
+        self.parse_stats = {"calls": 0, "parse_failures": 0, "reasks": 0, "gave_up": 0}
+        self.token_stats = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0}
+        self.stats_lock = threading.Lock()
+        
+    def _messages(self, task: str, context: str) -> List[Dict]:
+        """Build the chat messages for a task"""
+        if self.prompt is None:
+            self.prompt = PromptTemplate.for_agent(self)
+        return self.prompt.render(task, context)
+        
+    def _settings(self, route: Optional["ModelRoute"]) -> Dict:
+        """Model, temperature and max_tokens: the routed ones or the agent's own"""
+        if route is None:
+            return {"model": self.model, "temperature": self.temperature, "max_tokens": self.max_tokens}
+        return {"model": route.model, "temperature": route.temperature, "max_tokens": route.max_tokens}
+        
+    def _cache_key(self, messages: List[Dict], settings: Dict) -> Optional[str]:
+        """Cache key for this call, or None when caching is off"""
+        if self.cache is None or not self.cacheable:
+            return None
+        return self.cache.key(messages, settings["model"], settings["temperature"], settings["max_tokens"])
+        
+    def _request(self, messages: List[Dict], settings: Dict, **overrides) -> Dict:
+        """Arguments for chat.completions.create"""
+        request = dict(settings, messages=messages)
+        if self.schema and request["model"].startswith(JSON_MODE_MODELS):
+            request["response_format"] = {"type": "json_object"}
+        if self.tools:
+            request["tools"] = TOOLS.schemas(self.tools)
+        request.update(overrides)
+        return request
+        
+    def _record_usage(self, response, model: str):
+        """Add a response's token usage to the query's per-agent totals"""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        cached = cached_tokens(usage)
+        totals = current_state().usage.setdefault(
+            self.name, {"model": model, "calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                        "cached_tokens": 0})
+        totals["calls"] += 1
+        totals["prompt_tokens"] += usage.prompt_tokens or 0
+        totals["completion_tokens"] += usage.completion_tokens or 0
+        totals["cached_tokens"] += cached
+        with self.stats_lock:
+            self.token_stats["calls"] += 1
+            self.token_stats["prompt_tokens"] += usage.prompt_tokens or 0
+            self.token_stats["cached_tokens"] += cached
+        
+    def _count(self, counter: str):
+        with self.stats_lock:
+            self.parse_stats[counter] += 1
+        
+    def _steps(self, task: str, context: str, on_token: Optional[Callable[[str], None]] = None,
+               route: Optional["ModelRoute"] = None):
+        """The agent's work as a generator of API requests
+        
+        Yields the keyword arguments of each chat.completions.create call
+        and receives its response, so run() can be blocking or async. Tool
+        calls are yielded as a ToolRound and answered with the tool messages.
+        """
+        started_ns = time.monotonic_ns()
+        messages = self._messages(task, context)
+        settings = self._settings(route)
+        cache_key = self._cache_key(messages, settings)
+        content = self.cache.get(cache_key) if cache_key else None
+        from_cache = content is not None
+        
+        # Only plain-text answers are streamed; JSON and tool calls are not worth showing
+        stream = {}
+        if on_token is not None and self.schema is None and not self.tools:
+            stream = {"stream": True, "stream_options": {"include_usage": True}}
+            if from_cache:
+                on_token(content)
+        
+        used_tools = False
+        if not from_cache:
+            try:
+                conversation = list(messages)
+                response = yield self._request(conversation, settings, **stream)
+                self._record_usage(response, settings["model"])
+                message = response.choices[0].message
+                rounds = 0
+                while getattr(message, "tool_calls", None) and rounds < self.max_tool_rounds:
+                    rounds += 1
+                    used_tools = True
+                    conversation.append({
+                        "role": "assistant",
+                        "content": message.content,
+                        "tool_calls": [{"id": call.id, "type": "function",
+                                        "function": {"name": call.function.name,
+                                                     "arguments": call.function.arguments}}
+                                       for call in message.tool_calls]
+                    })
+                    conversation.extend((yield ToolRound(self.name, message.tool_calls)))
+                    # The last round withholds the tools so the model must answer
+                    final_round = rounds >= self.max_tool_rounds
+                    response = yield self._request(conversation, settings,
+                                                   **({"tool_choice": "none"} if final_round else {}))
+                    self._record_usage(response, settings["model"])
+                    message = response.choices[0].message
+                content = message.content
+            except Exception as e:
+                # No answer rather than an error message later agents would read as context
+                error_msg = f"Error: {type(e).__name__}: {e}"
+                current_state().agent_errors[self.name] = error_msg
+                current_state().log(self.name, task[:100], error_msg, started_ns, "error", settings["model"])
+                return None
+        
+        if self.schema is None:
+            # Answers that depended on tool results are not reused
+            if cache_key and not from_cache and not used_tools:
+                self.cache.put(cache_key, content)
+            current_state().log(self.name, task[:100], content, started_ns,
+                                model=settings["model"], cache_hit=from_cache)
+            return content
+        
+        self._count("calls")
+        reasks = 0
+        while True:
+            try:
+                answer = parse_structured(self.schema, content)
+            except ValueError as problem:
+                self._count("parse_failures")
+                if reasks >= self.max_reasks:
+                    self._count("gave_up")
+                    current_state().log(self.name, task[:100], f"Invalid output: {problem}",
+                                        started_ns, "invalid", settings["model"], from_cache)
+                    return None
+                # Re-ask only this agent, with a short and deterministic request
+                reasks += 1
+                self._count("reasks")
+                retry = messages + [
+                    {"role": "assistant", "content": content or ""},
+                    {"role": "user", "content": f"That reply was invalid: {problem}. "
+                                                f"Reply again with only the corrected JSON object."}
+                ]
+                try:
+                    response = yield self._request(retry, settings, temperature=0, max_tokens=200)
+                    self._record_usage(response, settings["model"])
+                    content = response.choices[0].message.content
+                except Exception as e:
+                    self._count("gave_up")
+                    current_state().log(self.name, task[:100], f"Error: {str(e)}",
+                                        started_ns, "error", settings["model"])
+                    return None
+                from_cache = False
+                continue
+            
+            if cache_key and not from_cache:
+                self.cache.put(cache_key, content)
+            current_state().log(self.name, task[:100], content, started_ns,
+                                model=settings["model"], cache_hit=from_cache)
+            return answer
+        
+    def _create(self):
+        """The function that makes API calls (reading streams to the end), through the shared policy if set"""
+        if self.resilience is None:
+            return partial(_create_direct, self.client.chat.completions.create)
+        return partial(self.resilience.call, self.client.chat.completions)
+        
+    def run(self, task: str, context: str = "", on_token: Optional[Callable[[str], None]] = None,
+            route: Optional["ModelRoute"] = None):
+        """Run agent with a task, on the routed model if a route is given"""
+        return _drive(self._steps(task, context, on_token, route), self._create(), on_token)
+
+class AsyncSimpleAgent(SimpleAgent):
+    """Same agent, but awaits the OpenAI call so many can share one event loop"""
+    
+    def __init__(self, client: AsyncOpenAI, name: str, role: str, goal: str, instructions: str,
+                 cache: Optional["ResponseCache"] = None, cacheable: bool = True,
+                 schema=None, max_reasks: int = 1, tools: Tuple[str, ...] = (),
+                 max_tool_rounds: int = 3):
+        super().__init__(client, name, role, goal, instructions, cache, cacheable,
+                         schema, max_reasks, tools, max_tool_rounds)
+        
+    async def run(self, task: str, context: str = "", on_token: Optional[Callable[[str], None]] = None,
+                  route: Optional["ModelRoute"] = None):
+        """Run agent with a task without blocking the event loop"""
+        return await _drive_async(self._steps(task, context, on_token, route), self._create(), on_token)
+        
+    def _create(self):
+        if self.resilience is None:
+            return partial(_acreate_direct, self.client.chat.completions.create)
+        return partial(self.resilience.acall, self.client.chat.completions)
+
+# ============================================================================
+# RESPONSE CACHE
+# ============================================================================
+
+class ResponseCache:
+    """LLM answer cache: in-memory LRU in front of an optional SQLite file
+    
+    Entries expire after ttl seconds. Each tier holds a bounded number of
+    entries and drops the least recently used ones when full. Hits only
+    touch memory: the disk tier's last-use times are written back in
+    batches, and expired rows are deleted when the disk tier is trimmed.
+    """
+    RECENCY_BATCH = 1024   # Uses noted before they are written back to disk
+    
+    def __init__(self, path: Optional[str] = None, max_memory_entries: int = 1024,
+                 max_disk_entries: int = 100_000, ttl: float = 24 * 3600):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.memory = OrderedDict()   # key -> (expires_at, response)
+        self.used = {}                # key -> last use not yet written to the disk tier
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0,
+                         "writes": 0, "evictions": 0, "expired": 0}
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, response TEXT NOT NULL,
+                expires_at REAL NOT NULL, used_at REAL NOT NULL)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used_at)")
+            self.db.commit()
+        
+    @staticmethod
+    def key(messages: List[Dict], model: str, temperature: float, max_tokens: int) -> str:
+        """Hash of everything that determines the answer"""
+        payload = json.dumps([messages, model, temperature, max_tokens], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        
+    def get(self, key: str) -> Optional[str]:
+        """Cached response, or None"""
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    if self.db is not None:
+                        self._touch(key, now)
+                    return entry[1]
+                del self.memory[key]
+                self.counters["expired"] += 1
+            
+            if self.db is not None:
+                row = self.db.execute("SELECT response, expires_at FROM responses WHERE key = ?",
+                                      (key,)).fetchone()
+                if row and row[1] > now:
+                    self._touch(key, now)
+                    self._remember(key, row[1], row[0])
+                    self.counters["disk_hits"] += 1
+                    return row[0]
+                if row:
+                    self.counters["expired"] += 1   # Deleted by the next trim
+            
+            self.counters["misses"] += 1
+            return None
+        
+    def put(self, key: str, response: str):
+        """Store a response in both tiers"""
+        now = time.time()
+        expires_at = now + self.ttl
+        with self.lock:
+            self._remember(key, expires_at, response)
+            self.counters["writes"] += 1
+            if self.db is not None:
+                self.used.pop(key, None)
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                                (key, response, expires_at, now))
+                # Trim in chunks so every write doesn't pay for a count
+                if self.counters["writes"] % 100 == 0:
+                    self._trim_disk(now)
+                self.db.commit()
+        
+    def _remember(self, key: str, expires_at: float, response: str):
+        """Put an entry in the memory tier (caller holds the lock)"""
+        self.memory[key] = (expires_at, response)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+            self.counters["evictions"] += 1
+        
+    def _touch(self, key: str, now: float):
+        """Note a use of a disk entry (caller holds the lock)"""
+        self.used[key] = now
+        if len(self.used) >= self.RECENCY_BATCH:
+            self._write_recency()
+            self.db.commit()
+        
+    def _write_recency(self):
+        """Write the noted uses to the disk tier (caller holds the lock and commits)"""
+        if self.used:
+            self.db.executemany("UPDATE responses SET used_at = ? WHERE key = ?",
+                                [(used_at, key) for key, used_at in self.used.items()])
+            self.used.clear()
+        
+    def _trim_disk(self, now: float):
+        """Drop expired and least recently used rows (caller holds the lock)"""
+        self._write_recency()
+        self.db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        count = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        excess = count - self.max_disk_entries
+        if excess > 0:
+            self.db.execute("""DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY used_at LIMIT ?)""", (excess,))
+            self.counters["evictions"] += excess
+        
+    def stats(self) -> Dict:
+        """Hit/miss counters"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self.memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
+        
+    def close(self):
+        """Write back the noted uses and close the SQLite file"""
+        with self.lock:
+            if self.db is not None:
+                self._write_recency()
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+# ============================================================================
+# SEMANTIC INTENT CACHE
+# ============================================================================
+
+def text_features(text: str) -> List[str]:
+    """Lowercase word unigrams and bigrams"""
+    words = re.findall(r"[a-z0-9']+", text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+def embed_text(text: str, dim: int = 512):
+    """Local text embedding: hashed word unigrams and bigrams, L2-normalized"""
+    features = text_features(text)
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature in features:
+        h = zlib.crc32(feature.encode("utf-8"))
+        vector[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def format_classification(fields: Dict, customer_query: str) -> GreeterOutput:
+    """Greeter answer for a classification made without the LLM"""
+    return GreeterOutput(
+        greeting="",
+        intent=fields["intent"],
+        sentiment=fields.get("sentiment", "NEUTRAL"),
+        priority=fields.get("priority", "MEDIUM"),
+        summary=customer_query,
+        confidence=fields.get("confidence", 1.0)
+    )
+
+class SemanticIntentCache:
+    """Reuses Greeter classifications for near-duplicate queries
+    
+    Past queries are kept as rows of a fixed-size NumPy matrix, so memory
+    is bounded by max_entries; when full, the oldest entry is overwritten.
+    A lookup is one matrix-vector product (cosine similarity).
+    """
+    def __init__(self, threshold: float = 0.85, max_entries: int = 5000, dim: int = 512):
+        if np is None:
+            raise ImportError("SemanticIntentCache needs numpy: python -m pip install numpy")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.dim = dim
+        self.vectors = np.zeros((max_entries, dim), dtype=np.float32)
+        self.labels = [None] * max_entries
+        self.size = 0
+        self.next_slot = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        
+    def lookup(self, query: str) -> Optional[Dict]:
+        """Classification of the most similar past query above the threshold"""
+        vector = embed_text(query, self.dim)
+        with self.lock:
+            if self.size:
+                scores = self.vectors[:self.size] @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.hits += 1
+                    return self.labels[best]
+            self.misses += 1
+            return None
+        
+    def add(self, query: str, classification: Dict):
+        """Remember the classification of a query"""
+        vector = embed_text(query, self.dim)
+        with self.lock:
+            self.vectors[self.next_slot] = vector
+            self.labels[self.next_slot] = dict(classification)
+            self.next_slot = (self.next_slot + 1) % self.max_entries
+            self.size = min(self.size + 1, self.max_entries)
+        
+    def stats(self) -> Dict:
+        """Hit rate and index size"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "entries": self.size,
+                "max_entries": self.max_entries,
+                "index_bytes": int(self.vectors.nbytes)
+            }
+
+# ============================================================================
+# LOCAL FAST-PATH CLASSIFIER
+# ============================================================================
+
+class NaiveBayesTextClassifier:
+    """TF-IDF features with multinomial Naive Bayes (as in Email_Classifier.ipynb)"""
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self.vocabulary = {}
+        self.idf = None
+        self.classes = []
+        self.feature_log_prob = None
+        self.class_log_prior = None
+        
+    def _counts(self, texts: List[str]):
+        """Term counts for known features, one row per text"""
+        counts = np.zeros((len(texts), len(self.vocabulary)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in text_features(text):
+                column = self.vocabulary.get(feature)
+                if column is not None:
+                    counts[row, column] += 1
+        return counts
+        
+    def _tfidf(self, counts):
+        """Sublinear TF-IDF, L2-normalized per row"""
+        weights = np.log1p(counts) * self.idf
+        norms = np.linalg.norm(weights, axis=1, keepdims=True)
+        return weights / np.where(norms > 0, norms, 1)
+        
+    def fit(self, texts: List[str], labels: List[str]) -> "NaiveBayesTextClassifier":
+        """Train on labeled texts"""
+        for text in texts:
+            for feature in text_features(text):
+                self.vocabulary.setdefault(feature, len(self.vocabulary))
+        counts = self._counts(texts)
+        document_freq = (counts > 0).sum(axis=0)
+        self.idf = np.log((1 + len(texts)) / (1 + document_freq)) + 1
+        features = self._tfidf(counts)
+        
+        self.classes = sorted(set(labels))
+        labels = np.array(labels)
+        totals = np.stack([features[labels == label].sum(axis=0) for label in self.classes]) + self.alpha
+        self.feature_log_prob = np.log(totals / totals.sum(axis=1, keepdims=True))
+        self.class_log_prior = np.log(np.array([(labels == label).mean() for label in self.classes]))
+        return self
+        
+    def predict(self, text: str) -> Tuple[str, float]:
+        """Most likely label and its probability"""
+        features = self._tfidf(self._counts([text]))[0]
+        scores = self.feature_log_prob @ features + self.class_log_prior
+        probs = np.exp(scores - scores.max())
+        probs /= probs.sum()
+        best = int(np.argmax(probs))
+        return self.classes[best], float(probs[best])
+
+class FastPathClassifier:
+    """Local intent/sentiment/priority classifier that runs before the Greeter
+    
+    Only answers when the probability of every predicted field (intent,
+    sentiment and priority all drive routing and early exit) reaches the
+    threshold; otherwise the query goes to the LLM Greeter as usual. By
+    default the threshold is calibrated on held-out predictions, so the
+    answers it gives are right on every field at least target_accuracy
+    of the time. If no threshold gets there, it never answers.
+    """
+    FIELDS = ("intent", "sentiment", "priority")
+    NEVER = float("inf")   # Threshold of a classifier that always defers to the LLM
+    
+    def __init__(self, models: Dict[str, NaiveBayesTextClassifier], threshold: float):
+        self.models = models
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        
+    @classmethod
+    def from_csv(cls, path: str, threshold: Optional[float] = None,
+                 target_accuracy: float = 0.95) -> "FastPathClassifier":
+        """Train from a CSV with a 'text' column and intent/sentiment/priority labels"""
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        return cls.from_rows(rows, threshold, target_accuracy)
+        
+    @classmethod
+    def from_rows(cls, rows: List[Dict], threshold: Optional[float] = None,
+                  target_accuracy: float = 0.95) -> "FastPathClassifier":
+        """Train from dicts with a 'text' key and intent/sentiment/priority labels
+        
+        Without a threshold, one is calibrated for target_accuracy.
+        """
+        if np is None:
+            raise ImportError("FastPathClassifier needs numpy: python -m pip install numpy")
+        if threshold is None:
+            threshold = cls.calibrate(rows, target_accuracy)
+        texts = [row["text"] for row in rows]
+        models = {
+            field: NaiveBayesTextClassifier().fit(texts, [row[field].strip().upper() for row in rows])
+            for field in cls.FIELDS if rows and field in rows[0]
+        }
+        return cls(models, threshold)
+        
+    @classmethod
+    def held_out(cls, rows: List[Dict], folds: int = 5, seed: int = 7) -> List[Tuple[Dict, Dict, bool]]:
+        """(row, prediction, every field right), each row predicted by a model trained without it"""
+        rows = list(rows)
+        random.Random(seed).shuffle(rows)
+        results = []
+        for fold in range(folds):
+            model = cls.from_rows([row for i, row in enumerate(rows) if i % folds != fold], cls.NEVER)
+            for row in rows[fold::folds]:
+                prediction = model.predict(row["text"])
+                results.append((row, prediction, all(prediction[field] == row[field].strip().upper()
+                                                     for field in model.models)))
+        return results
+        
+    @classmethod
+    def calibrate(cls, rows: List[Dict], target_accuracy: float = 0.95, folds: int = 5,
+                  min_support: int = 20) -> float:
+        """Lowest threshold whose held-out answers are right at least target_accuracy of the time
+        
+        At least min_support held-out rows must reach it; NEVER if no
+        threshold qualifies.
+        """
+        if len(rows) < folds:
+            return cls.NEVER
+        scored = sorted(((prediction["confidence"], right) for _, prediction, right in cls.held_out(rows, folds)),
+                        key=lambda item: item[0], reverse=True)
+        threshold = cls.NEVER
+        correct = 0
+        for answered, (confidence, right) in enumerate(scored, 1):
+            correct += right
+            if answered < len(scored) and scored[answered][0] == confidence:
+                continue   # Ties all answer or none does
+            if answered >= min_support and correct >= target_accuracy * answered:
+                threshold = confidence
+        return threshold
+        
+    def predict(self, text: str) -> Dict:
+        """All predicted labels, each field's confidence, and the lowest of them as confidence"""
+        prediction = {"confidences": {}}
+        for field, model in self.models.items():
+            label, confidence = model.predict(text)
+            prediction[field] = label
+            prediction["confidences"][field] = confidence
+        prediction["confidence"] = min(prediction["confidences"].values(), default=0.0)
+        return prediction
+        
+    def classify(self, text: str) -> Optional[Dict]:
+        """Prediction if every field is confident enough, else None"""
+        prediction = self.predict(text)
+        confident = prediction["confidence"] >= self.threshold
+        with self.lock:
+            if confident:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return prediction if confident else None
+        
+    def stats(self) -> Dict:
+        """How often the Greeter was skipped, and at what threshold"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "threshold": None if self.threshold == self.NEVER else round(self.threshold, 3),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+# ============================================================================
+# CONTEXT COMPACTION
+# ============================================================================
+
+# Optional: exact token counts with tiktoken, else ~4 characters per token
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in text"""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return max(1, len(text) // 4)
+
+# Context field -> (label, priority). Higher priority numbers are
+# shortened or dropped first when an agent's budget is exceeded; 0 is kept whole.
+CONTEXT_FIELDS = {
+    "query": ("Customer Query", 0),
+    "classification": ("Classification", 1),
+    "customer": ("Customer Info", 1),
+    "actions": ("Actions Taken", 1),
+    "resolution": ("Resolver Plan", 2),
+    "draft": ("Draft Reply", 2),
+    "research": ("Research Findings", 3),
+    "greeting": ("Greeter Notes", 4)
+}
+
+def shorten(text: str, max_tokens: int) -> str:
+    """Keep the leading lines/sentences of text that fit in max_tokens"""
+    pieces = re.split(r"(?<=[.!?\n])\s+", text.strip())
+    kept = []
+    used = 0
+    for piece in pieces:
+        tokens = count_tokens(piece)
+        if used + tokens > max_tokens:
+            break
+        kept.append(piece)
+        used += tokens
+    return " ".join(kept) + " …" if kept else ""
+
+class ContextCompactor:
+    """Gives each agent only the context fields it needs, within a token budget"""
+    DEFAULT_BUDGETS = {
+        "greeter": 300,
+        "researcher": 600,
+        "tone_adapter": 800,
+        "resolver": 900,
+        "quality": 1000,
+        "escalation": 600,
+        "followup": 500
+    }
+    
+    def __init__(self, budgets: Optional[Dict[str, int]] = None):
+        self.budgets = dict(self.DEFAULT_BUDGETS, **(budgets or {}))
+        
+    def sections(self, needs: Tuple[str, ...], state: CustomerCareState,
+                 produced: Dict[str, str]) -> List[List]:
+        """[field, text] for each needed field that has content"""
+        sections = []
+        for field in needs:
+            if field == "query":
+                text = state.customer_query
+                if state.customer_id != "Unknown":
+                    text += f"\nCustomer ID: {state.customer_id}"
+            elif field == "classification":
+                text = (f"Intent: {state.intent} | Sentiment: {state.sentiment} | "
+                        f"Priority: {state.priority}") if state.intent else ""
+            elif field == "customer":
+                text = json.dumps(state.customer_info, separators=(",", ":")) if state.customer_info else ""
+            elif field == "actions":
+                text = "\n".join(state.actions_taken + [f"Held for approval: {action['tool']} {action['arguments']}"
+                                                        for action in state.pending_actions])
+            else:
+                text = produced.get(field, "")
+            if text:
+                sections.append([field, text])
+        return sections
+        
+    def build(self, node: "AgentNode", state: CustomerCareState, produced: Dict[str, str]) -> Tuple[str, int]:
+        """Context text for an agent and its token count"""
+        budget = self.budgets.get(node.key, 800)
+        sections = self.sections(node.needs, state, produced)
+        tokens = {field: count_tokens(f"{CONTEXT_FIELDS[field][0]}: {text}") for field, text in sections}
+        total = sum(tokens.values())
+        
+        # Shorten, then drop, the lowest-priority fields until it fits
+        for section in sorted(sections, key=lambda sec: -CONTEXT_FIELDS[sec[0]][1]):
+            if total <= budget:
+                break
+            field, text = section
+            if CONTEXT_FIELDS[field][1] == 0:
+                continue
+            label_tokens = count_tokens(f"{CONTEXT_FIELDS[field][0]}: ")
+            allowed = tokens[field] - (total - budget) - label_tokens - 2
+            section[1] = shorten(text, allowed) if allowed >= 20 else ""
+            kept = count_tokens(f"{CONTEXT_FIELDS[field][0]}: {section[1]}") if section[1] else 0
+            total -= tokens[field] - kept
+        
+        context = "\n".join(f"{CONTEXT_FIELDS[field][0]}: {text}" for field, text in sections if text)
+        return context, count_tokens(context)
+
+# ============================================================================
+# MODEL ROUTING
+# ============================================================================
+
+# USD per million tokens (input, output); used to estimate what routing saves
+MODEL_PRICES = {
+    "gpt-4": (30.0, 60.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-3.5-turbo": (0.5, 1.5)
+}
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Estimated USD cost of a call (0 for unknown models)"""
+    price_in, price_out = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+@dataclass
+class ModelRoute:
+    """The model settings one agent uses for one ticket"""
+    model: str
+    max_tokens: int
+    temperature: float
+    level: str = "standard"
+    reason: str = ""
+
+class RoutingPolicy:
+    """Picks model, max_tokens and temperature per agent and per ticket
+    
+    Each ticket gets a level from the Greeter's priority and the
+    customer's tier: CRITICAL tickets and premium_tiers are "premium", HIGH
+    is "standard", everything else "economy". Each level maps to a model.
+    Agents with a simple, constrained answer are capped at a level, so
+    they stay on the cheap model whatever the ticket.
+    """
+    LEVELS = ("economy", "standard", "premium")
+    DEFAULT_MODELS = {"economy": "gpt-4o-mini", "standard": "gpt-4o", "premium": "gpt-4"}
+    # agent key -> (max_tokens, temperature)
+    DEFAULT_SETTINGS = {
+        "greeter": (250, 0.0),
+        "researcher": (400, 0.3),
+        "tone_adapter": (400, 0.7),
+        "resolver": (400, 0.2),
+        "quality": (200, 0.0),
+        "escalation": (150, 0.0),
+        "followup": (100, 0.0)
+    }
+    DEFAULT_CAPS = {"greeter": "economy", "followup": "economy", "escalation": "standard"}
+    
+    def __init__(self, models: Optional[Dict[str, str]] = None,
+                 settings: Optional[Dict[str, Tuple[int, float]]] = None,
+                 caps: Optional[Dict[str, str]] = None,
+                 premium_priorities: Tuple[str, ...] = ("CRITICAL",),
+                 standard_priorities: Tuple[str, ...] = ("HIGH",),
+                 premium_tiers: Tuple[str, ...] = PREMIUM_TIERS,
+                 baseline_model: str = "gpt-4"):
+        self.models = dict(self.DEFAULT_MODELS, **(models or {}))
+        self.settings = dict(self.DEFAULT_SETTINGS, **(settings or {}))
+        self.caps = dict(self.DEFAULT_CAPS, **(caps or {}))
+        self.premium_priorities = premium_priorities
+        self.standard_priorities = standard_priorities
+        self.premium_tiers = premium_tiers
+        self.baseline_model = baseline_model   # What every agent used before routing
+        self.totals = {}   # model -> {"calls", "seconds", "cost_usd", "baseline_cost_usd"}
+        self.lock = threading.Lock()
+        
+    def level(self, state: CustomerCareState) -> Tuple[str, str]:
+        """The ticket's level and why"""
+        tier = (state.customer_info or {}).get("tier")
+        if tier in self.premium_tiers:
+            return "premium", f"{tier} tier"
+        if state.priority in self.premium_priorities:
+            return "premium", f"{state.priority} priority"
+        if state.priority in self.standard_priorities:
+            return "standard", f"{state.priority} priority"
+        if state.priority:
+            return "economy", f"{state.priority} priority"
+        return "standard", "priority unknown"
+        
+    def route(self, agent_key: str, state: CustomerCareState) -> ModelRoute:
+        """Settings for one agent on this ticket"""
+        level, reason = self.level(state)
+        cap = self.caps.get(agent_key)
+        if cap and self.LEVELS.index(level) > self.LEVELS.index(cap):
+            level, reason = cap, f"{reason}, capped for {agent_key}"
+        max_tokens, temperature = self.settings.get(agent_key, (500, 0.7))
+        return ModelRoute(self.models[level], max_tokens, temperature, level, reason)
+        
+    def record(self, route: ModelRoute, seconds: float, usage: Optional[Dict]) -> Dict:
+        """Log one routed call; returns the decision with its latency and cost"""
+        prompt_tokens = usage["prompt_tokens"] if usage else 0
+        completion_tokens = usage["completion_tokens"] if usage else 0
+        decision = dataclasses.asdict(route)
+        decision.update({
+            "seconds": round(seconds, 3),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost_usd": round(estimate_cost(route.model, prompt_tokens, completion_tokens), 6),
+            "baseline_cost_usd": round(estimate_cost(self.baseline_model, prompt_tokens, completion_tokens), 6)
+        })
+        with self.lock:
+            totals = self.totals.setdefault(route.model, {"calls": 0, "seconds": 0.0, "cost_usd": 0.0,
+                                                          "baseline_cost_usd": 0.0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["cost_usd"] += decision["cost_usd"]
+            totals["baseline_cost_usd"] += decision["baseline_cost_usd"]
+        return decision
+        
+    def stats(self) -> Dict:
+        """Calls, mean latency and estimated cost per model, vs. the baseline model"""
+        with self.lock:
+            per_model = {
+                model: {"calls": t["calls"],
+                        "mean_s": round(t["seconds"] / t["calls"], 3),
+                        "cost_usd": round(t["cost_usd"], 6)}
+                for model, t in self.totals.items()
+            }
+            cost = sum(t["cost_usd"] for t in self.totals.values())
+            baseline = sum(t["baseline_cost_usd"] for t in self.totals.values())
+        return {
+            "models": per_model,
+            "cost_usd": round(cost, 6),
+            "baseline_cost_usd": round(baseline, 6),
+            "baseline_model": self.baseline_model,
+            "savings_pct": round(100 * (1 - cost / baseline), 1) if baseline else 0.0
+        }
+
+# ============================================================================
+# EARLY EXIT
+# ============================================================================
+
+class EarlyExitPolicy:
+    """Rules for skipping agents that cannot change a simple ticket's outcome
+    
+    rules maps an intent to the agents it may skip. A rule applies only
+    when the intent was classified with at least min_confidence, the
+    priority is in allowed_priorities and the sentiment is not in
+    blocked_sentiments. The escalation check always runs for customers in
+    escalation_tiers and for escalation_sentiments. The latency each skip
+    saves is estimated from the agents' recent mean durations.
+    """
+    # A password reset or tracking answer is one KB line or one tool result:
+    # nothing to execute, escalate or follow up on. OTHER is not here: it is
+    # where the unusual and sensitive tickets end up
+    DEFAULT_RULES = {
+        "ACCOUNT": ("resolver", "escalation", "followup"),
+        "TRACKING": ("resolver", "escalation", "followup")
+    }
+    
+    def __init__(self, rules: Optional[Dict[str, Tuple[str, ...]]] = None,
+                 min_confidence: float = 0.8,
+                 allowed_priorities: Tuple[str, ...] = ("LOW", "MEDIUM"),
+                 blocked_sentiments: Tuple[str, ...] = ("URGENT",),
+                 escalation_tiers: Tuple[str, ...] = PREMIUM_TIERS,
+                 escalation_sentiments: Tuple[str, ...] = ("NEGATIVE", "URGENT")):
+        self.rules = self.DEFAULT_RULES if rules is None else rules
+        self.min_confidence = min_confidence
+        self.allowed_priorities = allowed_priorities
+        self.blocked_sentiments = blocked_sentiments
+        self.escalation_tiers = escalation_tiers
+        self.escalation_sentiments = escalation_sentiments
+        self.durations = {}   # agent key -> moving average of its duration in seconds
+        self.per_intent = {}  # intent -> {"tickets", "short_circuited", "calls_skipped", "seconds_saved"}
+        self.lock = threading.Lock()
+        
+    def skips(self, agent_key: str, state: CustomerCareState) -> bool:
+        """Whether this ticket can go without the agent"""
+        if agent_key not in self.rules.get(state.intent, ()):
+            return False
+        if agent_key == "escalation" and (
+                state.sentiment in self.escalation_sentiments
+                or (state.customer_info or {}).get("tier") in self.escalation_tiers):
+            return False
+        return (state.intent_confidence >= self.min_confidence
+                and state.priority in self.allowed_priorities
+                and state.sentiment not in self.blocked_sentiments)
+        
+    def observe(self, agent_key: str, seconds: float):
+        """Learn how long an agent usually takes"""
+        with self.lock:
+            previous = self.durations.get(agent_key)
+            self.durations[agent_key] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+        
+    def estimate(self, agent_key: str) -> float:
+        """Expected duration of an agent (0 until it has been seen)"""
+        with self.lock:
+            return self.durations.get(agent_key, 0.0)
+        
+    def record(self, intent: Optional[str], skipped: List[str], seconds_saved: float):
+        """Count one finished ticket"""
+        with self.lock:
+            totals = self.per_intent.setdefault(intent or "UNKNOWN", {
+                "tickets": 0, "short_circuited": 0, "calls_skipped": 0, "seconds_saved": 0.0})
+            totals["tickets"] += 1
+            totals["short_circuited"] += bool(skipped)
+            totals["calls_skipped"] += len(skipped)
+            totals["seconds_saved"] += seconds_saved
+        
+    def stats(self) -> Dict:
+        """Agent calls skipped and latency saved per intent"""
+        with self.lock:
+            return {
+                intent: {
+                    "tickets": t["tickets"],
+                    "short_circuited": t["short_circuited"],
+                    "calls_skipped": t["calls_skipped"],
+                    "seconds_saved": round(t["seconds_saved"], 3),
+                    "mean_seconds_saved": round(t["seconds_saved"] / t["tickets"], 3)
+                }
+                for intent, t in sorted(self.per_intent.items())
+            }
+
+# ============================================================================
+# SPECULATIVE EXECUTION
+# ============================================================================
+
+class SpeculationPolicy:
+    """Runs an agent on a predicted intent while the Greeter is still working
+    
+    The intent is predicted from keywords in the query. The speculative
+    run works on a copy of the query's state. If the Greeter agrees and
+    the agent would not get a better model on the real priority, its
+    answer is used as is.
+    Otherwise it is cancelled (or ignored once running) and the agent runs
+    again on the real intent. Only agents whose tools have no side
+    effects should be speculated; by default that is the Researcher.
+    """
+    DEFAULT_KEYWORDS = {
+        "REFUND": ("refund", "money back", "reimburse"),
+        "RETURN": ("return", "exchange", "send it back", "wrong size", "doesn't fit"),
+        "SHIPPING": ("shipping", "delivery", "in transit", "delayed", "late", "arrive"),
+        "TRACKING": ("where is", "track", "status of", "package"),
+        "ACCOUNT": ("password", "log in", "log into", "login", "sign in", "account"),
+        "BILLING": ("charged", "charge", "invoice", "payment", "billing", "declined")
+    }
+    
+    def __init__(self, agent_key: str = "researcher",
+                 keywords: Optional[Dict[str, Tuple[str, ...]]] = None):
+        self.agent_key = agent_key
+        self.keywords = self.DEFAULT_KEYWORDS if keywords is None else keywords
+        self.totals = {"tickets": 0, "speculated": 0, "hits": 0, "misses": 0,
+                       "seconds_saved": 0.0, "tokens_wasted": 0}
+        self.lock = threading.Lock()
+        
+    def predict(self, query: str) -> Optional[str]:
+        """The intent with the most keyword matches, or None if there is no clear winner"""
+        text = query.lower()
+        scores = sorted(((sum(word in text for word in words), intent)
+                         for intent, words in self.keywords.items()), reverse=True)
+        if not scores or scores[0][0] == 0 or (len(scores) > 1 and scores[1][0] == scores[0][0]):
+            return None
+        return scores[0][1]
+        
+    def record(self, speculated: bool, hit: bool = False, seconds_saved: float = 0.0):
+        """Count one finished ticket"""
+        with self.lock:
+            self.totals["tickets"] += 1
+            self.totals["speculated"] += speculated
+            self.totals["hits"] += hit
+            self.totals["misses"] += speculated and not hit
+            self.totals["seconds_saved"] += seconds_saved
+        
+    def wasted(self, tokens: int):
+        """Count the tokens of a discarded speculative run"""
+        with self.lock:
+            self.totals["tokens_wasted"] += tokens
+        
+    def stats(self) -> Dict:
+        """Speculation hit rate and the latency it saved"""
+        with self.lock:
+            t = dict(self.totals)
+        t["hit_rate"] = round(t["hits"] / t["speculated"], 3) if t["speculated"] else 0.0
+        t["seconds_saved"] = round(t["seconds_saved"], 3)
+        t["mean_seconds_saved"] = round(t["seconds_saved"] / t["tickets"], 3) if t["tickets"] else 0.0
+        return t
+
+# ============================================================================
+# AGENT GRAPH
+# ============================================================================
+
+class AgentNode:
+    """One agent in the pipeline and the agents whose output it reads"""
+    def __init__(self, key: str, title: str, task: str, after: Tuple[str, ...] = (),
+                 prepare: Optional[str] = None, apply: Optional[str] = None,
+                 shortcut: Optional[str] = None, needs: Tuple[str, ...] = ("query",),
+                 produces: Optional[str] = None, streams: bool = False):
+        self.key = key
+        self.title = title
+        self.task = task          # Formatted with the query's state
+        self.after = after        # Agents whose output is this agent's context
+        self.prepare = prepare    # CustomerCareSystem method run before the agent
+        self.apply = apply        # CustomerCareSystem method that reads the result
+        self.shortcut = shortcut  # CustomerCareSystem method that may answer without the LLM
+        self.needs = needs        # Context fields the agent is given (see CONTEXT_FIELDS)
+        self.produces = produces  # Context field filled with the agent's answer
+        self.streams = streams    # Its answer is the customer's reply, streamed when asked
+
+_REVIEW_INPUTS = ("greeter", "researcher", "tone_adapter", "resolver")
+
+# Reviewer, escalation and follow-up only read the first four agents,
+# so they run side by side once the Resolver is done
+AGENT_GRAPH = [
+    AgentNode("greeter", "🤝 Agent 1: Greeter & Intent Classifier",
+              "Analyze this customer query: {state.customer_query}",
+              apply="_apply_greeting", shortcut="_classify_locally",
+              needs=("query",), produces="greeting"),
+    AgentNode("researcher", "🔍 Agent 2: Knowledge Researcher",
+              "Based on the intent '{state.intent}', what information do we need to resolve this?",
+              after=("greeter",), prepare="_gather_research",
+              needs=("query", "classification", "customer", "greeting"), produces="research"),
+    AgentNode("tone_adapter", "💙 Agent 3: Empathy & Tone Adapter",
+              "Craft an empathetic response for a customer with {state.sentiment} sentiment.",
+              after=("greeter", "researcher"), apply="_apply_tone",
+              needs=("query", "classification", "customer", "research", "greeting"), produces="draft",
+              streams=True),
+    AgentNode("resolver", "🛠️  Agent 4: Problem Resolver",
+              "What specific actions should we take to resolve this issue?",
+              after=("greeter", "researcher", "tone_adapter"), apply="_apply_resolution",
+              needs=("query", "classification", "customer", "research", "draft"), produces="resolution"),
+    AgentNode("quality", "✅ Agent 5: Quality Reviewer",
+              "Review this entire interaction for quality, accuracy, and completeness.",
+              after=_REVIEW_INPUTS, apply="_apply_quality",
+              needs=("query", "classification", "research", "draft", "resolution", "actions")),
+    AgentNode("escalation", "🚨 Agent 6: Escalation Coordinator",
+              "Should this be escalated to a human?",
+              after=_REVIEW_INPUTS, apply="_apply_escalation",
+              needs=("query", "classification", "customer", "resolution", "actions")),
+    AgentNode("followup", "📅 Agent 7: Follow-up Scheduler",
+              "Should we schedule a follow-up with this customer?",
+              after=_REVIEW_INPUTS, apply="_apply_followup",
+              needs=("query", "classification", "customer", "resolution", "actions"))
+]
+
+def critical_path(durations: Dict[str, float]) -> Tuple[float, List[str]]:
+    """Slowest chain of dependent agents, as (seconds, agent keys)"""
+    longest = {}   # agent key -> (seconds, path) of the slowest chain ending there
+    for node in AGENT_GRAPH:
+        if node.key not in durations:
+            continue
+        before = max((longest[key] for key in node.after if key in longest), default=(0.0, []))
+        longest[node.key] = (before[0] + durations[node.key], before[1] + [node.key])
+    return max(longest.values(), default=(0.0, []))
+
+def _timed_call(func, *args, **kwargs):
+    """Call func and return (result, start, end)"""
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, started, time.perf_counter()
+
+async def _timed_call_async(func, *args, **kwargs):
+    """Await func and return (result, start, end)"""
+    started = time.perf_counter()
+    result = await func(*args, **kwargs)
+    return result, started, time.perf_counter()
+
+def _call_in_state(state: CustomerCareState, func, *args, **kwargs):
+    """Call func with state as the current query's state (run in a copied context)"""
+    _current_state.set(state)
+    return func(*args, **kwargs)
+
+async def _await_in_state(state: CustomerCareState, call):
+    """Await call with state as the current query's state (run as its own task)"""
+    _current_state.set(state)
+    return await call
+
+class PipelineRun:
+    """Tracks one query moving through AGENT_GRAPH
+    
+    With on_token, the streaming agent's reply is passed on token by token;
+    on_reply gets the whole reply once that agent is done, while the
+    agents after it keep running.
+    """
+    def __init__(self, system, state: CustomerCareState, context: str, print,
+                 on_token: Optional[Callable[[str], None]] = None,
+                 on_reply: Optional[Callable[[str], None]] = None):
+        self.system = system
+        self.state = state
+        self.base_context = context
+        self.print = print
+        self.outputs = {}      # agent key -> text it adds to later contexts
+        self.produced = {}     # context field -> agent answer
+        self.prepared = {}     # agent key -> (extra context, console notes)
+        self.context_tokens = {}   # agent key -> (tokens sent, tokens of the full context)
+        self.timings = {}      # agent key -> (start, end), seconds since query start
+        self.started = time.perf_counter()
+        self.started_ns = time.monotonic_ns()   # For the query's root span
+        self.on_token = on_token
+        self.on_reply = on_reply
+        self.first_token_at = None   # perf_counter() of the first streamed token
+        self.routes = {}       # agent key -> ModelRoute it ran with
+        self.skipped = []      # Agents left out by the early-exit rules
+        self.speculation = None    # The speculative run in flight, until claimed
+        self.speculated = None     # What was speculated and whether it was used
+        self.adopted = {}          # agent key -> state of the speculative run used for it
+        
+    def agent_kwargs(self, node: AgentNode) -> Dict:
+        """Extra arguments for the agent's run(): its route, and a token callback if it streams"""
+        kwargs = {}
+        if self.system.routing is not None:
+            kwargs["route"] = self.routes[node.key] = self.system.routing.route(node.key, self.state)
+        if not node.streams or self.on_token is None:
+            return kwargs
+        def on_token(token: str):
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            self.on_token(token)
+        kwargs["on_token"] = on_token
+        return kwargs
+        
+    @property
+    def finished(self) -> bool:
+        return len(self.outputs) == len(AGENT_GRAPH)
+        
+    def ready(self) -> List[Tuple[AgentNode, str, str]]:
+        """Agents whose inputs are all available, as (node, task, context)
+        
+        Agents answered by their shortcut are completed here and not returned.
+        """
+        launch = []
+        for node in AGENT_GRAPH:
+            if node.key in self.outputs or node.key in self.prepared:
+                continue
+            if not all(key in self.outputs for key in node.after):
+                continue
+            
+            if self.system.early_exit is not None and self.system.early_exit.skips(node.key, self.state):
+                # Later agents go without its output, as with a failed agent
+                self.outputs[node.key] = ""
+                self.skipped.append(node.key)
+                continue
+            
+            notes = []
+            extra = ""
+            if node.prepare:
+                extra = getattr(self.system, node.prepare)(self.state, lambda *args: notes.append(args))
+            self.prepared[node.key] = (extra, notes)
+            
+            if node.shortcut:
+                now = time.perf_counter()
+                answer = getattr(self.system, node.shortcut)(self.state)
+                if answer is not None:
+                    # Answered locally; later nodes in the graph can start right away
+                    self.complete(node, answer, now, time.perf_counter())
+                    continue
+            
+            context = self.base_context
+            for other in AGENT_GRAPH:
+                if other.key in node.after:
+                    context += self.outputs[other.key]
+            context += extra
+            full_tokens = count_tokens(context)
+            sent_tokens = full_tokens
+            if self.system.compactor is not None:
+                context, sent_tokens = self.system.compactor.build(node, self.state, self.produced)
+            self.context_tokens[node.key] = (sent_tokens, full_tokens)
+            launch.append((node, node.task.format(state=self.state), context))
+        return launch
+        
+    def speculate(self) -> Optional[Tuple[AgentNode, str, str, CustomerCareState, Dict]]:
+        """Start the speculative agent now? Returns (node, task, context, state, kwargs)
+        
+        None when speculation is off, the agent's inputs are already there
+        (e.g. the Greeter was answered locally) or the intent can't be
+        predicted. The agent gets a copy of the state with the predicted
+        intent, so its usage and tool calls only count if it is used.
+        """
+        policy = self.system.speculation
+        if policy is None or self.speculated is not None:
+            return None
+        node = next((node for node in AGENT_GRAPH if node.key == policy.agent_key), None)
+        if node is None or node.key in self.outputs or all(key in self.outputs for key in node.after):
+            return None
+        predicted = policy.predict(self.state.customer_query)
+        if predicted is None:
+            return None
+        
+        guess = CustomerCareState.from_dict(self.state.to_dict())
+        guess.intent = predicted
+        extra = getattr(self.system, node.prepare)(guess, _silent_print) if node.prepare else ""
+        context = self.base_context + extra
+        if self.system.compactor is not None:
+            context, _ = self.system.compactor.build(node, guess, self.produced)
+        kwargs = {}
+        if self.system.routing is not None:
+            kwargs["route"] = self.system.routing.route(node.key, guess)
+        self.speculation = {"node": node, "state": guess, "route": kwargs.get("route"),
+                            "started": time.perf_counter(), "future": None}
+        self.speculated = {"agent": node.key, "predicted_intent": predicted, "hit": None, "seconds_saved": 0.0}
+        return node, node.task.format(state=guess), context, guess, kwargs
+        
+    def claim_speculation(self, node: AgentNode):
+        """The speculative run's future if it can stand in for this agent, else None
+        
+        A speculative run the real inputs don't match is cancelled, or
+        left to finish unused if it already started.
+        """
+        speculation = self.speculation
+        if speculation is None or speculation["node"] is not node:
+            return None
+        self.speculation = None
+        route = speculation["route"]
+        # Before the Greeter the priority is unknown, which routes to the standard
+        # level; the answer is kept unless the ticket turned out to need a better model
+        levels = RoutingPolicy.LEVELS
+        if speculation["state"].intent != self.state.intent or (
+                route is not None and levels.index(route.level)
+                < levels.index(self.system.routing.route(node.key, self.state).level)):
+            self.speculated["hit"] = False
+            guess, policy = speculation["state"], self.system.speculation
+            speculation["future"].cancel()
+            speculation["future"].add_done_callback(lambda _: policy.wasted(sum(
+                usage["prompt_tokens"] + usage["completion_tokens"] for usage in guess.usage.values())))
+            return None
+        
+        # Started now, the agent would finish this much later: the time it has run so far,
+        # or its whole run if it is already done
+        saved = time.perf_counter() - speculation["started"]
+        future = speculation["future"]
+        if future.done() and not future.cancelled() and future.exception() is None:
+            _, started, ended = future.result()
+            saved = min(saved, ended - started)
+        self.speculated.update(hit=True, seconds_saved=round(saved, 3))
+        if route is not None:
+            self.routes[node.key] = route
+        self.adopted[node.key] = speculation["state"]
+        return speculation["future"]
+        
+    def speculation_report(self) -> Optional[Dict]:
+        """Counts the ticket in the speculation stats; returns what was speculated"""
+        if self.system.speculation is None:
+            return None
+        if self.speculated is not None and self.speculated["hit"] is None:
+            # Never claimed (e.g. the agent was skipped)
+            self.speculated["hit"] = False
+        self.system.speculation.record(self.speculated is not None,
+                                       bool(self.speculated and self.speculated["hit"]),
+                                       self.speculated["seconds_saved"] if self.speculated else 0.0)
+        return self.speculated
+        
+    def _adopt(self, agent_name: str, guess: CustomerCareState):
+        """Take over the usage, tool calls and error of a speculative run"""
+        if agent_name in guess.usage:
+            self.state.usage[agent_name] = guess.usage[agent_name]
+        if agent_name in guess.agent_errors:
+            self.state.agent_errors[agent_name] = guess.agent_errors[agent_name]
+        self.state.tool_calls.extend(call for call in guess.tool_calls if call["agent"] == agent_name)
+        
+    def complete(self, node: AgentNode, result, started: float, finished: float):
+        """Record an agent's answer (text, structured output or None) and apply it"""
+        agent_name = self.system.agents[node.key].name
+        if node.key in self.adopted:
+            self._adopt(agent_name, self.adopted.pop(node.key))
+        if result is None and agent_name not in self.state.agent_errors:
+            self.state.parse_failures.append(node.key)
+        extra, notes = self.prepared.pop(node.key)
+        self.timings[node.key] = (started - self.started, finished - self.started)
+        if self.system.early_exit is not None:
+            self.system.early_exit.observe(node.key, finished - started)
+        
+        print = self.print
+        print(node.title)
+        print("-" * 80)
+        for args in notes:
+            print(*args)
+        route = self.routes.pop(node.key, None)
+        if route is not None:
+            decision = self.system.routing.record(route, finished - started,
+                                                  self.state.usage.get(agent_name))
+            self.state.routing[node.key] = decision
+            print(f"🧭 {route.model} ({route.level}: {route.reason}) "
+                  f"{decision['seconds']}s ~${decision['cost_usd']:.4f}")
+        for call in self.state.tool_calls:
+            if call["agent"] == agent_name:
+                print(f"🔧 {call['tool']}({call['arguments']}) {call['ms']}ms")
+        text = answer_text(result)
+        if agent_name in self.state.agent_errors:
+            print(f"❌ {self.state.agent_errors[agent_name]}")
+        else:
+            print(text)
+        if node.apply:
+            getattr(self.system, node.apply)(self.state, result, print)
+        print()
+        
+        if result is None:
+            # Later agents just go without this one's answer
+            text = ""
+        self.outputs[node.key] = f"{extra}\n{text}\n"
+        if node.produces and text:
+            self.produced[node.produces] = text
+        if node.streams and self.on_reply is not None:
+            self.on_reply(text)
+        if self.system.checkpoints is not None:
+            self.system.checkpoints.append(self.state.ticket_id, self.checkpoint())
+        
+    def checkpoint(self) -> Dict:
+        """Everything needed to continue this run after the agents done so far"""
+        return {
+            "state": self.state.to_dict(),
+            "outputs": self.outputs,
+            "produced": self.produced,
+            "timings": self.timings,
+            "context_tokens": self.context_tokens,
+            "skipped": self.skipped
+        }
+        
+    def restore(self, checkpoint: Dict):
+        """Mark the checkpointed agents as done; the state is restored by the caller"""
+        self.outputs.update(checkpoint["outputs"])
+        self.produced.update(checkpoint["produced"])
+        self.timings.update({key: tuple(times) for key, times in checkpoint["timings"].items()})
+        self.context_tokens.update({key: tuple(tokens) for key, tokens in checkpoint["context_tokens"].items()})
+        self.skipped.extend(checkpoint["skipped"])
+        
+    def early_exit_report(self) -> Dict:
+        """Agents skipped and the critical-path time that saved (estimated)"""
+        durations = {key: end - start for key, (start, end) in self.timings.items()}
+        actual_s = critical_path(durations)[0]
+        for key in self.skipped:
+            durations[key] = self.system.early_exit.estimate(key)
+        saved_s = max(0.0, critical_path(durations)[0] - actual_s) if self.skipped else 0.0
+        return {"skipped": list(self.skipped), "seconds_saved": round(saved_s, 3)}
+        
+    def context_report(self) -> Dict:
+        """Context tokens sent to the agents vs. the full accumulated context"""
+        sent = sum(tokens for tokens, _ in self.context_tokens.values())
+        full = sum(tokens for _, tokens in self.context_tokens.values())
+        return {
+            "sent_tokens": sent,
+            "full_tokens": full,
+            "tokens_saved": full - sent,
+            "per_agent": {key: {"sent": tokens, "full": full_tokens}
+                          for key, (tokens, full_tokens) in self.context_tokens.items()}
+        }
+        
+    def schedule(self) -> Dict:
+        """When each agent ran and the critical path through the graph"""
+        agents = {}
+        for node in AGENT_GRAPH:
+            if node.key not in self.timings:
+                continue
+            start, end = self.timings[node.key]
+            agents[node.key] = {
+                "start_s": round(start, 3),
+                "end_s": round(end, 3),
+                "duration_s": round(end - start, 3)
+            }
+        
+        durations = {key: end - start for key, (start, end) in self.timings.items()}
+        critical_s, path = critical_path(durations)
+        reply = next((node.key for node in AGENT_GRAPH if node.streams and node.key in self.timings), None)
+        return {
+            "wall_time_s": round(time.perf_counter() - self.started, 3),
+            "first_token_s": (round(self.first_token_at - self.started, 3)
+                              if self.first_token_at is not None else None),
+            "reply_s": round(self.timings[reply][1], 3) if reply else None,
+            "critical_path": path,
+            "critical_path_s": round(critical_s, 3),
+            "agents": agents
+        }
+
+# ============================================================================
+# BATCH STATISTICS
 # ============================================================================
 
-class CustomerCareState:
-    """Shared memory across all agents"""
+def _silent_print(*args, **kwargs):
+    """Drop console output (used for quiet/batch runs)"""
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+class BatchStats:
+    """Throughput and latency statistics for one batch"""
     def __init__(self):
-        self.customer_query = ""
-        self.customer_id = ""
-        self.intent = ""
-        self.sentiment = ""
-        self.priority = ""
-        self.research_findings = []
-        self.customer_info = {}
-        self.proposed_solution = ""
-        self.final_message = ""
-        self.actions_taken = []
-        self.requires_human = False
-        self.escalation_reason = ""
-        self.quality_score = 0
-        self.quality_feedback = ""
-        self.follow_up_needed = False
-        self.interaction_log = []
-        
-    def log(self, agent, action, result):
-        """Log agent interaction"""
-        self.interaction_log.append({
-            "timestamp": datetime.now().isoformat(),
-            "agent": agent,
-            "action": action,
-            "result": result[:200]  # Truncate long results
-        })
+        self.started = time.perf_counter()
+        self.finished = None
+        self.latencies = []
+        self.statuses = {}
         
-    def reset(self):
-        """Reset for new query"""
-        self.__init__()
-
-# Global state
-state = CustomerCareState()
+    def record(self, status: str, latency: float):
+        """Record one finished query"""
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        
+    def finish(self):
+        """Mark the batch as complete"""
+        self.finished = time.perf_counter()
+        
+    def summary(self) -> Dict:
+        """Batch statistics as a dict"""
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        count = len(self.latencies)
+        return {
+            "queries": count,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_qps": round(count / elapsed, 3) if elapsed > 0 else 0.0,
+            "latency_mean_s": round(sum(self.latencies) / count, 3) if count else 0.0,
+            "latency_p50_s": round(percentile(self.latencies, 50), 3),
+            "latency_p95_s": round(percentile(self.latencies, 95), 3),
+            "latency_p99_s": round(percentile(self.latencies, 99), 3),
+            "statuses": dict(self.statuses)
+        }
+        
+    def report(self):
+        """Print batch statistics"""
+        summary = self.summary()
+        print("\n" + "="*80)
+        print("📈 BATCH COMPLETE")
+        print("="*80)
+        print(f"Queries: {summary['queries']} in {summary['elapsed_s']}s "
+              f"({summary['throughput_qps']} queries/s)")
+        print(f"Latency: mean {summary['latency_mean_s']}s | p50 {summary['latency_p50_s']}s | "
+              f"p95 {summary['latency_p95_s']}s | p99 {summary['latency_p99_s']}s")
+        print(f"Statuses: {summary['statuses']}")
+        print("="*80)
 
 # ============================================================================
-# SIMULATED TOOLS (Same as before)
+# HUMAN APPROVAL QUEUE
 # ============================================================================
 
-def search_knowledge_base(query: str) -> str:
-    """Search company policies"""
-    kb = {
-        "refund": "Refund Policy: Full refunds within 30 days. Process time: 5-7 business days.",
-        "return": "Return Process: Contact support → Receive label → Ship back → Refund processed.",
-        "shipping": "Shipping: Standard (5-7 days) Free, Express (2-3 days) $15, Overnight $30",
-        "tracking": "Tracking available 24-48 hours after order.",
-        "account": "Account: Password reset via email. 2FA in Settings.",
-        "billing": "Billing: Charges appear as 'ACME INC'. Contact billing@acme.com",
-        "password": "Password Reset: Click 'Forgot Password' → Check email for reset link.",
-        "warranty": "Warranty: 1 year on electronics. 2 years premium. Claims: warranty@acme.com",
-        "exchange": "Exchanges: Available within 30 days. Free for size/color changes."
-    }
-    
-    query_lower = query.lower()
-    results = []
-    for key, value in kb.items():
-        if key in query_lower:
-            results.append(f"{key.upper()}: {value}")
-    
-    return "\n".join(results) if results else "No specific policy found. Contact: support@acme.com"
-
-def lookup_customer(customer_id: str) -> str:
-    """Look up customer information"""
-    customers = {
-        "12345": {
-            "name": "Jane Smith",
-            "email": "jane@email.com",
-            "tier": "Premium",
-            "lifetime_value": "$2,450",
-            "recent_orders": ["ORD-789: $85"],
-            "notes": "VIP customer - expedited service"
-        },
-        "67890": {
-            "name": "John Doe",
-            "email": "john@email.com",
-            "tier": "Standard",
-            "lifetime_value": "$340",
-            "recent_orders": ["ORD-321: $1,500"],
-            "notes": "First major purchase"
-        },
-        "11111": {
-            "name": "Sarah Johnson",
-            "email": "sarah@email.com",
-            "tier": "Gold",
-            "lifetime_value": "$5,200",
-            "recent_orders": ["ORD-555: $220"],
-            "notes": "Loyal long-term customer"
-        }
-    }
-    
-    customer = customers.get(customer_id, {
-        "name": "Valued Customer",
-        "tier": "Standard",
-        "notes": "New customer"
-    })
-    
-    return json.dumps(customer, indent=2)
+# Held tool calls and what carries each out
+HELD_ACTIONS = {"process_refund": issue_refund, "send_email": deliver_email}
 
-def process_refund(order_id: str, amount: float, reason: str) -> str:
-    """Process refund (checks for human approval)"""
-    if amount > 100:
-        state.requires_human = True
-        state.escalation_reason = f"Refund over $100 requires approval: ${amount} for {order_id}"
-        return f"⚠️ ESCALATED: ${amount} refund requires human approval. Reason: {reason}"
+class ApprovalQueue:
+    """Escalated tickets waiting for a human, in a SQLite file
     
-    ref = f"REF-{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    result = f"✓ Refund processed: ${amount} for {order_id}. Reference: {ref}. ETA: 5-7 days."
-    state.actions_taken.append(result)
-    return result
-
-def send_email(recipient: str, subject: str) -> str:
-    """Send email to customer"""
-    email_id = f"EMAIL-{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    result = f"✓ Email sent to {recipient}. Subject: {subject}. ID: {email_id}"
-    state.actions_taken.append(result)
-    return result
-
-def track_shipment(order_id: str) -> str:
-    """Track package"""
-    tracking = {
-        "ORD-555": {"status": "In Transit", "location": "Chicago, IL", "eta": "2024-02-18"},
-        "ORD-789": {"status": "Delivered", "date": "2024-02-10"}
-    }
-    data = tracking.get(order_id, {"status": "Not Found", "message": "Check back in 24-48 hours"})
-    return json.dumps(data, indent=2)
+    Each parked ticket keeps a snapshot of its state and of the result it
+    would have had, so approving it finishes the ticket without running
+    any agent again. Status goes pending -> approved -> resolved, or
+    pending -> rejected; only one caller can move a ticket out of pending.
+    A ticket left approved (its actions failed before it was resolved)
+    can be approved again; the outbox keeps the retried actions from
+    running twice.
+    """
+    def __init__(self, path: str = "approvals.sqlite3"):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS approvals (
+            ticket_id TEXT PRIMARY KEY, status TEXT NOT NULL, reason TEXT,
+            customer_id TEXT, parked_at REAL NOT NULL, decided_at REAL,
+            decided_by TEXT, note TEXT, snapshot TEXT NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS approvals_status ON approvals (status, parked_at)")
+        self.db.commit()
+        self.lock = threading.Lock()
+        
+    def park(self, state: CustomerCareState, result: Dict):
+        """Store an escalated ticket; returns at once"""
+        snapshot = json.dumps({"state": state.to_dict(), "result": result}, separators=(",", ":"))
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO approvals (ticket_id, status, reason, customer_id, parked_at, snapshot) "
+                "VALUES (?, 'pending', ?, ?, ?, ?)",
+                (state.ticket_id, state.escalation_reason, state.customer_id, time.time(), snapshot))
+            self.db.commit()
+        
+    def pending(self, limit: int = 50) -> List[Dict]:
+        """Oldest tickets still waiting for a decision"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT ticket_id, reason, customer_id, parked_at FROM approvals "
+                "WHERE status = 'pending' ORDER BY parked_at LIMIT ?", (limit,)).fetchall()
+        return [{"ticket_id": ticket_id, "reason": reason, "customer_id": customer_id,
+                 "parked_at": datetime.fromtimestamp(parked_at).isoformat()}
+                for ticket_id, reason, customer_id, parked_at in rows]
+        
+    def decide(self, ticket_id: str, approved: bool, decided_by: str, note: str = "") -> Dict:
+        """Approve or reject a pending ticket; returns its snapshot
+        
+        An approved ticket that was never resolved may be approved again.
+        Raises KeyError if the ticket is unknown or already decided.
+        """
+        open_statuses = "('pending', 'approved')" if approved else "('pending')"
+        with self.lock:
+            updated = self.db.execute(
+                "UPDATE approvals SET status = ?, decided_at = ?, decided_by = ?, note = ? "
+                f"WHERE ticket_id = ? AND status IN {open_statuses}",
+                ("approved" if approved else "rejected", time.time(), decided_by, note, ticket_id))
+            self.db.commit()
+            if updated.rowcount != 1:
+                raise KeyError(f"No pending approval for ticket {ticket_id}")
+            row = self.db.execute("SELECT snapshot FROM approvals WHERE ticket_id = ?", (ticket_id,)).fetchone()
+        return json.loads(row[0])
+        
+    def resolve(self, ticket_id: str, state: CustomerCareState, result: Dict):
+        """Store the final state and result of an approved ticket"""
+        snapshot = json.dumps({"state": state.to_dict(), "result": result}, separators=(",", ":"))
+        with self.lock:
+            self.db.execute("UPDATE approvals SET status = 'resolved', snapshot = ? WHERE ticket_id = ?",
+                            (snapshot, ticket_id))
+            self.db.commit()
+        
+    def stats(self) -> Dict:
+        """Tickets per status"""
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM approvals GROUP BY status").fetchall())
+        
+    def close(self):
+        with self.lock:
+            self.db.close()
 
 # ============================================================================
-# AI AGENTS (Using OpenAI API Directly)
+# CHECKPOINT LOG
 # ============================================================================
 
-class SimpleAgent:
-    """Simple AI agent using OpenAI"""
+class CheckpointLog:
+    """Append-only log of each ticket's progress through the agent graph
     
-    def __init__(self, client: OpenAI, name: str, role: str, goal: str, instructions: str):
-        self.client = client
-        self.name = name
-        self.role = role
-        self.goal = goal
-        self.instructions = instructions
+    A record is written after every agent step. Records are framed as
+    [payload length][crc32][ticket id length][ticket id][zlib JSON]. A
+    writer thread appends them in batches with one fsync per batch, so
+    append() only costs a queue put. An empty payload marks a finished
+    ticket. On open, the record headers are scanned to find each ticket's
+    latest record, and a torn record at the end (from a crash) is cut off.
+    Once the file reaches compact_min_bytes and compact_growth times its
+    size after the last compaction, the writer rewrites it with only the
+    unfinished tickets' latest records, so it does not grow without limit.
+    """
+    HEADER = struct.Struct("<IIH")
+    
+    def __init__(self, path: str = "checkpoints.log", flush_interval: float = 0.02,
+                 max_batch: int = 1024, compact_min_bytes: int = 64 << 20, compact_growth: float = 2.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.compact_min_bytes = compact_min_bytes
+        self.compact_growth = compact_growth
+        self.index = {}   # ticket id -> offset of its latest record (absent once finished)
+        self.queued = {}  # ticket id -> its latest payload not yet on disk
+        self.lock = threading.Lock()   # Held while writing to the file
+        self.queued_lock = threading.Lock()
+        self.counters = {"records": 0, "batches": 0, "bytes": 0, "fsync_s": 0.0, "compactions": 0}
+        self._scan()
+        self.file = open(path, "ab")
+        self.compacted_size = self.file.tell()   # Size after the last compaction (or on open)
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, name="checkpoint-writer", daemon=True)
+        self.writer.start()
         
-    def run(self, task: str, context: str = "") -> str:
-        """Run agent with a task"""
-        system_prompt = f"""You are {self.role}.
-
-Your goal: {self.goal}
-
-Instructions: {self.instructions}
-
-Context from previous agents:
-{context}
-
-Be concise but thorough. Format your response clearly."""
-
-        try:
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": task}
-                ],
-                temperature=0.7,
-                max_tokens=500
-            )
-            
-            result = response.choices[0].message.content
-            state.log(self.name, task[:100], result)
-            return result
-            
-        except Exception as e:
-            error_msg = f"Error: {str(e)}"
-            state.log(self.name, task[:100], error_msg)
-            return error_msg
+    def _scan(self):
+        """Index the existing log and drop a torn last record"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r+b") as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset + self.HEADER.size <= size:
+                f.seek(offset)
+                length, _, id_length = self.HEADER.unpack(f.read(self.HEADER.size))
+                end = offset + self.HEADER.size + id_length + length
+                if end > size:
+                    break
+                ticket_id = f.read(id_length).decode("utf-8")
+                if length:
+                    self.index[ticket_id] = offset
+                else:
+                    self.index.pop(ticket_id, None)
+                offset = end
+            if offset < size:
+                f.truncate(offset)
+        
+    def _encode(self, ticket_id: str, payload: bytes) -> bytes:
+        ticket = ticket_id.encode("utf-8")
+        return self.HEADER.pack(len(payload), zlib.crc32(payload), len(ticket)) + ticket + payload
+        
+    def append(self, ticket_id: str, checkpoint: Dict):
+        """Queue a checkpoint for the ticket (returns without waiting for disk)"""
+        payload = zlib.compress(json.dumps(checkpoint, separators=(",", ":")).encode("utf-8"), 1)
+        self._enqueue(ticket_id, payload)
+        
+    def finish(self, ticket_id: str):
+        """Mark the ticket done; it will not be resumed"""
+        self._enqueue(ticket_id, b"")
+        
+    def _enqueue(self, ticket_id: str, payload: bytes):
+        with self.queued_lock:
+            self.queued[ticket_id] = payload
+        self.queue.put((ticket_id, payload))
+        
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            batch = [item]
+            # Group commit: gather what arrives shortly after, then one fsync
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)   # Handle the stop request after this batch
+                    self.queue.task_done()
+                    break
+                batch.append(item)
+            self._write(batch)
+            for _ in batch:
+                self.queue.task_done()
+        
+    def _write(self, batch: List[Tuple[str, bytes]]):
+        with self.lock:
+            offset = self.file.tell()
+            chunks = []
+            for ticket_id, payload in batch:
+                record = self._encode(ticket_id, payload)
+                if payload:
+                    self.index[ticket_id] = offset
+                else:
+                    self.index.pop(ticket_id, None)
+                offset += len(record)
+                chunks.append(record)
+            data = b"".join(chunks)
+            self.file.write(data)
+            self.file.flush()
+            started = time.perf_counter()
+            os.fsync(self.file.fileno())
+            self.counters["fsync_s"] += time.perf_counter() - started
+            self.counters["records"] += len(batch)
+            self.counters["batches"] += 1
+            self.counters["bytes"] += len(data)
+            if offset >= max(self.compact_min_bytes, self.compact_growth * self.compacted_size):
+                self._compact()
+        with self.queued_lock:
+            for ticket_id, payload in batch:
+                if self.queued.get(ticket_id) is payload:
+                    del self.queued[ticket_id]
+        
+    def flush(self):
+        """Wait until every queued checkpoint is on disk"""
+        self.queue.join()
+        
+    def latest(self, ticket_id: str) -> Optional[Dict]:
+        """The ticket's last checkpoint, or None if it has none or finished"""
+        with self.queued_lock:
+            payload = self.queued.get(ticket_id)
+        if payload is not None:
+            # Not on disk yet; no need to wait for the writer
+            return json.loads(zlib.decompress(payload)) if payload else None
+        with self.lock:
+            offset = self.index.get(ticket_id)
+            if offset is None:
+                return None
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                length, crc, id_length = self.HEADER.unpack(f.read(self.HEADER.size))
+                f.seek(id_length, 1)
+                payload = f.read(length)
+        if zlib.crc32(payload) != crc:
+            raise ValueError(f"Checkpoint for ticket {ticket_id} is corrupt")
+        return json.loads(zlib.decompress(payload))
+        
+    def unfinished(self) -> List[str]:
+        """Tickets with checkpoints that never finished (e.g. after a crash)"""
+        self.flush()
+        with self.lock:
+            return list(self.index)
+        
+    def compact(self):
+        """Rewrite the log with only the latest record of each unfinished ticket"""
+        self.flush()
+        with self.lock:
+            self._compact()
+        
+    def _compact(self):
+        """compact() with self.lock held and nothing half-written"""
+        records = []
+        with open(self.path, "rb") as f:
+            for ticket_id, offset in self.index.items():
+                f.seek(offset)
+                length, _, id_length = self.HEADER.unpack(f.read(self.HEADER.size))
+                f.seek(id_length, 1)
+                records.append((ticket_id, f.read(length)))
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as f:
+            offset = 0
+            for ticket_id, payload in records:
+                record = self._encode(ticket_id, payload)
+                self.index[ticket_id] = offset
+                offset += len(record)
+                f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(temporary, self.path)
+        self.file = open(self.path, "ab")
+        self.compacted_size = offset
+        self.counters["compactions"] += 1
+        
+    def stats(self) -> Dict:
+        """Records, batches, bytes and fsync time so far"""
+        with self.lock:
+            counters = dict(self.counters)
+            unfinished = len(self.index)
+        batches = counters["batches"]
+        return {
+            "records": counters["records"],
+            "batches": batches,
+            "mean_batch": round(counters["records"] / batches, 1) if batches else 0.0,
+            "bytes": counters["bytes"],
+            "mean_record_bytes": round(counters["bytes"] / counters["records"]) if counters["records"] else 0,
+            "mean_fsync_ms": round(1000 * counters["fsync_s"] / batches, 3) if batches else 0.0,
+            "unfinished_tickets": unfinished,
+            "compactions": counters["compactions"]
+        }
+        
+    def close(self):
+        """Write what is queued and stop the writer"""
+        self.queue.put(None)
+        self.writer.join()
+        self.file.close()
 
 # ============================================================================
 # MULTI-AGENT SYSTEM
@@ -231,9 +3332,77 @@ Be concise but thorough. Format your response clearly."""
 class CustomerCareSystem:
     """Main multi-agent customer care system"""
     
-    def __init__(self, api_key: str):
-        """Initialize system with API key"""
-        self.client = OpenAI(api_key=api_key)
+    def __init__(self, api_key: str, verbose: bool = True, max_connections: int = 100,
+                 agent_workers: int = 16, cache: Optional[ResponseCache] = None,
+                 intent_cache: Optional["SemanticIntentCache"] = None,
+                 fast_path: Optional["FastPathClassifier"] = None,
+                 knowledge_base_path: Optional[str] = None,
+                 customer_db_path: Optional[str] = None,
+                 context_budgets: Optional[Dict[str, int]] = None, compact_context: bool = True,
+                 resilience: Optional[ResilientClient] = None,
+                 routing: Optional[RoutingPolicy] = None, route_models: bool = True,
+                 early_exit: Optional[EarlyExitPolicy] = None,
+                 speculation: Optional[SpeculationPolicy] = None,
+                 approval_queue: Optional[ApprovalQueue] = None,
+                 checkpoints: Optional[CheckpointLog] = None,
+                 outbox: Optional[ActionOutbox] = None):
+        """Initialize system with API key
+        
+        Pass a ResponseCache to reuse answers for identical agent calls, and
+        a SemanticIntentCache and/or FastPathClassifier to skip the Greeter
+        when the query can be classified locally. knowledge_base_path loads
+        the policy corpus (JSONL file or directory) once, up front, and
+        customer_db_path opens a SQLite file of customers and orders.
+        Agents get only the context fields they need, trimmed to
+        context_budgets tokens per agent, unless compact_context is False.
+        Every API call goes through resilience (a default ResilientClient
+        if not given) for timeouts, retries and rate limiting. Each agent's
+        model, max_tokens and temperature come from routing (a default
+        RoutingPolicy) unless route_models is False. An EarlyExitPolicy
+        lets simple, confidently classified tickets skip agents, and a
+        SpeculationPolicy starts the Researcher on a predicted intent
+        while the Greeter runs. Escalated
+        tickets are parked in approval_queue (by default a SQLite file at
+        CUSTOMER_CARE_APPROVALS_PATH or approvals.sqlite3). With a
+        CheckpointLog, every agent step is checkpointed and an interrupted
+        ticket continues where it stopped when run again with its ticket_id.
+        Refunds and emails go through outbox (by default an ActionOutbox
+        at CUSTOMER_CARE_OUTBOX_PATH or outbox.sqlite3).
+        """
+        if knowledge_base_path:
+            set_knowledge_base(KnowledgeBase.from_path(knowledge_base_path))
+        get_knowledge_base()
+        if customer_db_path:
+            set_customer_store(CustomerStore(customer_db_path))
+        if outbox is not None:
+            set_outbox(outbox)
+        # Retries are done by self.resilience, not the SDK
+        self.client = OpenAI(api_key=api_key, max_retries=0)
+        self.resilience = resilience or ResilientClient()
+        # Agents of every blocking query share this pool
+        self.agent_pool = ThreadPoolExecutor(max_workers=agent_workers,
+                                             thread_name_prefix="agent")
+        # One async client (and connection pool) shared by every async query
+        self.async_client = AsyncOpenAI(
+            api_key=api_key,
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            ))
+        )
+        self.verbose = verbose
+        self.last_batch_stats = None
+        self.cache = cache
+        self.intent_cache = intent_cache
+        self.fast_path = fast_path
+        self.compactor = ContextCompactor(context_budgets) if compact_context else None
+        self.routing = (routing or RoutingPolicy()) if route_models else None
+        self.early_exit = early_exit
+        self.speculation = speculation
+        self._approvals = approval_queue
+        self.approvals_lock = threading.Lock()
+        self.checkpoints = checkpoints
         
         # Create 7 specialized agents
         self.agents = {
@@ -247,7 +3416,9 @@ class CustomerCareSystem:
                 - INTENT: (REFUND, RETURN, SHIPPING, TRACKING, ACCOUNT, BILLING, OTHER)
                 - SENTIMENT: (POSITIVE, NEUTRAL, NEGATIVE, URGENT)
                 - PRIORITY: (LOW, MEDIUM, HIGH, CRITICAL)
-                - SUMMARY: What customer needs in 1-2 sentences"""
+                - SUMMARY: What customer needs in 1-2 sentences
+                - CONFIDENCE: How sure you are of the intent, 0.0 to 1.0""",
+                schema=GreeterOutput
             ),
             
             "researcher": SimpleAgent(
@@ -259,7 +3430,9 @@ class CustomerCareSystem:
                 - Search knowledge base for policies
                 - Look up customer details
                 - Track shipments if relevant
-                Provide relevant findings to support the solution."""
+                Only call the tools that are relevant; you may call several at once.
+                Provide relevant findings to support the solution.""",
+                tools=("search_knowledge_base", "lookup_customer", "track_shipment")
             ),
             
             "tone_adapter": SimpleAgent(
@@ -283,7 +3456,10 @@ class CustomerCareSystem:
                 - Process refunds (flag if over $100)
                 - Send emails
                 - Track packages
-                List specific actions needed."""
+                Take the actions with your tools, using the order ids, amounts
+                and email addresses from the context. List the actions taken.""",
+                cacheable=False,  # Its answer triggers refunds and emails
+                tools=("process_refund", "send_email", "track_shipment", "lookup_customer")
             ),
             
             "quality": SimpleAgent(
@@ -296,7 +3472,8 @@ class CustomerCareSystem:
                 - Is information accurate?
                 - Is tone appropriate?
                 - Are all steps complete?
-                Provide: APPROVED/NEEDS_REVISION and score (1-10)"""
+                Provide: APPROVED/NEEDS_REVISION and score (1-10)""",
+                schema=QualityOutput
             ),
             
             "escalation": SimpleAgent(
@@ -309,7 +3486,9 @@ class CustomerCareSystem:
                 - Policy exceptions
                 - VIP customers
                 - Complex issues
-                Provide: ESCALATE/NO_ESCALATION and reason"""
+                Provide: ESCALATE/NO_ESCALATION and reason""",
+                cacheable=False,  # Escalation must be judged fresh every time
+                schema=EscalationOutput
             ),
             
             "followup": SimpleAgent(
@@ -321,17 +3500,169 @@ class CustomerCareSystem:
                 - Delivery confirmations
                 - Satisfaction checks
                 - VIP relationship building
-                Provide: FOLLOW_UP/NO_FOLLOW_UP with timing"""
+                Provide: FOLLOW_UP/NO_FOLLOW_UP with timing""",
+                schema=FollowUpOutput
             )
         }
     
-    def handle_query(self, customer_query: str, customer_id: str = None) -> Dict:
-        """Process customer query through all agents"""
+        for agent in self.agents.values():
+            agent.cache = cache
+        
+        self.async_agents = {
+            key: AsyncSimpleAgent(self.async_client, agent.name, agent.role,
+                                  agent.goal, agent.instructions,
+                                  cache, agent.cacheable, agent.schema,
+                                  tools=agent.tools)
+            for key, agent in self.agents.items()
+        }
+        # Every agent's static prompt prefix is built once, here
+        self.prompts = PromptRegistry()
+        for agent in list(self.agents.values()) + list(self.async_agents.values()):
+            agent.resilience = self.resilience
+            self.prompts.compile(agent)
+    
+    def handle_query(self, customer_query: str, customer_id: str = None,
+                     verbose: Optional[bool] = None,
+                     on_token: Optional[Callable[[str], None]] = None,
+                     on_reply: Optional[Callable[[str], None]] = None,
+                     ticket_id: Optional[str] = None) -> Dict:
+        """Process customer query through all agents
+        
+        Every call gets its own CustomerCareState, so queries can run in
+        parallel threads. Agents whose inputs are ready run concurrently on
+        the shared agent pool. Refunds that need human approval are parked
+        in the approval queue and returned as ESCALATED; see approve().
+        If the ticket_id has an unfinished checkpoint, the agents it
+        already ran are not run again.
+        
+        on_token receives the customer's reply (the Tone Adapter's draft)
+        token by token as it is generated, and on_reply the whole reply;
+        both are called from agent threads while later agents still run.
+        """
+        state, checkpoint = self._resume_point(ticket_id)
+        token = _current_state.set(state)
+        try:
+            run = self._start_run(state, customer_query, customer_id,
+                                  self.verbose if verbose is None else verbose,
+                                  on_token, on_reply, ticket_id, checkpoint)
+            pending = {}
+            while not run.finished:
+                for node, task, context in run.ready():
+                    future = run.claim_speculation(node)
+                    if future is None:
+                        agent = self.agents[node.key]
+                        # Copy the context so the agent thread sees this query's state
+                        future = self.agent_pool.submit(contextvars.copy_context().run,
+                                                        _timed_call, agent.run, task, context,
+                                                        **run.agent_kwargs(node))
+                    pending[future] = node
+                speculative = run.speculate()
+                if speculative is not None:
+                    node, task, context, guess, kwargs = speculative
+                    run.speculation["future"] = self.agent_pool.submit(
+                        contextvars.copy_context().run, _call_in_state, guess,
+                        _timed_call, self.agents[node.key].run, task, context, **kwargs)
+                if not pending:
+                    raise RuntimeError("Agent graph has dependencies that can never be met")
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    run.complete(pending.pop(future), *future.result())
+            return self._finish(run)
+        finally:
+            _current_state.reset(token)
+    
+    async def handle_query_async(self, customer_query: str, customer_id: str = None,
+                                 verbose: Optional[bool] = None,
+                                 on_token: Optional[Callable[[str], None]] = None,
+                                 on_reply: Optional[Callable[[str], None]] = None,
+                                 ticket_id: Optional[str] = None) -> Dict:
+        """Process customer query through all agents on the running event loop
+        
+        Uses the shared AsyncOpenAI client, so hundreds of queries can be in
+        flight at once (e.g. with asyncio.gather). Escalations, on_token and
+        on_reply work as in handle_query().
+        """
+        state, checkpoint = self._resume_point(ticket_id)
+        token = _current_state.set(state)
+        try:
+            run = self._start_run(state, customer_query, customer_id,
+                                  self.verbose if verbose is None else verbose,
+                                  on_token, on_reply, ticket_id, checkpoint)
+            pending = {}
+            while not run.finished:
+                for node, task, context in run.ready():
+                    future = run.claim_speculation(node)
+                    if future is None:
+                        agent = self.async_agents[node.key]
+                        call = _timed_call_async(agent.run, task, context, **run.agent_kwargs(node))
+                        future = asyncio.ensure_future(call)
+                    pending[future] = node
+                speculative = run.speculate()
+                if speculative is not None:
+                    node, task, context, guess, kwargs = speculative
+                    call = _timed_call_async(self.async_agents[node.key].run, task, context, **kwargs)
+                    run.speculation["future"] = asyncio.ensure_future(_await_in_state(guess, call))
+                if not pending:
+                    raise RuntimeError("Agent graph has dependencies that can never be met")
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    run.complete(pending.pop(future), *future.result())
+            return self._finish(run)
+        finally:
+            _current_state.reset(token)
+    
+    async def aclose(self):
+        """Close the shared async connection pool"""
+        await self.async_client.close()
+    
+    def stream_query(self, customer_query: str, customer_id: str = None,
+                     verbose: bool = False) -> Tuple[Iterator[str], Future]:
+        """Start a query in the background and stream the customer's reply
+        
+        Returns (tokens, result): iterating tokens yields the reply as it is
+        generated and stops once the reply is complete; result is a Future
+        for the handle_query() result, which resolves after the remaining
+        agents finish. Never prompts for approval.
+        """
+        tokens = queue.Queue()
+        result = Future()
+        done = object()
+        
+        def run_query():
+            try:
+                result.set_result(self.handle_query(customer_query, customer_id,
+                                                    verbose=verbose, on_token=tokens.put,
+                                                    on_reply=lambda reply: tokens.put(done)))
+            except BaseException as e:
+                result.set_exception(e)
+            finally:
+                tokens.put(done)  # In case the reply never came
+        
+        threading.Thread(target=run_query, name="stream-query", daemon=True).start()
+        
+        def reply_tokens():
+            while True:
+                token = tokens.get()
+                if token is done:
+                    return
+                yield token
+        return reply_tokens(), result
+    
+    def _start_run(self, state: CustomerCareState, customer_query: str,
+                   customer_id: Optional[str], verbose: bool,
+                   on_token: Optional[Callable[[str], None]] = None,
+                   on_reply: Optional[Callable[[str], None]] = None,
+                   ticket_id: Optional[str] = None,
+                   checkpoint: Optional[Dict] = None) -> "PipelineRun":
+        """Fill in the query and print the inquiry banner"""
+        print = builtins.print if verbose else _silent_print
         
-        # Reset state
-        state.reset()
         state.customer_query = customer_query
         state.customer_id = customer_id or "Unknown"
+        state.ticket_id = ticket_id or f"TKT-{uuid.uuid4().hex[:16]}"
+        if customer_id and not state.customer_info:
+            # Local and cheap; the routing policy needs the tier from the start
+            state.customer_info = get_customer_store().get_customer(customer_id)
         
         print("\n" + "="*80)
         print("🎯 NEW CUSTOMER INQUIRY")
@@ -341,154 +3672,688 @@ class CustomerCareSystem:
             print(f"Customer ID: {customer_id}")
         print("="*80 + "\n")
         
-        # Build context as we go
         context = f"Customer Query: {customer_query}\n"
         if customer_id:
             context += f"Customer ID: {customer_id}\n"
         
-        # AGENT 1: Greeter
-        print("🤝 Agent 1: Greeter & Intent Classifier")
-        print("-" * 80)
-        greeting_result = self.agents["greeter"].run(
-            f"Analyze this customer query: {customer_query}",
-            context
-        )
-        print(greeting_result)
-        print()
-        
-        # Extract intent and sentiment
-        if "INTENT:" in greeting_result:
-            state.intent = greeting_result.split("INTENT:")[1].split("\n")[0].strip()
-        if "SENTIMENT:" in greeting_result:
-            state.sentiment = greeting_result.split("SENTIMENT:")[1].split("\n")[0].strip()
-        if "PRIORITY:" in greeting_result:
-            state.priority = greeting_result.split("PRIORITY:")[1].split("\n")[0].strip()
+        run = PipelineRun(self, state, context, print, on_token, on_reply)
+        if checkpoint is not None:
+            run.restore(checkpoint)
+            print(f"♻️  Resuming ticket {state.ticket_id} after: {', '.join(checkpoint['outputs'])}\n")
+        return run
+    
+    def _resume_point(self, ticket_id: Optional[str]) -> Tuple[CustomerCareState, Optional[Dict]]:
+        """A fresh state, or the checkpointed one if the ticket was interrupted"""
+        if self.checkpoints is None or not ticket_id:
+            return CustomerCareState(), None
+        checkpoint = self.checkpoints.latest(ticket_id)
+        if checkpoint is None:
+            return CustomerCareState(), None
+        return CustomerCareState.from_dict(checkpoint["state"]), checkpoint
+    
+    def resume(self, ticket_id: str, verbose: Optional[bool] = None) -> Dict:
+        """Continue an interrupted ticket from its last checkpoint
         
-        context += f"\n{greeting_result}\n"
+        Raises KeyError if the ticket has no unfinished checkpoint.
+        """
+        checkpoint = self.checkpoints.latest(ticket_id) if self.checkpoints is not None else None
+        if checkpoint is None:
+            raise KeyError(f"No unfinished checkpoint for ticket {ticket_id}")
+        state = checkpoint["state"]
+        customer_id = state["customer_id"] if state["customer_id"] != "Unknown" else None
+        return self.handle_query(state["customer_query"], customer_id, verbose=verbose, ticket_id=ticket_id)
+    
+    # ------------------------------------------------------------------
+    # Steps around the agents (referenced by name from AGENT_GRAPH)
+    # ------------------------------------------------------------------
+    
+    def _apply_greeting(self, state: CustomerCareState, greeting: Optional[GreeterOutput], print):
+        """Record intent, sentiment and priority"""
+        if greeting is None:
+            return
+        state.intent = greeting.intent
+        state.sentiment = greeting.sentiment
+        state.priority = greeting.priority
+        state.intent_confidence = greeting.confidence
         
-        # AGENT 2: Researcher
-        print("🔍 Agent 2: Knowledge Researcher")
-        print("-" * 80)
+        if not state.intent_source:
+            state.intent_source = "llm"
+            if self.intent_cache is not None and state.intent:
+                self.intent_cache.add(state.customer_query, {
+                    "intent": state.intent,
+                    "sentiment": state.sentiment,
+                    "priority": state.priority,
+                    "confidence": state.intent_confidence
+                })
+    
+    def _classify_locally(self, state: CustomerCareState) -> Optional[str]:
+        """Classify without the Greeter when a local stage is confident
         
-        # Call tools based on intent
-        if state.intent and "REFUND" in state.intent:
-            kb_result = search_knowledge_base("refund")
-            print(f"📚 Knowledge Base: {kb_result}")
+        Tries the semantic cache of earlier LLM classifications first,
+        then the local fast-path classifier.
+        """
+        if self.intent_cache is not None:
+            match = self.intent_cache.lookup(state.customer_query)
+            if match is not None:
+                state.intent_source = "semantic_cache"
+                return format_classification(match, state.customer_query)
         
-        if customer_id:
-            cust_result = lookup_customer(customer_id)
+        if self.fast_path is not None:
+            match = self.fast_path.classify(state.customer_query)
+            if match is not None:
+                state.intent_source = "local_classifier"
+                return format_classification(match, state.customer_query)
+        return None
+    
+    def _gather_research(self, state: CustomerCareState, print) -> str:
+        """Look up the customer; returns extra context for the Researcher"""
+        context = ""
+        if state.customer_id != "Unknown":
+            if not state.customer_info:
+                state.customer_info = get_customer_store().get_customer(state.customer_id)
+            cust_result = json.dumps(state.customer_info)
             print(f"👤 Customer Info: {cust_result}")
-            state.customer_info = json.loads(cust_result)
             context += f"\nCustomer Info: {cust_result}\n"
-        
-        research_task = f"Based on the intent '{state.intent}', what information do we need to resolve this?"
-        research_result = self.agents["researcher"].run(research_task, context)
-        print(research_result)
-        print()
-        
-        context += f"\n{research_result}\n"
-        
-        # AGENT 3: Tone Adapter
-        print("💙 Agent 3: Empathy & Tone Adapter")
-        print("-" * 80)
-        tone_task = f"Craft an empathetic response for a customer with {state.sentiment} sentiment."
-        tone_result = self.agents["tone_adapter"].run(tone_task, context)
-        print(tone_result)
-        print()
-        
+        return context
+    
+    def _apply_tone(self, state: CustomerCareState, tone_result: str, print):
+        """The Tone Adapter's draft is what the customer sees"""
         state.final_message = tone_result
-        context += f"\n{tone_result}\n"
-        
-        # AGENT 4: Resolver
-        print("🛠️  Agent 4: Problem Resolver")
-        print("-" * 80)
-        resolver_task = "What specific actions should we take to resolve this issue?"
-        resolver_result = self.agents["resolver"].run(resolver_task, context)
-        print(resolver_result)
-        
-        # Execute actions based on resolver's decision
-        if "refund" in resolver_result.lower() and "ORD-" in customer_query:
-            # Extract order ID and amount
-            order_id = "ORD-789"  # Simplified
-            amount = 85.0  # Would extract from query
-            if "1500" in customer_query or "$1,500" in customer_query:
-                amount = 1500.0
-            
-            action_result = process_refund(order_id, amount, state.intent)
-            print(f"   {action_result}")
-            
-        if "email" in resolver_result.lower():
-            email = state.customer_info.get("email", "customer@email.com")
-            email_result = send_email(email, f"Re: Your {state.intent} Request")
-            print(f"   {email_result}")
-        
-        print()
-        context += f"\n{resolver_result}\n"
-        
-        # AGENT 5: Quality Reviewer
-        print("✅ Agent 5: Quality Reviewer")
-        print("-" * 80)
-        quality_task = "Review this entire interaction for quality, accuracy, and completeness."
-        quality_result = self.agents["quality"].run(quality_task, context)
-        print(quality_result)
-        print()
-        
-        # Extract quality score
-        if "/10" in quality_result:
-            try:
-                score_text = quality_result.split("/10")[0].split()[-1]
-                state.quality_score = int(score_text)
-            except:
-                state.quality_score = 8
+    
+    def _apply_resolution(self, state: CustomerCareState, resolver_result: str, print):
+        """Carry out the Resolver's actions, unless the ticket waits for a human"""
+        if not state.requires_human:
+            self._carry_out(state)
+        for action in state.actions_taken:
+            print(f"   {action}")
+        for action in state.pending_actions:
+            print(f"   ⏸️  Held: {action['tool']} {action['arguments']}")
+    
+    def _carry_out(self, state: CustomerCareState):
+        """Send a ticket's held actions to the outbox and clear them
         
-        # AGENT 6: Escalation Coordinator
-        print("🚨 Agent 6: Escalation Coordinator")
-        print("-" * 80)
-        escalation_task = "Should this be escalated to a human?"
-        escalation_result = self.agents["escalation"].run(escalation_task, context)
-        print(escalation_result)
-        print()
+        If one raises, the rest stay held; the outbox idempotency keys make
+        running them again safe.
+        """
+        token = _current_state.set(state)
+        try:
+            while state.pending_actions:
+                action = state.pending_actions[0]
+                done = HELD_ACTIONS[action["tool"]](**action["arguments"])
+                if done not in state.actions_taken:   # A retry finds it already submitted
+                    state.actions_taken.append(done)
+                state.pending_actions.pop(0)
+        finally:
+            _current_state.reset(token)
+    
+    def _apply_quality(self, state: CustomerCareState, review: Optional[QualityOutput], print):
+        """Record the quality score"""
+        if review is not None:
+            state.quality_score = review.score
+            state.quality_feedback = review.feedback
+    
+    def _apply_escalation(self, state: CustomerCareState, decision: Optional[EscalationOutput], print):
+        """Record the escalation recommendation"""
+        if decision is not None:
+            state.escalation_recommended = decision.escalate
+    
+    def _apply_followup(self, state: CustomerCareState, plan: Optional[FollowUpOutput], print):
+        """Record whether a follow-up is needed"""
+        if plan is not None:
+            state.follow_up_needed = plan.follow_up
+    
+    def structured_output_stats(self) -> Dict:
+        """Parse failures and re-asks of the structured agents"""
+        stats = {}
+        for key, agent in self.agents.items():
+            if agent.schema is None:
+                continue
+            counts = dict(agent.parse_stats)
+            async_counts = self.async_agents[key].parse_stats
+            for counter in counts:
+                counts[counter] += async_counts[counter]
+            counts["parse_failure_rate"] = (round(counts["parse_failures"] / counts["calls"], 3)
+                                            if counts["calls"] else 0.0)
+            stats[key] = counts
+        return stats
+    
+    def tool_stats(self) -> Dict:
+        """Calls, errors and latency per tool"""
+        return TOOLS.report()
+    
+    def traces(self, trace_id: Optional[str] = None) -> List[TraceRecord]:
+        """Buffered trace records, oldest first (optionally of one query)"""
+        return TRACES.records(trace_id)
+    
+    def export_traces(self, path: str = "traces.jsonl", trace_id: Optional[str] = None) -> int:
+        """Append buffered spans to a JSONL file; returns how many were written"""
+        return TRACES.export_jsonl(path, trace_id)
+    
+    def early_exit_stats(self) -> Dict:
+        """Agent calls skipped and latency saved per intent"""
+        return self.early_exit.stats() if self.early_exit is not None else {}
+    
+    def outbox_stats(self) -> Dict:
+        """Depth, batch sizes and dispatch latency of the action outbox (once it is open)"""
+        return _outbox.stats() if _outbox is not None else {}
+    
+    def speculation_stats(self) -> Dict:
+        """Speculation hit rate, latency saved and tokens spent on discarded runs"""
+        return self.speculation.stats() if self.speculation is not None else {}
+    
+    def routing_stats(self) -> Dict:
+        """Calls, latency and estimated cost per routed model"""
+        return self.routing.stats() if self.routing is not None else {}
+    
+    def prompt_cache_stats(self) -> Dict:
+        """Prompt tokens per agent and the share the API served from its prompt cache"""
+        report = {}
+        for key, agent in self.agents.items():
+            totals = dict(agent.token_stats)
+            for counter, value in self.async_agents[key].token_stats.items():
+                totals[counter] += value
+            totals["cached_share"] = (round(totals["cached_tokens"] / totals["prompt_tokens"], 3)
+                                      if totals["prompt_tokens"] else 0.0)
+            totals["prefix_chars"] = len(agent.prompt.system_prompt)
+            report[key] = totals
+        return report
+    
+    def client_stats(self) -> Dict:
+        """Retries, throttling and circuit state of the LLM calls"""
+        return self.resilience.report()
+    
+    def _finish(self, run: "PipelineRun") -> Dict:
+        """Final result; tickets that need a human are parked for approval"""
+        state, print = run.state, run.print
+        schedule = run.schedule()
+        context_tokens = run.context_report()
+        print(f"⏱️  Wall time {schedule['wall_time_s']}s | critical path "
+              f"{' → '.join(schedule['critical_path'])} ({schedule['critical_path_s']}s)")
+        if schedule["first_token_s"] is not None:
+            print(f"💬 First reply token after {schedule['first_token_s']}s, "
+                  f"reply complete after {schedule['reply_s']}s")
+        print(f"🧮 Context tokens: {context_tokens['sent_tokens']} sent, "
+              f"{context_tokens['tokens_saved']} saved")
+        early_exit = None
+        if self.early_exit is not None:
+            early_exit = run.early_exit_report()
+            self.early_exit.record(state.intent, early_exit["skipped"], early_exit["seconds_saved"])
+            if early_exit["skipped"]:
+                print(f"⏭️  Skipped {', '.join(early_exit['skipped'])} for a simple {state.intent} "
+                      f"ticket (confidence {state.intent_confidence:.2f}), ~{early_exit['seconds_saved']}s saved")
+        speculation = run.speculation_report()
+        if speculation is not None and speculation["hit"]:
+            print(f"🔮 Speculative {speculation['agent']} on {speculation['predicted_intent']} was right, "
+                  f"~{speculation['seconds_saved']}s saved")
+        if state.routing:
+            cost = sum(decision["cost_usd"] for decision in state.routing.values())
+            baseline = sum(decision["baseline_cost_usd"] for decision in state.routing.values())
+            print(f"🧭 Estimated cost ${cost:.4f} (${baseline:.4f} if every agent used "
+                  f"{self.routing.baseline_model})")
         
-        # AGENT 7: Follow-up Scheduler
-        print("📅 Agent 7: Follow-up Scheduler")
-        print("-" * 80)
-        followup_task = "Should we schedule a follow-up with this customer?"
-        followup_result = self.agents["followup"].run(followup_task, context)
-        print(followup_result)
-        print()
+        result = {
+            "status": "RESOLVED",
+            "ticket_id": state.ticket_id,
+            "intent": state.intent,
+            "sentiment": state.sentiment,
+            "priority": state.priority,
+            "intent_source": state.intent_source,
+            "actions_taken": state.actions_taken,
+            "quality_score": state.quality_score,
+            "requires_human": state.requires_human,
+            "follow_up_needed": state.follow_up_needed,
+            "escalation_recommended": state.escalation_recommended,
+            "parse_failures": state.parse_failures,
+            "tool_calls": state.tool_calls,
+            "agent_errors": state.agent_errors,
+            "usage": state.usage,
+            "routing": state.routing,
+            "early_exit": early_exit,
+            "speculation": speculation,
+            "trace_id": state.trace_id,
+            "schedule": schedule,
+            "context_tokens": context_tokens
+        }
         
-        if "FOLLOW_UP" in followup_result and "NO_FOLLOW_UP" not in followup_result:
-            state.follow_up_needed = True
+        if self.checkpoints is not None:
+            self.checkpoints.finish(state.ticket_id)
+        TRACES.add(TraceRecord("ticket", "handle_query", state.trace_id, "", state.ticket_id,
+                               run.started_ns, time.monotonic_ns(),
+                               "error" if state.agent_errors else "ok",
+                               detail=f"{state.intent} ticket, {len(state.usage)} agents called",
+                               span_id=state.span_id))
         
         # Check for human escalation
         if state.requires_human:
             print("\n⚠️  HUMAN ESCALATION REQUIRED")
             print(f"Reason: {state.escalation_reason}")
-            print("\n⏸️  Would pause here for human approval...")
-            approval = input("\nApprove? (yes/no): ").strip().lower()
-            if approval not in ['yes', 'y']:
-                return {
-                    "status": "ESCALATED",
-                    "requires_human": True,
-                    "reason": state.escalation_reason
-                }
+            result.update(status="ESCALATED", reason=state.escalation_reason)
+            self.approvals.park(state, result)
+            print(f"⏸️  Ticket {state.ticket_id} parked for approval")
+            return result
         
         # Final summary
         print("\n" + "="*80)
         print("✅ RESOLUTION COMPLETE")
         print("="*80)
+        return result
+    
+    @property
+    def approvals(self) -> ApprovalQueue:
+        """The approval queue, opened when first needed"""
+        with self.approvals_lock:
+            if self._approvals is None:
+                self._approvals = ApprovalQueue(os.getenv("CUSTOMER_CARE_APPROVALS_PATH", "approvals.sqlite3"))
+        return self._approvals
+    
+    def pending_approvals(self, limit: int = 50) -> List[Dict]:
+        """Escalated tickets waiting for a human decision, oldest first"""
+        return self.approvals.pending(limit)
+    
+    def approve(self, ticket_id: str, approved_by: str = "human", note: str = "") -> Dict:
+        """Approve a parked ticket and finish it from its snapshot
         
-        return {
-            "status": "RESOLVED",
-            "intent": state.intent,
-            "sentiment": state.sentiment,
-            "priority": state.priority,
-            "actions_taken": state.actions_taken,
-            "quality_score": state.quality_score,
-            "requires_human": state.requires_human,
-            "follow_up_needed": state.follow_up_needed,
-            "interaction_log": state.interaction_log
+        The held actions (the large refund and the Resolver's emails) are
+        carried out; no agent runs again. The ticket is only resolved once
+        they all succeed; if one raises, the ticket stays approved and
+        approve() can be called again. Raises KeyError if the ticket is not
+        pending or approved.
+        """
+        snapshot = self.approvals.decide(ticket_id, True, approved_by, note)
+        state = CustomerCareState.from_dict(snapshot["state"])
+        self._carry_out(state)
+        
+        result = dict(snapshot["result"], status="RESOLVED", actions_taken=state.actions_taken,
+                      approval={"approved": True, "by": approved_by, "note": note})
+        result.pop("reason", None)
+        self.approvals.resolve(ticket_id, state, result)
+        return result
+    
+    def reject(self, ticket_id: str, rejected_by: str = "human", note: str = "") -> Dict:
+        """Reject a parked ticket; its held actions (refunds and emails) are dropped"""
+        snapshot = self.approvals.decide(ticket_id, False, rejected_by, note)
+        return dict(snapshot["result"], status="REJECTED",
+                    approval={"approved": False, "by": rejected_by, "note": note})
+    
+    def handle_batch(self, queries: Iterable[Tuple[str, Optional[str]]],
+                     max_workers: int = 8) -> Iterator[Dict]:
+        """Process many (query, customer_id) pairs concurrently
+        
+        A third item, if given, is the ticket_id (see handle_query).
+        Results are yielded in completion order. Each result carries the
+        position of its query in the input ("index") and its "latency".
+        Batch statistics are kept in self.last_batch_stats once the
+        iterator is exhausted.
+        """
+        stats = BatchStats()
+        self.last_batch_stats = stats
+        pending = {}
+        queries = iter(enumerate(queries))
+        
+        def run_one(customer_query, customer_id, ticket_id=None):
+            started = time.perf_counter()
+            try:
+                result = self.handle_query(customer_query, customer_id, verbose=False, ticket_id=ticket_id)
+            except Exception as e:
+                result = {"status": "ERROR", "error": str(e)}
+            result["latency"] = time.perf_counter() - started
+            return result
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            exhausted = False
+            while True:
+                # Keep the pool busy without reading the whole input up front
+                incoming = []
+                while not exhausted and len(pending) + len(incoming) < max_workers * 2:
+                    try:
+                        incoming.append(next(queries))
+                    except StopIteration:
+                        exhausted = True
+                
+                # Load the customers of the new tickets in one query
+                get_customer_store().prefetch(ticket[1] for _, ticket in incoming)
+                for index, ticket in incoming:
+                    future = pool.submit(run_one, *ticket)
+                    pending[future] = index
+                
+                if not pending:
+                    break
+                
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    result["index"] = pending.pop(future)
+                    stats.record(result["status"], result["latency"])
+                    yield result
+        
+        stats.finish()
+        if self.verbose:
+            stats.report()
+
+# ============================================================================
+# SHARDED WORKERS
+# ============================================================================
+
+def shard_for(key: str, shards: int) -> int:
+    """Shard of a customer: the same on every run and in every process (unlike hash())"""
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+def shard_path(path: str, shard: int) -> str:
+    """Per-shard file name, e.g. checkpoints.log -> checkpoints-2.log"""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{shard}{ext}"
+
+def _shard_worker(shard: int, inbox, results, options: Dict):
+    """Worker process: runs the tickets of one shard
+    
+    Tickets of different customers run concurrently on a thread pool;
+    a customer's tickets wait for the one before them to finish, so they
+    run in the order they were sent.
+    """
+    checkpoints = CheckpointLog(shard_path(options["checkpoints_path"], shard)) \
+        if options["checkpoints_path"] else None
+    # One dispatcher per outbox file, or two processes would send the same action
+    set_outbox(ActionOutbox(shard_path(options["outbox_path"], shard)))
+    resilience = ResilientClient(limiter=RateLimiter(options["requests_per_minute"],
+                                                     options["tokens_per_minute"]))
+    system = CustomerCareSystem(options["api_key"], verbose=False, checkpoints=checkpoints,
+                                resilience=resilience, agent_workers=max(16, options["concurrency"] * 3))
+    pool = ThreadPoolExecutor(max_workers=options["concurrency"])
+    lock = threading.Lock()
+    idle = threading.Condition(lock)
+    waiting = {}   # Customer -> tickets queued behind the one running
+    
+    def run(item):
+        index, (customer_query, customer_id, ticket_id) = item
+        started = time.perf_counter()
+        try:
+            result = system.handle_query(customer_query, customer_id, verbose=False, ticket_id=ticket_id)
+        except Exception as e:
+            result = {"status": "ERROR", "error": str(e)}
+        result.update({"index": index, "shard": shard, "latency": time.perf_counter() - started})
+        # Plain JSON types, so the result always pickles (a failed pickle would be lost silently)
+        results.put(json.loads(json.dumps(result, default=str)))
+        key = customer_id or index
+        with lock:
+            if waiting[key]:
+                pool.submit(run, waiting[key].popleft())
+            else:
+                del waiting[key]
+                idle.notify_all()
+    
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        key = item[1][1] or item[0]   # Tickets without a customer need no ordering
+        with lock:
+            if key in waiting:
+                waiting[key].append(item)
+                continue
+            waiting[key] = deque()
+        pool.submit(run, item)
+    
+    with lock:
+        idle.wait_for(lambda: not waiting)
+    pool.shutdown()
+    system.agent_pool.shutdown()
+    if checkpoints is not None:
+        # Only tickets that never finished are kept for the next run
+        checkpoints.compact()
+        checkpoints.close()
+    _outbox.close()
+
+class ShardSupervisor:
+    """Runs tickets on N worker processes, sharded by customer
+    
+    A ticket goes to the shard its customer_id hashes to, so all of a
+    customer's tickets are handled by one process, in order, while other
+    customers run in parallel on other cores. A worker that dies is
+    restarted and gets every ticket of its shard that had no result yet,
+    in the original order. A ticket without a ticket_id is given one
+    before it is sent (the run's id and its input index), so a ticket
+    sent again resumes from its checkpoint and does not queue its
+    refunds or emails twice. Checkpoint logs and outboxes are per shard (see shard_path), so keep
+    the worker count when resuming a run.
+    """
+    def __init__(self, workers: int = 4, concurrency: int = 16, api_key: Optional[str] = None,
+                 checkpoints_path: Optional[str] = None, outbox_path: Optional[str] = None,
+                 requests_per_minute: float = 500, tokens_per_minute: float = 30_000,
+                 max_pending: int = 256, restart_limit: int = 10):
+        self.workers = workers
+        # Each worker gets an equal part of the rate limits
+        self.options = {
+            "api_key": api_key or os.getenv("OPENAI_API_KEY"),
+            "concurrency": concurrency,
+            "checkpoints_path": checkpoints_path,
+            "outbox_path": outbox_path or os.getenv("CUSTOMER_CARE_OUTBOX_PATH", "outbox.sqlite3"),
+            "requests_per_minute": requests_per_minute / workers,
+            "tokens_per_minute": tokens_per_minute / workers
         }
+        self.max_pending = max_pending
+        self.restart_limit = restart_limit
+        # Spawn, not fork: the parent has running threads (outbox, checkpoints, pools)
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue()
+        self.inboxes = [None] * workers
+        self.processes = [None] * workers
+        self.outstanding = [OrderedDict() for _ in range(workers)]   # Sent, no result yet
+        self.shard_stats = [BatchStats() for _ in range(workers)]
+        self.restarts = [0] * workers
+        self.last_check = 0.0
+        self.run_id = uuid.uuid4().hex[:8]
+        
+    def _start(self, shard: int):
+        """Start (or restart) a shard's worker and send it the shard's unfinished tickets"""
+        if self.inboxes[shard] is not None:
+            self.inboxes[shard].close()
+            self.inboxes[shard].cancel_join_thread()
+        self.inboxes[shard] = self.context.Queue()
+        self.processes[shard] = self.context.Process(
+            target=_shard_worker, args=(shard, self.inboxes[shard], self.results, self.options),
+            name=f"care-shard-{shard}", daemon=True)
+        self.processes[shard].start()
+        for item in self.outstanding[shard].items():
+            self.inboxes[shard].put(item)
+        
+    def _check_workers(self):
+        """Restart workers that died"""
+        self.last_check = time.monotonic()
+        for shard, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            if self.restarts[shard] >= self.restart_limit:
+                raise RuntimeError(f"Shard {shard} worker died {self.restarts[shard] + 1} times "
+                                   f"(exit code {process.exitcode})")
+            self.restarts[shard] += 1
+            self._start(shard)
+        
+    def _collect(self, timeout: float) -> Optional[Dict]:
+        """The next result, or None if none came within timeout"""
+        if time.monotonic() - self.last_check > 0.5:
+            self._check_workers()
+        try:
+            result = self.results.get(timeout=timeout)
+        except queue.Empty:
+            self._check_workers()
+            return None
+        shard = result["shard"]
+        if self.outstanding[shard].pop(result["index"], None) is None:
+            return None   # Sent again after a restart and already answered
+        self.shard_stats[shard].record(result["status"], result["latency"])
+        return result
+        
+    def run(self, tickets: Iterable[Tuple]) -> Iterator[Dict]:
+        """Process (query, customer_id[, ticket_id]) tuples; results are yielded as they finish
+        
+        Each result carries its "index" in the input and its "shard". At
+        most max_pending tickets wait per shard, so a large input is not
+        read into memory.
+        """
+        for shard in range(self.workers):
+            self._start(shard)
+        try:
+            for index, ticket in enumerate(tickets):
+                customer_query, customer_id, ticket_id = (tuple(ticket) + (None,))[:3]
+                shard = shard_for(customer_id or str(index), self.workers)
+                while len(self.outstanding[shard]) >= self.max_pending:
+                    result = self._collect(timeout=0.5)
+                    if result is not None:
+                        yield result
+                # Fixed before dispatch: a replay must reuse the outbox keys derived from it
+                item = (customer_query, customer_id, ticket_id or f"TKT-{self.run_id}-{index}")
+                self.outstanding[shard][index] = item
+                self.inboxes[shard].put((index, item))
+            while any(self.outstanding):
+                result = self._collect(timeout=0.5)
+                if result is not None:
+                    yield result
+        finally:
+            self.close()
+        
+    def stats(self) -> Dict[int, Dict]:
+        """Per shard: tickets waiting or running (depth), throughput, latency and restarts"""
+        report = {}
+        for shard in range(self.workers):
+            summary = self.shard_stats[shard].summary()
+            process = self.processes[shard]
+            summary.update({"depth": len(self.outstanding[shard]), "restarts": self.restarts[shard],
+                            "alive": process is not None and process.is_alive()})
+            report[shard] = summary
+        return report
+        
+    def close(self, timeout: float = 30.0):
+        """Let the workers finish what they have, then stop them"""
+        for shard, process in enumerate(self.processes):
+            if process is not None and process.is_alive():
+                self.inboxes[shard].put(None)
+        for shard, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+            self.shard_stats[shard].finish()
+
+# ============================================================================
+# HEADLESS MODE
+# ============================================================================
+
+def read_tickets(source, fmt: str = "jsonl") -> Iterator[Dict]:
+    """Tickets from a JSONL or CSV stream, read lazily
+    
+    Each record needs a "query" and may have "customer_id" and
+    "ticket_id". Every ticket gets a stable "input_id" (its ticket_id,
+    or its record number) used to resume an interrupted run. A record
+    without a ticket_id is given one derived from its input_id and
+    content, so a rerun resumes its checkpoint and reuses its outbox
+    keys instead of refunding or emailing again.
+    """
+    rows = csv.DictReader(source) if fmt == "csv" else (
+        json.loads(line) for line in source if line.strip())
+    for number, row in enumerate(rows, 1):
+        query = (row.get("query") or "").strip()
+        if not query:
+            continue
+        customer_id = row.get("customer_id") or None
+        input_id = row.get("ticket_id") or str(number)
+        # The content keeps record 3 of one file apart from record 3 of another
+        digest = hashlib.sha256(f"{input_id}\0{customer_id}\0{query}".encode("utf-8")).hexdigest()
+        yield {"query": query, "customer_id": customer_id,
+               "ticket_id": row.get("ticket_id") or f"TKT-IN-{digest[:16]}", "input_id": input_id}
+
+def completed_inputs(output_path: str) -> set:
+    """input_ids already written to an output file by an earlier run
+    
+    Tickets that errored are not counted, so they are tried again. A
+    line cut off by a crash is ignored.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") != "ERROR":
+                done.add(record.get("input_id"))
+    return done
+
+def run_headless(input_path: str, output_path: str, fmt: Optional[str] = None, concurrency: int = 16,
+                 checkpoints_path: Optional[str] = None, requests_per_minute: float = 500,
+                 tokens_per_minute: float = 30_000, workers: int = 1) -> Dict:
+    """Process a ticket file (or stdin, as "-") without prompts or console output
+    
+    Results are appended to output_path as JSONL as tickets finish, each
+    line flushed and fsynced before the next is written. Running the same command again skips tickets already in the output,
+    so an interrupted backfill carries on where it stopped. Tickets that
+    were mid-pipeline resume from their checkpoint when they carry a
+    ticket_id and checkpoints_path is set. The rate limits are the
+    starting quota; the API's rate-limit headers adjust them. With
+    workers > 1 the tickets run on a ShardSupervisor's processes, each
+    with concurrency threads, and counts["shards"] has per-shard stats.
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise SystemExit("OPENAI_API_KEY is not set")
+    fmt = fmt or ("csv" if input_path.endswith(".csv") else "jsonl")
+    done = completed_inputs(output_path)
+    checkpoints = system = supervisor = None
+    if workers > 1:
+        supervisor = ShardSupervisor(workers, concurrency, api_key, checkpoints_path,
+                                     requests_per_minute=requests_per_minute,
+                                     tokens_per_minute=tokens_per_minute)
+    else:
+        checkpoints = CheckpointLog(checkpoints_path) if checkpoints_path else None
+        resilience = ResilientClient(limiter=RateLimiter(requests_per_minute, tokens_per_minute))
+        system = CustomerCareSystem(api_key, verbose=False, checkpoints=checkpoints, resilience=resilience,
+                                    agent_workers=max(16, concurrency * 3))
+    
+    source = sys.stdin if input_path == "-" else open(input_path, newline="", encoding="utf-8")
+    counts = {"skipped": 0, "queued": 0, "written": 0, "errors": 0}
+    tickets = {}   # Batch index -> ticket, until its result is written
+    
+    def pending():
+        for ticket in read_tickets(source, fmt):
+            if ticket["input_id"] in done:
+                counts["skipped"] += 1
+                continue
+            tickets[counts["queued"]] = ticket
+            counts["queued"] += 1
+            yield ticket["query"], ticket["customer_id"], ticket["ticket_id"]
+    
+    started = time.perf_counter()
+    try:
+        with open(output_path, "a", encoding="utf-8") as out:
+            results = supervisor.run(pending()) if supervisor else \
+                system.handle_batch(pending(), max_workers=concurrency)
+            for result in results:
+                ticket = tickets.pop(result.pop("index"))
+                result["input_id"] = ticket["input_id"]
+                out.write(json.dumps(result, default=str) + "\n")
+                # A finished ticket missing from the output would be run again after a crash
+                out.flush()
+                os.fsync(out.fileno())
+                counts["written"] += 1
+                counts["errors"] += result["status"] == "ERROR"
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if system is not None:
+            system.agent_pool.shutdown()
+        if checkpoints is not None:
+            # Only tickets that never finished are kept for the next run
+            checkpoints.compact()
+            checkpoints.close()
+        if _outbox is not None:
+            # Whatever is still pending is sent on the next run
+            _outbox.flush()
+    counts["seconds"] = round(time.perf_counter() - started, 3)
+    if supervisor:
+        counts["shards"] = supervisor.stats()
+    return counts
 
 # ============================================================================
 # INTERACTIVE MENU
@@ -546,6 +4411,26 @@ def get_scenario(choice: str):
 
 def main():
     """Main function"""
+    parser = argparse.ArgumentParser(description="Customer care multi-agent system")
+    parser.add_argument("--input", help="JSONL/CSV ticket file, or - for JSONL on stdin (runs headless)")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--format", choices=("jsonl", "csv"), help="input format (default: from the extension)")
+    parser.add_argument("--concurrency", type=int, default=16, help="tickets in flight (per worker)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes; tickets are sharded by customer_id")
+    parser.add_argument("--checkpoints", help="checkpoint log, to resume tickets that were mid-pipeline")
+    parser.add_argument("--requests-per-minute", type=float, default=500)
+    parser.add_argument("--tokens-per-minute", type=float, default=30_000)
+    args = parser.parse_args()
+    if args.input:
+        counts = run_headless(args.input, args.output, args.format, args.concurrency, args.checkpoints,
+                              args.requests_per_minute, args.tokens_per_minute, workers=args.workers)
+        sys.stderr.write(f"{counts['written']} written ({counts['errors']} errors), "
+                         f"{counts['skipped']} already done, {counts['seconds']}s\n")
+        for shard, stats in counts.get("shards", {}).items():
+            sys.stderr.write(f"  shard {shard}: {stats['queries']} tickets, {stats['throughput_qps']}/s, "
+                             f"p95 {stats['latency_p95_s']}s, {stats['restarts']} restarts\n")
+        return
     
     print("\n" + "🌟"*40)
     print("CUSTOMER CARE MULTI-AGENT SYSTEM")
@@ -593,6 +4478,11 @@ def main():
                 customer_id=scenario.get("customer_id")
             )
             
+            if result["status"] == "ESCALATED":
+                approval = input("\nApprove now? (yes/no, no leaves it in the queue): ").strip().lower()
+                if approval in ['yes', 'y']:
+                    result = system.approve(result["ticket_id"], approved_by="console")
+            
             # Display summary
             print("\n" + "📊"*40)
             print("RESOLUTION SUMMARY")
@@ -0,0 +1,103 @@
+"""ApprovalQueue: a parked ticket sends nothing until a human approves it"""
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import MockOpenAIServer
+from customer_care_SIMPLE import ActionOutbox, ApprovalQueue, CustomerCareState, CustomerCareSystem
+
+QUERY = "I want a refund for order ORD-321, it arrived broken"
+REFUND = {"order_id": "ORD-321", "amount": 1500, "reason": "Arrived broken"}
+EMAIL = {"subject": "Your refund has been processed"}
+
+
+@pytest.fixture
+def system(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = MockOpenAIServer({QUERY: "REFUND"}, "fixed:0.01",
+                              tool_calls={"process_refund": REFUND, "send_email": EMAIL}).start()
+    monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+    outbox = ActionOutbox(str(tmp_path / "outbox.sqlite3"))
+    system = CustomerCareSystem("sk-mock", verbose=False, outbox=outbox,
+                                approval_queue=ApprovalQueue(str(tmp_path / "approvals.sqlite3")))
+    yield system
+    outbox.close()
+    system.approvals.close()
+    server.close()
+
+
+def outbox_kinds(tmp_path):
+    """Kinds of the actions in the outbox, sent or not"""
+    db = sqlite3.connect(str(tmp_path / "outbox.sqlite3"))
+    try:
+        return sorted(kind for kind, in db.execute("SELECT kind FROM outbox"))
+    finally:
+        db.close()
+
+
+def test_parked_ticket_holds_refund_and_email(system, tmp_path):
+    result = system.handle_query(QUERY, "67890", verbose=False, ticket_id="T1")
+    assert result["status"] == "ESCALATED"
+    assert outbox_kinds(tmp_path) == []
+    assert [ticket["ticket_id"] for ticket in system.pending_approvals()] == ["T1"]
+
+
+def test_reject_drops_held_actions(system, tmp_path):
+    system.handle_query(QUERY, "67890", verbose=False, ticket_id="T1")
+    assert system.reject("T1", "alice")["status"] == "REJECTED"
+    assert outbox_kinds(tmp_path) == []
+    with pytest.raises(KeyError):
+        system.approve("T1", "bob")
+    assert system.approvals.stats() == {"rejected": 1}
+
+
+def test_approve_carries_out_held_actions_once(system, tmp_path):
+    system.handle_query(QUERY, "67890", verbose=False, ticket_id="T1")
+    result = system.approve("T1", "alice")
+    assert result["status"] == "RESOLVED"
+    assert outbox_kinds(tmp_path) == ["email", "refund"]
+    with pytest.raises(KeyError):
+        system.approve("T1", "alice")
+    with pytest.raises(KeyError):
+        system.reject("T1", "bob")
+    assert system.approvals.stats() == {"resolved": 1}
+
+
+def test_failed_approval_can_be_retried(system, tmp_path, monkeypatch):
+    system.handle_query(QUERY, "67890", verbose=False, ticket_id="T1")
+    outbox = ActionOutbox.enqueue
+
+    def fail_once(self, kind, *args, **kwargs):
+        monkeypatch.setattr(ActionOutbox, "enqueue", outbox)
+        raise sqlite3.OperationalError("disk I/O error")
+    monkeypatch.setattr(ActionOutbox, "enqueue", fail_once)
+
+    with pytest.raises(sqlite3.OperationalError):
+        system.approve("T1", "alice")
+    assert system.approvals.stats() == {"approved": 1}
+    assert system.approve("T1", "alice")["status"] == "RESOLVED"
+    assert outbox_kinds(tmp_path) == ["email", "refund"]
+
+
+def test_unknown_ticket_raises(system):
+    with pytest.raises(KeyError):
+        system.approve("NOPE", "alice")
+    with pytest.raises(KeyError):
+        system.reject("NOPE", "alice")
+
+
+def test_queue_lists_pending_oldest_first(tmp_path):
+    queue = ApprovalQueue(str(tmp_path / "queue.sqlite3"))
+    for ticket_id in ("T1", "T2", "T3"):
+        state = CustomerCareState()
+        state.ticket_id, state.customer_id, state.escalation_reason = ticket_id, "67890", "Large refund"
+        queue.park(state, {"status": "ESCALATED"})
+    queue.decide("T2", False, "alice")
+    assert [ticket["ticket_id"] for ticket in queue.pending()] == ["T1", "T3"]
+    assert queue.stats() == {"pending": 2, "rejected": 1}
+    queue.close()
@@ -0,0 +1,105 @@
+"""CheckpointLog: interrupted tickets resume, torn records are cut off, the log stays bounded"""
+
+import copy
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import MockOpenAIServer
+from customer_care_SIMPLE import ApprovalQueue, CheckpointLog, CustomerCareSystem
+
+QUERY = "Where is my package ORD-555?"
+
+
+def checkpoint(step):
+    return {"state": {"step": step}, "outputs": {"greeter": "x" * 200}}
+
+
+def test_reopened_log_finds_unfinished_tickets(tmp_path):
+    path = str(tmp_path / "checkpoints.log")
+    log = CheckpointLog(path)
+    log.append("T1", checkpoint(1))
+    log.append("T1", checkpoint(2))
+    log.append("T2", checkpoint(1))
+    log.finish("T2")
+    log.close()
+
+    log = CheckpointLog(path)
+    assert log.unfinished() == ["T1"]
+    assert log.latest("T1") == checkpoint(2)
+    assert log.latest("T2") is None
+    log.close()
+
+
+def test_torn_final_record_is_cut_off(tmp_path):
+    path = str(tmp_path / "checkpoints.log")
+    log = CheckpointLog(path)
+    log.append("T1", checkpoint(1))
+    log.close()
+    intact = os.path.getsize(path)
+    log = CheckpointLog(path)
+    log.append("T1", checkpoint(2))
+    log.close()
+    # A crash in the middle of writing the second record
+    with open(path, "r+b") as f:
+        f.truncate(intact + (os.path.getsize(path) - intact) // 2)
+
+    log = CheckpointLog(path)
+    assert os.path.getsize(path) == intact
+    assert log.latest("T1") == checkpoint(1)
+    # New records go after the intact ones, not after the torn bytes
+    log.append("T1", checkpoint(3))
+    log.close()
+    log = CheckpointLog(path)
+    assert log.latest("T1") == checkpoint(3)
+    log.close()
+
+
+def test_log_is_compacted_as_it_grows(tmp_path):
+    path = str(tmp_path / "checkpoints.log")
+    log = CheckpointLog(path, compact_min_bytes=4096)
+    log.append("OPEN", checkpoint(1))
+    for i in range(200):
+        log.append(f"T{i}", checkpoint(1))
+        log.finish(f"T{i}")
+    log.flush()
+    assert log.stats()["compactions"] > 0
+    assert os.path.getsize(path) < 2 * 4096
+    assert log.unfinished() == ["OPEN"]
+    assert log.latest("OPEN") == checkpoint(1)
+    log.close()
+
+
+def test_resume_runs_only_the_remaining_agents(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = MockOpenAIServer({QUERY: "TRACKING"}, "fixed:0.01").start()
+    monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+    approvals = ApprovalQueue(str(tmp_path / "approvals.sqlite3"))
+    try:
+        # A full run, keeping each checkpoint it writes
+        log = CheckpointLog(str(tmp_path / "full.log"))
+        saved = []
+        append = log.append
+        monkeypatch.setattr(log, "append", lambda ticket_id, data: (saved.append(copy.deepcopy(data)),
+                                                                     append(ticket_id, data)))
+        system = CustomerCareSystem("sk-mock", verbose=False, checkpoints=log, approval_queue=approvals)
+        requests = server.stats["requests"]
+        system.handle_query(QUERY, "11111", verbose=False, ticket_id="T1")
+        full_run = server.stats["requests"] - requests
+        log.close()
+
+        # A log left behind by a crash after the first three agents
+        crashed = next(data for data in saved if len(data["outputs"]) == 3)
+        log = CheckpointLog(str(tmp_path / "crashed.log"))
+        log.append("T1", crashed)
+        system = CustomerCareSystem("sk-mock", verbose=False, checkpoints=log, approval_queue=approvals)
+        requests = server.stats["requests"]
+        result = system.resume("T1")
+        assert result["status"] == "RESOLVED"
+        assert server.stats["requests"] - requests == full_run - 3
+        assert log.unfinished() == []
+        log.close()
+    finally:
+        approvals.close()
+        server.close()
@@ -0,0 +1,36 @@
+"""EarlyExitPolicy: simple tickets skip agents, but never the checks that protect customers"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from customer_care_SIMPLE import (DEFAULT_CUSTOMERS, PREMIUM_TIERS, CustomerCareState, EarlyExitPolicy,
+                                  RoutingPolicy)
+
+
+def ticket(intent="TRACKING", sentiment="NEUTRAL", tier="Standard"):
+    state = CustomerCareState()
+    state.intent, state.sentiment, state.priority = intent, sentiment, "LOW"
+    state.intent_confidence = 0.95
+    state.customer_info = {"tier": tier}
+    return state
+
+
+def test_simple_ticket_skips_escalation():
+    assert EarlyExitPolicy().skips("escalation", ticket())
+
+
+@pytest.mark.parametrize("state", [ticket(intent="OTHER"), ticket(sentiment="NEGATIVE"), ticket(tier="Premium")])
+def test_escalation_always_runs_for_at_risk_tickets(state):
+    assert not EarlyExitPolicy().skips("escalation", state)
+
+
+def test_premium_tiers_are_shared_and_exist():
+    # Routing and early exit agree on who is premium, and every such tier is a real one
+    assert set(PREMIUM_TIERS) <= {tier for _, _, _, tier, _, _ in DEFAULT_CUSTOMERS}
+    for tier in PREMIUM_TIERS:
+        assert RoutingPolicy().level(ticket(tier=tier))[0] == "premium"
+        assert not EarlyExitPolicy().skips("escalation", ticket(tier=tier))
@@ -0,0 +1,37 @@
+"""FastPathClassifier: only answers where held-out answers meet the target accuracy"""
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("numpy")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import synthetic_tickets, training_rows
+from customer_care_SIMPLE import FastPathClassifier
+
+CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "intent_training.csv")
+
+
+def test_bundled_demo_csv_never_skips_the_greeter():
+    classifier = FastPathClassifier.from_csv(CSV)
+    assert classifier.threshold == FastPathClassifier.NEVER
+    assert all(classifier.classify(row["text"]) is None for row in training_rows(CSV))
+
+
+def test_calibrated_threshold_meets_target_on_held_out_rows():
+    # Template tickets: easy to classify, so a usable threshold exists
+    rows = [{"text": ticket["query"], "intent": ticket["intent"], "sentiment": "NEUTRAL", "priority": "MEDIUM"}
+            for ticket in synthetic_tickets(300)]
+    classifier = FastPathClassifier.from_rows(rows, target_accuracy=0.95)
+    assert classifier.threshold < FastPathClassifier.NEVER
+    answered = [right for _, prediction, right in FastPathClassifier.held_out(rows)
+                if prediction["confidence"] >= classifier.threshold]
+    assert len(answered) >= 20
+    assert sum(answered) >= 0.95 * len(answered)
+
+
+def test_fixed_threshold_is_kept():
+    assert FastPathClassifier.from_csv(CSV, threshold=0.7).threshold == 0.7
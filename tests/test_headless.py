@@ -0,0 +1,78 @@
+"""run_headless: rerunning a ticket file never repeats a ticket's outbox actions"""
+
+import json
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import MockOpenAIServer
+from customer_care_SIMPLE import ActionOutbox, read_tickets, run_headless, set_outbox
+
+QUERY = "I want a refund for my order, it arrived broken"
+EMAIL = {"subject": "About your refund"}
+
+
+@pytest.fixture
+def headless(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = MockOpenAIServer({QUERY: "REFUND"}, "fixed:0.01", tool_calls={"send_email": EMAIL}).start()
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-mock")
+    monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+    monkeypatch.setenv("CUSTOMER_CARE_APPROVALS_PATH", str(tmp_path / "approvals.sqlite3"))
+    with open(tmp_path / "tickets.jsonl", "w", encoding="utf-8") as f:
+        for customer_id in ("12345", "67890", "11111"):
+            f.write(json.dumps({"query": QUERY, "customer_id": customer_id}) + "\n")
+    outboxes = []
+
+    def run():
+        # A fresh outbox on the same file, as in a new process
+        outboxes.append(ActionOutbox(str(tmp_path / "outbox.sqlite3")))
+        set_outbox(outboxes[-1])
+        return run_headless(str(tmp_path / "tickets.jsonl"), str(tmp_path / "results.jsonl"), concurrency=3)
+    yield run
+    for outbox in outboxes:
+        outbox.close()
+    set_outbox(None)
+    server.close()
+
+
+def outbox_rows(tmp_path):
+    db = sqlite3.connect(str(tmp_path / "outbox.sqlite3"))
+    try:
+        return db.execute("SELECT ticket_id, kind FROM outbox").fetchall()
+    finally:
+        db.close()
+
+
+def test_rerun_after_lost_results_sends_nothing_twice(headless, tmp_path):
+    assert headless()["written"] == 3
+    first = sorted(outbox_rows(tmp_path))
+    assert [kind for _, kind in first] == ["email"] * 3
+
+    # A crash after the emails were queued but before the results were written
+    os.remove(tmp_path / "results.jsonl")
+    assert headless()["written"] == 3
+    assert sorted(outbox_rows(tmp_path)) == first
+
+
+def test_rerun_skips_finished_tickets(headless, tmp_path):
+    headless()
+    counts = headless()
+    assert counts["skipped"] == 3
+    assert counts["written"] == 0
+    assert len(outbox_rows(tmp_path)) == 3
+
+
+def test_ticket_ids_are_stable_across_reads(tmp_path):
+    path = tmp_path / "tickets.csv"
+    path.write_text("query,customer_id\nWhere is ORD-555?,11111\nReset my password,\n", encoding="utf-8")
+    with open(path, newline="", encoding="utf-8") as f:
+        first = [ticket["ticket_id"] for ticket in read_tickets(f, "csv")]
+    with open(path, newline="", encoding="utf-8") as f:
+        second = [ticket["ticket_id"] for ticket in read_tickets(f, "csv")]
+    assert first == second
+    assert len(set(first)) == 2
@@ -0,0 +1,72 @@
+"""KnowledgeBase: BM25 ranking, MaxScore pruning and in-place updates"""
+
+import math
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from customer_care_SIMPLE import DEFAULT_ARTICLES, KnowledgeBase, index_terms
+
+WORDS = ["refund", "order", "broken", "late", "shipping", "express", "password", "reset", "email",
+         "warranty", "claim", "exchange", "size", "color", "billing", "charge", "account", "label"]
+
+
+def exhaustive(kb, query, top_k):
+    """Plain BM25 over every article, no pruning"""
+    average_length = kb.total_length / len(kb.articles)
+    scores = {}
+    for doc_id, text in kb.articles.items():
+        terms = index_terms(f"{doc_id} {text}")
+        score = 0.0
+        for term in set(index_terms(query)):
+            tf = terms.count(term)
+            if tf:
+                df = len(kb.postings[term])
+                idf = math.log(1 + (len(kb.articles) - df + 0.5) / (df + 0.5))
+                norm = kb.k1 * (1 - kb.b + kb.b * len(terms) / average_length)
+                score += idf * tf * (kb.k1 + 1) / (tf + norm)
+        if score:
+            scores[doc_id] = score
+    return sorted(scores.values(), reverse=True)[:top_k]
+
+
+def test_search_finds_the_matching_article_first():
+    kb = KnowledgeBase.from_articles(DEFAULT_ARTICLES)
+    assert kb.search("how do I reset my password")[0][0] == "password"
+    assert kb.search("refunds for a broken order")[0][0] == "refund"
+    results = kb.search("return label for a refund", top_k=2)
+    assert [doc_id for doc_id, _, _ in results] == ["return", "refund"]
+    assert results[0][1] >= results[1][1]
+
+
+def test_search_without_matches_is_empty():
+    assert KnowledgeBase().search("refund") == []
+    assert KnowledgeBase.from_articles(DEFAULT_ARTICLES).search("zebra") == []
+
+
+@pytest.mark.parametrize("top_k", [1, 3, 10])
+def test_maxscore_matches_exhaustive_bm25(top_k):
+    rng = random.Random(7)
+    # Zipf-like term frequencies, so rare terms score high and pruning kicks in
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    kb = KnowledgeBase.from_articles({f"doc{i}": " ".join(rng.choices(WORDS, weights, k=rng.randint(3, 40)))
+                                      for i in range(200)})
+    for _ in range(50):
+        query = " ".join(rng.sample(WORDS, rng.randint(1, 6)))
+        scores = [score for _, score, _ in kb.search(query, top_k=top_k)]
+        assert scores == [round(score, 4) for score in exhaustive(kb, query, top_k)]
+
+
+def test_update_and_remove_change_the_index_in_place():
+    kb = KnowledgeBase.from_articles(DEFAULT_ARTICLES)
+    kb.update("refund", "Refund Policy: Full refunds within 60 days.")
+    assert "60 days" in kb.search("refund policy")[0][2]
+    kb.remove("warranty")
+    assert len(kb) == len(DEFAULT_ARTICLES) - 1
+    assert all(doc_id != "warranty" for doc_id, _, _ in kb.search("warranty claims electronics", top_k=10))
+    assert "electronic" not in kb.postings
+    assert kb.total_length == sum(kb.lengths.values())
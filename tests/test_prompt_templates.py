@@ -0,0 +1,46 @@
+"""PromptTemplate: every agent sends a byte-identical prefix, whatever the ticket"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import MockOpenAIServer
+from customer_care_SIMPLE import CustomerCareSystem
+
+QUERIES = {"Where is my package ORD-555?": "TRACKING", "How do I reset my password?": "ACCOUNT"}
+
+
+def test_system_prefix_is_identical_across_tickets(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = MockOpenAIServer(QUERIES, "fixed:0.01").start()
+    monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+    sent = []
+    respond = server.respond
+    monkeypatch.setattr(server, "respond", lambda path, request: (sent.append(request["messages"]),
+                                                                  respond(path, request))[1])
+    try:
+        system = CustomerCareSystem("sk-mock", verbose=False)
+        system.handle_query("Where is my package ORD-555?", "11111", verbose=False)
+        first = len(sent)
+        system.handle_query("How do I reset my password?", "12345", verbose=False)
+    finally:
+        server.close()
+
+    assert 0 < first < len(sent)
+    prefixes = {agent.prompt.system_prompt for agent in system.agents.values()}
+    assert len(prefixes) == len(system.agents)
+    for messages in sent:
+        # The static prompt comes first; the ticket's context and task come after it
+        assert messages[0]["role"] == "system"
+        assert messages[0]["content"] in prefixes
+        assert "ORD-555" not in messages[0]["content"]
+    assert {m[0]["content"] for m in sent[:first]} == {m[0]["content"] for m in sent[first:]}
+
+
+def test_sync_and_async_agents_share_one_template(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = CustomerCareSystem("sk-mock", verbose=False)
+    for key, agent in system.agents.items():
+        assert system.async_agents[key].prompt is agent.prompt
+        assert system.prompts[agent.name] is agent.prompt
@@ -0,0 +1,138 @@
+"""ResilientClient and CircuitBreaker: retries, stream settlement and breaker state"""
+
+import os
+import sys
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from customer_care_SIMPLE import CircuitBreaker, CircuitOpenError, RateLimiter, ResilientClient
+
+REQUEST = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "Where is my order?"}],
+           "max_tokens": 500, "stream": True}
+
+
+def chunk(content=None, usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content is not None else []
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+def connection_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+
+
+class FakeCompletions:
+    """create() returns each of streams in turn; a stream item that is an exception is raised mid-stream"""
+    def __init__(self, *streams):
+        self.streams = list(streams)
+        self.calls = 0
+
+    def create(self, **request):
+        self.calls += 1
+        items = self.streams.pop(0)
+
+        def stream():
+            for item in items:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        return stream()
+
+
+def client():
+    return ResilientClient(max_retries=2, backoff_base=0.0,
+                           limiter=RateLimiter(requests_per_minute=1e6, tokens_per_minute=10_000),
+                           breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+
+
+def test_stream_settles_from_usage_chunk():
+    resilient = client()
+    completions = FakeCompletions([chunk("On "), chunk("its way"), chunk(usage=SimpleNamespace(total_tokens=40))])
+    tokens = []
+    response = resilient.call(completions, on_token=tokens.append, **REQUEST)
+    assert response.choices[0].message.content == "On its way"
+    assert tokens == ["On ", "its way"]
+    # Only the 40 tokens used are gone, not the 500-token max_tokens estimate
+    assert resilient.limiter.levels["tokens"] == pytest.approx(10_000 - 40, abs=1)
+
+
+def test_stream_without_usage_settles_from_received_text():
+    resilient = client()
+    resilient.call(FakeCompletions([chunk("On "), chunk("its way")]), on_token=lambda token: None, **REQUEST)
+    assert resilient.limiter.levels["tokens"] > 10_000 - 100
+
+
+def test_error_before_first_token_is_retried():
+    resilient = client()
+    completions = FakeCompletions([connection_error()], [chunk("Sorry"), chunk(usage=SimpleNamespace(total_tokens=9))])
+    tokens = []
+    resilient.call(completions, on_token=tokens.append, **REQUEST)
+    assert completions.calls == 2
+    assert tokens == ["Sorry"]
+    assert resilient.report()["retries"] == 1
+
+
+def test_error_mid_stream_counts_as_failure_without_retry():
+    resilient = client()
+    completions = FakeCompletions([chunk("Your refund "), connection_error()], [chunk("never used")])
+    tokens = []
+    with pytest.raises(openai.APIConnectionError):
+        resilient.call(completions, on_token=tokens.append, **REQUEST)
+    # Retrying would send the customer the start of the reply twice
+    assert completions.calls == 1
+    assert tokens == ["Your refund "]
+    assert resilient.breaker.failures == 1
+    assert resilient.report()["failures"] == 1
+
+
+def test_breaker_opens_probes_and_closes(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("customer_care_SIMPLE.time.monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    assert breaker.allow() is False
+    breaker.record(False)
+    assert breaker.state == "closed"
+    breaker.record(False)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+    now[0] += 30
+    assert breaker.state == "half-open"
+    assert breaker.allow() is True     # The one trial call
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()                # Everyone else waits for its verdict
+    breaker.record(False)
+    assert breaker.state == "open"     # A failed trial opens it for another reset_timeout
+    assert breaker.opened == 1
+
+    now[0] += 30
+    assert breaker.allow() is True
+    breaker.record(True)
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+
+
+def test_released_trial_lets_the_next_call_try(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("customer_care_SIMPLE.time.monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record(False)
+    now[0] += 30
+    assert breaker.allow() is True
+    breaker.release()                  # e.g. the trial was rate limited
+    assert breaker.allow() is True
+
+
+def test_rejected_requests_do_not_open_the_breaker():
+    resilient = client()
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    bad_request = openai.BadRequestError("bad", response=httpx.Response(400, request=request), body=None)
+    for _ in range(5):
+        with pytest.raises(openai.BadRequestError):
+            resilient.call(FakeCompletions([bad_request]), on_token=lambda token: None, **REQUEST)
+    assert resilient.breaker.state == "closed"
@@ -0,0 +1,52 @@
+"""ResponseCache: hits stay in memory, and the disk tier still evicts the least recently used"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from customer_care_SIMPLE import ResponseCache
+
+
+def test_hits_do_not_write_to_disk(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), max_memory_entries=1)
+    cache.put("a", "answer a")
+    cache.put("b", "answer b")
+    changes = cache.db.total_changes
+    for _ in range(10):
+        assert cache.get("a") == "answer a"   # From disk: "b" holds the one memory slot
+        assert cache.get("b") == "answer b"
+    assert cache.db.total_changes == changes
+    assert cache.stats()["disk_hits"] == 20
+    cache.close()
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = ResponseCache(path, max_memory_entries=1, max_disk_entries=60)
+    for i in range(50):
+        cache.put(f"old{i}", f"answer {i}")
+    for i in range(10):
+        cache.get(f"old{i}")
+    # The 100th write trims the disk tier to 60 rows
+    for i in range(50):
+        cache.put(f"new{i}", f"answer {i}")
+    cache.close()
+
+    cache = ResponseCache(path, max_memory_entries=1)
+    assert all(cache.get(f"old{i}") == f"answer {i}" for i in range(10))
+    assert all(cache.get(f"old{i}") is None for i in range(10, 50))
+    assert all(cache.get(f"new{i}") == f"answer {i}" for i in range(50))
+    cache.close()
+
+
+def test_uses_survive_close(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = ResponseCache(path)
+    cache.put("a", "answer a")
+    cache.get("a")
+    used_at = cache.used["a"]
+    cache.close()
+    cache = ResponseCache(path)
+    assert cache.db.execute("SELECT used_at FROM responses WHERE key = 'a'").fetchone()[0] == used_at
+    cache.close()
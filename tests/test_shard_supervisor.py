@@ -0,0 +1,77 @@
+"""ShardSupervisor: a worker killed mid-ticket must not repeat the ticket's side effects"""
+
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import MockOpenAIServer
+from customer_care_SIMPLE import ShardSupervisor, shard_path
+
+QUERY = "I want a refund for order ORD-12345, it arrived broken"
+EMAIL = {"subject": "About your refund"}
+# Demo customers with an email address on file, on both of the two shards
+CUSTOMERS = ("12345", "67890", "11111")
+
+
+def outbox_rows(path):
+    """(ticket_id, kind) of every action in an outbox file"""
+    if not os.path.exists(path):
+        return []
+    db = sqlite3.connect(path, timeout=5)
+    try:
+        return db.execute("SELECT ticket_id, kind FROM outbox").fetchall()
+    except sqlite3.OperationalError:   # Table not created yet
+        return []
+    finally:
+        db.close()
+
+
+def test_restarted_worker_does_not_repeat_actions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = MockOpenAIServer({QUERY: "REFUND"}, "fixed:0.2", tool_calls={"send_email": EMAIL}).start()
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-mock")
+    monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+    monkeypatch.setenv("CUSTOMER_CARE_APPROVALS_PATH", str(tmp_path / "approvals.sqlite3"))
+    outbox_path = str(tmp_path / "outbox.sqlite3")
+    supervisor = ShardSupervisor(workers=2, concurrency=4, outbox_path=outbox_path,
+                                 requests_per_minute=1e9, tokens_per_minute=1e12)
+    tickets = [(QUERY, CUSTOMERS[i % len(CUSTOMERS)]) for i in range(8)]
+    finished = set()
+    killed = {}
+
+    def kill_mid_ticket():
+        # Kill a worker as soon as one of its tickets has queued its email but not finished
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline and not killed:
+            for shard in range(supervisor.workers):
+                started = {ticket_id for ticket_id, _ in outbox_rows(shard_path(outbox_path, shard))}
+                process = supervisor.processes[shard]
+                if started - finished and process is not None and process.is_alive():
+                    killed[shard] = started - finished
+                    os.kill(process.pid, signal.SIGKILL)
+                    return
+            time.sleep(0.005)
+
+    killer = threading.Thread(target=kill_mid_ticket, daemon=True)
+    killer.start()
+    try:
+        results = []
+        for result in supervisor.run(tickets):
+            results.append(result)
+            finished.add(result.get("ticket_id"))
+        killer.join()
+    finally:
+        server.close()
+
+    assert killed, "no worker was killed mid-ticket"
+    assert sum(supervisor.restarts) == 1
+    assert sorted(result["index"] for result in results) == list(range(len(tickets)))
+    rows = [row for shard in range(supervisor.workers) for row in outbox_rows(shard_path(outbox_path, shard))]
+    # One email per ticket, including the tickets that ran again after the restart
+    assert sorted(rows) == sorted(set(rows))
+    assert len(rows) == len(tickets)
@@ -0,0 +1,55 @@
+"""Tools: the model's arguments can only reach the customer on the ticket"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from customer_care_SIMPLE import (CustomerCareState, _current_state, lookup_customer, process_refund,
+                                  send_email, track_shipment)
+
+
+@pytest.fixture
+def ticket():
+    state = CustomerCareState()
+    state.ticket_id = "T1"
+    state.customer_id = "67890"   # John Doe, owner of ORD-321
+    token = _current_state.set(state)
+    yield state
+    _current_state.reset(token)
+
+
+def test_lookup_only_the_ticket_customer(ticket):
+    assert lookup_customer("67890")["email"] == "john@email.com"
+    with pytest.raises(PermissionError):
+        lookup_customer("12345")
+
+
+def test_track_only_own_orders(ticket):
+    track_shipment("ORD-321")
+    with pytest.raises(PermissionError):
+        track_shipment("ORD-555")   # Sarah Johnson's parcel
+    with pytest.raises(PermissionError):
+        track_shipment("ORD-000")
+
+
+def test_refund_only_own_orders(ticket):
+    with pytest.raises(PermissionError):
+        process_refund("ORD-789", 10, "Not John's order")
+    with pytest.raises(ValueError):
+        process_refund("ORD-321", 0, "Nothing")
+    assert ticket.pending_actions == []
+
+
+def test_email_goes_to_the_address_on_file(ticket):
+    send_email("Your refund")
+    assert ticket.pending_actions == [{"tool": "send_email",
+                                       "arguments": {"recipient": "john@email.com", "subject": "Your refund"}}]
+
+
+def test_no_email_without_an_address(ticket):
+    ticket.customer_id = "Unknown"
+    with pytest.raises(PermissionError):
+        send_email("Your refund")